@@ -5,10 +5,14 @@ from werkzeug.utils import secure_filename
 import requests
 from dotenv import load_dotenv
 import json
+from llm_client import get_llm_client
+from structured_output import complete_structured, StructuredOutputError
 
 # Load environment variables
 load_dotenv()
 
+llm_client = get_llm_client("deepseek")
+
 app = Flask(__name__)
 
 
@@ -37,9 +41,6 @@ def generate_structured_data(text):
     """
     Generate structured data using Deepseek API
     """
-    DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
-    DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
-    
     prompt = f"""
     Analyze the following medical document and extract the following information in JSON format:
     - condition: The medical condition being discussed
@@ -52,39 +53,21 @@ def generate_structured_data(text):
     Return ONLY the JSON object, nothing else.
     """
     
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {DEEPSEEK_API_KEY}'
-    }
-    
-    data = {
-        "model": "deepseek-chat",
-        "messages": [
-            {"role": "system", "content": "You are a medical document analyzer. Extract key information and return it in JSON format."},
-            {"role": "user", "content": prompt}
-        ],
-        "temperature": 0.1
-    }
-    
-    response = requests.post(DEEPSEEK_API_URL, headers=headers, json=data)
-    
-    if response.status_code == 200:
-        try:
-            # Extract the JSON content from the response
-            content = response.json()['choices'][0]['message']['content']
-            # Clean the response to ensure it's valid JSON
-            content = content.strip()
-            if content.startswith('```json'):
-                content = content[7:]
-            if content.endswith('```'):
-                content = content[:-3]
-            return json.loads(content)
-        except Exception as e:
-            print(f"Error parsing response: {e}")
-            return None
-    else:
-        print(f"Error from Deepseek API: {response.status_code}")
-        print(response.text)
+    try:
+        return complete_structured(
+            llm_client,
+            model="deepseek-chat",
+            messages=[
+                {"role": "system", "content": "You are a medical document analyzer. Extract key information and return it in JSON format."},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.1
+        )
+    except StructuredOutputError as e:
+        print(f"Error parsing response: {e}")
+        return None
+    except Exception as e:
+        print(f"Error from Deepseek API: {e}")
         return None
 
 @app.route('/process-pdfs', methods=['POST'])
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Add the numeric ``decision_ts`` metadata field to precedent vectors indexed without it.
+
+pinecone-db.py writes ``decision_ts`` (seconds since the epoch) next to the
+ISO ``decision_date`` because Pinecone range filters only work on numbers.
+Vectors upserted before that have only ``decision_date``, so a recency
+filter matches none of them. This walks the index, derives ``decision_ts``
+from ``decision_date`` and sets it in place; vectors that already have it
+are left alone, so the script can be re-run.
+
+Run it before enabling PRECEDENT_RECENCY_YEARS against an existing index.
+
+Usage:
+    python backfill_decision_ts.py --dry-run
+    python backfill_decision_ts.py --index health-claims --workers 8
+"""
+
+import argparse
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import pinecone
+from dotenv import load_dotenv
+
+from rate_limiter import BATCH, RateLimitedIndex, use_priority
+
+load_dotenv()
+PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
+
+FETCH_BATCH_SIZE = 100
+
+
+def decision_ts(metadata: Dict[str, Any]) -> Optional[int]:
+    """Seconds since the epoch of a precedent's ``decision_date``, or None if it has none"""
+    value = metadata.get("decision_date")
+    if not value:
+        return None
+    try:
+        decided = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if decided.tzinfo is None:
+        decided = decided.replace(tzinfo=timezone.utc)
+    return int(decided.timestamp())
+
+
+def backfill_batch(index, ids: List[str], namespace: str = "", dry_run: bool = False) -> Dict[str, int]:
+    """
+    Set ``decision_ts`` on the vectors in one batch that lack it
+
+    Returns:
+        Counts of updated, already present and undated vectors
+    """
+    counts = {"updated": 0, "present": 0, "undated": 0}
+    fetched = index.fetch(ids=ids, namespace=namespace).vectors
+    for vector_id in ids:
+        vector = fetched.get(vector_id)
+        if vector is None:
+            continue
+        metadata = dict(vector.metadata or {})
+        if "decision_ts" in metadata:
+            counts["present"] += 1
+            continue
+        ts = decision_ts(metadata)
+        if ts is None:
+            counts["undated"] += 1
+            continue
+        if not dry_run:
+            index.update(id=vector_id, set_metadata={"decision_ts": ts}, namespace=namespace)
+        counts["updated"] += 1
+    return counts
+
+
+def run(index, namespace: str = "", workers: int = 4, dry_run: bool = False) -> Dict[str, int]:
+    """Backfill every vector in the namespace; returns the summed counts"""
+    report = {"updated": 0, "present": 0, "undated": 0}
+
+    def _add(counts: Dict[str, int]) -> None:
+        for key, value in counts.items():
+            report[key] += value
+
+    def _submit(pool, ids: List[str]):
+        # Workers don't inherit context variables; carry the caller's priority lane over
+        return pool.submit(contextvars.copy_context().run, backfill_batch, index, ids, namespace, dry_run)
+
+    pending: List[str] = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for page in index.list(namespace=namespace):
+            pending.extend(page)
+            while len(pending) >= FETCH_BATCH_SIZE:
+                futures.append(_submit(pool, pending[:FETCH_BATCH_SIZE]))
+                pending = pending[FETCH_BATCH_SIZE:]
+        if pending:
+            futures.append(_submit(pool, pending))
+        for future in futures:
+            _add(future.result())
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Add decision_ts metadata to precedents indexed without it")
+    parser.add_argument("--index", default="health-claims")
+    parser.add_argument("--namespace", default="")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--dry-run", action="store_true", help="Only count what would be updated")
+    args = parser.parse_args()
+
+    if not PINECONE_API_KEY:
+        raise RuntimeError("PINECONE_API_KEY must be set in .env")
+
+    # A bulk rewrite: keep the API's interactive queries ahead of it on the shared key
+    use_priority(BATCH)
+    pc = pinecone.Pinecone(api_key=PINECONE_API_KEY)
+    index = RateLimitedIndex(pc.Index(args.index), name=args.index)
+
+    report = run(index, args.namespace, args.workers, args.dry_run)
+    for key, value in report.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+"""
+Blob backends for claim file content.
+
+FileStorage keeps file metadata in MongoDB (file_refs, file_blobs) and the
+(possibly compressed) bytes in one of these stores, chosen for new blobs by
+``FILE_BLOB_BACKEND``:
+
+* ``gridfs``: fs.files / fs.chunks in the claims database (the original layout),
+* ``local``: one file per blob under ``FILE_BLOB_DIR``; uncompressed blobs can be
+  handed to a reverse proxy for zero-copy sendfile serving,
+* ``s3``: any S3-compatible object store (AWS, MinIO for local runs via
+  ``S3_ENDPOINT_URL``); requires ``boto3`` (``poetry install -E s3``).
+
+Each blob records which backend holds it, so stores can be mixed while
+``migrate_blobs.py`` moves existing content. ``cold-local`` and ``cold-s3``
+are the archive tier ``retention.py`` moves old claims' files to: a separate
+directory (``FILE_COLD_DIR``) or bucket/prefix with a cheaper storage class.
+"""
+
+import os
+import tempfile
+import threading
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+from database import get_db
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+FILE_BLOB_BACKEND = os.getenv("FILE_BLOB_BACKEND", "gridfs")
+FILE_BLOB_DIR = os.getenv("FILE_BLOB_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "blobs"))
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+S3_BUCKET = os.getenv("S3_BUCKET", "claim-files")
+S3_PREFIX = os.getenv("S3_PREFIX", "blobs/")
+S3_REGION = os.getenv("S3_REGION", "us-east-1")
+# Zero-copy serving of local blobs: name the reverse proxy's internal-redirect header
+# (X-Accel-Redirect for nginx, X-Sendfile for Apache/lighttpd) and the internal location
+# that maps to FILE_BLOB_DIR; the proxy then sendfile()s the blob itself
+FILE_SENDFILE_HEADER = os.getenv("FILE_SENDFILE_HEADER")
+FILE_SENDFILE_PREFIX = os.getenv("FILE_SENDFILE_PREFIX", "/protected-blobs/")
+# Cold (archive) tier
+FILE_COLD_DIR = os.getenv("FILE_COLD_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cold-blobs"))
+S3_COLD_BUCKET = os.getenv("S3_COLD_BUCKET", S3_BUCKET)
+S3_COLD_PREFIX = os.getenv("S3_COLD_PREFIX", "cold/")
+# Instant-retrieval classes only: reads must not need a restore request
+S3_COLD_STORAGE_CLASS = os.getenv("S3_COLD_STORAGE_CLASS", "STANDARD_IA")
+
+READ_CHUNK_SIZE = 255 * 1024  # GridFS default chunk size, also used to read local and S3 blobs
+GRIDFS_BATCH_CHUNKS = 16
+
+GRIDFS = "gridfs"
+LOCAL = "local"
+S3 = "s3"
+COLD_LOCAL = "cold-local"
+COLD_S3 = "cold-s3"
+COLD_BACKENDS = {COLD_LOCAL, COLD_S3}
+
+
+class BlobStore:
+    """Where a blob's bytes live; keys are chosen by the caller (FileStorage uses the SHA-256)"""
+
+    name = ""
+
+    def put(self, key: Any, chunks: Iterable[bytes], metadata: Optional[Dict[str, Any]] = None) -> int:
+        """
+        Store a blob from a stream of chunks
+
+        Args:
+            key: The blob's key
+            chunks: The content, in order
+            metadata: Descriptive fields the backend may keep alongside
+
+        Returns:
+            The number of bytes stored
+        """
+        raise NotImplementedError
+
+    def open(self, key: Any) -> Iterator[bytes]:
+        """Iterate over a blob's bytes (raises KeyError if it doesn't exist)"""
+        raise NotImplementedError
+
+    def delete(self, key: Any) -> bool:
+        """Delete a blob; False if it didn't exist"""
+        raise NotImplementedError
+
+    def exists(self, key: Any) -> bool:
+        raise NotImplementedError
+
+    def local_path(self, key: Any) -> Optional[str]:
+        """Path of the blob on this machine's disk, if the backend has one"""
+        return None
+
+
+class GridFSBlobStore(BlobStore):
+    """
+    The standard GridFS layout, read and written with plain pymongo
+
+    Chunks are read directly rather than through GridFSBucket: files written by the old
+    /direct-upload handlers have no length field, which GridOut requires.
+    """
+
+    name = GRIDFS
+
+    def __init__(self, db=None):
+        self.db = db if db is not None else get_db()
+        # What GridFSBucket would create on its first write
+        self.db.fs.chunks.create_index([("files_id", 1), ("n", 1)], unique=True)
+
+    def put(self, key: Any, chunks: Iterable[bytes], metadata: Optional[Dict[str, Any]] = None) -> int:
+        # Chunks are inserted in small batches as they arrive; the fs.files document goes
+        # last, so a file is only visible once complete
+        length = 0
+        batch = []
+        try:
+            for n, data in enumerate(chunks):
+                batch.append({"files_id": key, "n": n, "data": data})
+                length += len(data)
+                if len(batch) >= GRIDFS_BATCH_CHUNKS:
+                    self.db.fs.chunks.insert_many(batch, ordered=True)
+                    batch = []
+            if batch:
+                self.db.fs.chunks.insert_many(batch, ordered=True)
+            self.db.fs.files.insert_one({
+                "_id": key,
+                "filename": str(key),
+                "length": length,
+                "chunkSize": READ_CHUNK_SIZE,
+                "uploadDate": datetime.now(),
+                "metadata": metadata or {},
+            })
+        except Exception:
+            self.db.fs.chunks.delete_many({"files_id": key})
+            raise
+        return length
+
+    def open(self, key: Any) -> Iterator[bytes]:
+        if not self.exists(key):
+            raise KeyError(key)
+        return (chunk["data"] for chunk in self.db.fs.chunks.find({"files_id": key}, {"data": 1}).sort("n", 1))
+
+    def delete(self, key: Any) -> bool:
+        deleted = self.db.fs.files.delete_one({"_id": key}).deleted_count
+        self.db.fs.chunks.delete_many({"files_id": key})
+        return deleted == 1
+
+    def exists(self, key: Any) -> bool:
+        return self.db.fs.files.find_one({"_id": key}, {"_id": 1}) is not None
+
+
+class LocalBlobStore(BlobStore):
+    """One file per blob, sharded by key prefix; writes land atomically via rename"""
+
+    name = LOCAL
+
+    def __init__(self, root: str = FILE_BLOB_DIR, name: Optional[str] = None):
+        self.root = root
+        if name:
+            self.name = name
+
+    def _path(self, key: Any) -> str:
+        key = str(key)
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def put(self, key: Any, chunks: Iterable[bytes], metadata: Optional[Dict[str, Any]] = None) -> int:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        length = 0
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".upload-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for data in chunks:
+                    f.write(data)
+                    length += len(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return length
+
+    def open(self, key: Any) -> Iterator[bytes]:
+        try:
+            # Opened now, so a reader keeps its file even if the blob is moved (e.g. rehydrated) meanwhile
+            f = open(self._path(key), "rb")
+        except FileNotFoundError:
+            raise KeyError(key)
+
+        def _read():
+            with f:
+                while True:
+                    data = f.read(READ_CHUNK_SIZE)
+                    if not data:
+                        break
+                    yield data
+        return _read()
+
+    def delete(self, key: Any) -> bool:
+        try:
+            os.remove(self._path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def exists(self, key: Any) -> bool:
+        return os.path.exists(self._path(key))
+
+    def local_path(self, key: Any) -> Optional[str]:
+        return self._path(key)
+
+
+class _ChunkReader:
+    """Minimal file-like view of a chunk iterator, for boto3's managed (multipart) uploads"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+        self.length = 0
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            data = next(self._chunks, None)
+            if data is None:
+                break
+            self._buffer += data
+            self.length += len(data)
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+class S3BlobStore(BlobStore):
+    """S3-compatible object storage (AWS S3, MinIO...)"""
+
+    name = S3
+
+    def __init__(self, bucket: str = S3_BUCKET, prefix: str = S3_PREFIX, endpoint_url: Optional[str] = S3_ENDPOINT_URL,
+                 region: str = S3_REGION, client=None, name: Optional[str] = None, storage_class: Optional[str] = None):
+        if client is None:
+            if boto3 is None:
+                raise RuntimeError("boto3 is not installed (poetry install -E s3)")
+            # Credentials come from the usual AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY variables
+            client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.storage_class = storage_class
+        if name:
+            self.name = name
+        self._bucket_checked = False
+
+    def _key(self, key: Any) -> str:
+        return f"{self.prefix}{key}"
+
+    def _ensure_bucket(self) -> None:
+        if self._bucket_checked:
+            return
+        try:
+            self.client.head_bucket(Bucket=self.bucket)
+        except ClientError:
+            self.client.create_bucket(Bucket=self.bucket)
+        self._bucket_checked = True
+
+    def put(self, key: Any, chunks: Iterable[bytes], metadata: Optional[Dict[str, Any]] = None) -> int:
+        self._ensure_bucket()
+        reader = _ChunkReader(chunks)
+        extra = {"Metadata": {name: str(value) for name, value in (metadata or {}).items()}}
+        if self.storage_class:
+            extra["StorageClass"] = self.storage_class
+        self.client.upload_fileobj(reader, self.bucket, self._key(key), ExtraArgs=extra)
+        return reader.length
+
+    def open(self, key: Any) -> Iterator[bytes]:
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=self._key(key))["Body"]
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                raise KeyError(key)
+            raise
+        return body.iter_chunks(READ_CHUNK_SIZE)
+
+    def delete(self, key: Any) -> bool:
+        existed = self.exists(key)
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+        return existed
+
+    def exists(self, key: Any) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+            return True
+        except ClientError:
+            return False
+
+
+def sendfile_headers(path: str) -> Optional[Dict[str, str]]:
+    """
+    Headers handing a local blob to the reverse proxy, if one is configured
+
+    Args:
+        path: A path returned by ``local_path``
+
+    Returns:
+        The internal-redirect header, or None to serve the file from the app
+    """
+    if not FILE_SENDFILE_HEADER:
+        return None
+    if FILE_SENDFILE_HEADER.lower() == "x-accel-redirect":
+        relative = os.path.relpath(path, FILE_BLOB_DIR).replace(os.sep, "/")
+        return {FILE_SENDFILE_HEADER: FILE_SENDFILE_PREFIX.rstrip("/") + "/" + relative}
+    return {FILE_SENDFILE_HEADER: os.path.abspath(path)}
+
+
+_STORE_TYPES = {
+    GRIDFS: GridFSBlobStore,
+    LOCAL: LocalBlobStore,
+    S3: S3BlobStore,
+    COLD_LOCAL: lambda: LocalBlobStore(FILE_COLD_DIR, name=COLD_LOCAL),
+    COLD_S3: lambda: S3BlobStore(S3_COLD_BUCKET, S3_COLD_PREFIX, name=COLD_S3, storage_class=S3_COLD_STORAGE_CLASS),
+}
+_stores: Dict[str, BlobStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_blob_store(name: Optional[str] = None) -> BlobStore:
+    """
+    The shared store for a backend
+
+    Args:
+        name: ``gridfs``, ``local``, ``s3``, ``cold-local`` or ``cold-s3`` (``FILE_BLOB_BACKEND`` if omitted)
+    """
+    name = name or FILE_BLOB_BACKEND
+    with _stores_lock:
+        if name not in _stores:
+            if name not in _STORE_TYPES:
+                raise ValueError(f"Unknown blob backend: {name}")
+            _stores[name] = _STORE_TYPES[name]()
+        return _stores[name]
@@ -0,0 +1,162 @@
+"""
+Read-through cache for claim documents.
+
+Nearly every claims route starts by loading the claim, so ClaimService keeps
+recently read claims in a bounded LRU with a short TTL, keyed by ``claimId``
+and reachable by ``_id``. Every ClaimService write invalidates the claim;
+fills that raced with a write (the read started before the invalidation) are
+dropped, so a stale document can't be cached after the write that replaced
+it. Writes made by other processes are picked up after the TTL, or
+immediately when ``CLAIM_CACHE_WATCH`` tails the collection's change stream
+(requires a replica set).
+
+Cached documents are shared: treat them as read-only.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+CLAIM_CACHE_ENABLED = os.getenv("CLAIM_CACHE_ENABLED", "true").lower() == "true"
+CLAIM_CACHE_TTL = float(os.getenv("CLAIM_CACHE_TTL", "30"))
+CLAIM_CACHE_MAX_ENTRIES = int(os.getenv("CLAIM_CACHE_MAX_ENTRIES", "1000"))
+CLAIM_CACHE_WATCH = os.getenv("CLAIM_CACHE_WATCH", "false").lower() == "true"
+
+
+class ClaimCache:
+    """Thread-safe LRU + TTL cache of stored claim documents (``_id`` as a string)"""
+
+    def __init__(self, ttl_seconds: float = CLAIM_CACHE_TTL, max_entries: int = CLAIM_CACHE_MAX_ENTRIES,
+                 enabled: bool = CLAIM_CACHE_ENABLED):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._entries: "OrderedDict[str, Tuple[Dict[str, Any], float]]" = OrderedDict()
+        self._object_ids: Dict[str, str] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._watcher: Optional[threading.Thread] = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.stale_fills = 0
+
+    @property
+    def generation(self) -> int:
+        """Pass to ``put`` to have the fill dropped if an invalidation happened since"""
+        return self._generation
+
+    def _drop(self, claim_id: str) -> None:
+        entry = self._entries.pop(claim_id, None)
+        if entry is not None:
+            self._object_ids.pop(str(entry[0].get("_id")), None)
+
+    def get(self, claim_id: Optional[str] = None, object_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Look up a claim by ``claimId`` or by ``_id``
+
+        Args:
+            claim_id: The claim's claimId
+            object_id: The claim's _id as a string
+
+        Returns:
+            The cached document, or None on a miss
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            if claim_id is None and object_id is not None:
+                claim_id = self._object_ids.get(str(object_id))
+            entry = self._entries.get(claim_id) if claim_id is not None else None
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    self._drop(claim_id)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(claim_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, claim: Dict[str, Any], generation: Optional[int] = None) -> None:
+        """
+        Cache a full claim document
+
+        Args:
+            claim: The stored document with ``_id`` converted to a string
+            generation: ``generation`` read before the document was fetched
+        """
+        claim_id = claim.get("claimId")
+        if not self.enabled or not claim_id:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                self.stale_fills += 1
+                return
+            self._drop(claim_id)
+            self._entries[claim_id] = (claim, time.time() + self.ttl_seconds)
+            if claim.get("_id") is not None:
+                self._object_ids[str(claim["_id"])] = claim_id
+            while len(self._entries) > self.max_entries:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._object_ids.pop(str(evicted.get("_id")), None)
+
+    def invalidate(self, *keys: Any) -> None:
+        """Forget claims by ``claimId`` or ``_id`` (either works, so callers needn't know which they hold)"""
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            for key in keys:
+                if key is None:
+                    continue
+                key = str(key)
+                self._drop(self._object_ids.get(key, key))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._object_ids.clear()
+
+    def watch(self, collection, on_change: Optional[Callable[[Any], None]] = None) -> None:
+        """
+        Invalidate on changes made by any process, by tailing the collection's change stream
+
+        Args:
+            collection: The pymongo claims collection (its deployment must support change streams)
+            on_change: Also called with each changed claim's ``_id`` (to invalidate other caches)
+        """
+        if self._watcher is not None:
+            return
+
+        def _run():
+            try:
+                with collection.watch() as stream:
+                    for change in stream:
+                        document_key = change.get("documentKey") or {}
+                        self.invalidate(document_key.get("_id"))
+                        if on_change is not None:
+                            on_change(document_key.get("_id"))
+            except Exception as e:
+                print(f"Claim cache change stream stopped, relying on TTL: {str(e)}")
+                self.clear()
+
+        self._watcher = threading.Thread(target=_run, daemon=True, name="claim-cache-watch")
+        self._watcher.start()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "invalidations": self.invalidations,
+                "stale_fills": self.stale_fills,
+                "watching": self._watcher is not None and self._watcher.is_alive(),
+            }
+
+
+claim_cache = ClaimCache()
@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field
+from pydantic import AliasPath, BaseModel, Field
 from typing import List, Optional
 from datetime import datetime
 from enum import Enum
@@ -68,4 +68,17 @@ class Claim(BaseModel):
         }
 
 class ClaimInDB(Claim):
-    _id: Optional[str] = None 
\ No newline at end of file
+    _id: Optional[str] = None 
+
+class ClaimSummary(BaseModel):
+    """List-view row: read from the stored claim's nested fields, serialized flat"""
+    claimId: Optional[str] = None
+    status: ClaimStatus
+    submittedAt: datetime
+    providerType: ProviderType = Field(validation_alias=AliasPath("provider", "providerType"))
+    providerName: str = Field(validation_alias=AliasPath("provider", "providerName"))
+    patientName: str = Field(validation_alias=AliasPath("patient", "patientName"))
+    patientInsuranceProvider: str = Field(validation_alias=AliasPath("patient", "patientInsuranceProvider"))
+    serviceType: ServiceType = Field(validation_alias=AliasPath("service", "serviceType"))
+    serviceDate: str = Field(validation_alias=AliasPath("service", "serviceDate"))
+    totalCharge: str = Field(validation_alias=AliasPath("service", "totalCharge"))
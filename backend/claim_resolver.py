@@ -0,0 +1,157 @@
+"""
+One lookup for every kind of claim identifier clients send.
+
+Claims are referred to by their claimId ("MH-2024-0001"), by their _id as an
+ObjectId string, or (for a few old documents) by a string _id. Rather than
+trying each in turn, the identifier is classified once and matched with a
+single ``$or`` over indexed fields. The resulting claimId <-> _id mapping is
+cached, so repeat lookups (every file of a multi-file upload, a dashboard
+reloading) don't touch the database at all; updates then target ``_id``.
+
+Every route and script in a process shares ``claim_resolver``, so one
+``forget`` (ClaimService deletes and claimId changes, the claim cache's
+change stream) reaches all of them. Mappings written by other processes
+expire after ``CLAIM_RESOLVER_TTL``.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from bson import ObjectId
+from pymongo.collection import Collection
+
+from database import get_claims_collection
+
+CLAIM_RESOLVER_MAX_ENTRIES = int(os.getenv("CLAIM_RESOLVER_MAX_ENTRIES", "10000"))
+CLAIM_RESOLVER_TTL = float(os.getenv("CLAIM_RESOLVER_TTL", "300"))
+
+
+class ResolvedClaim(NamedTuple):
+    object_id: Any
+    claim_id: Optional[str]
+
+    @property
+    def query(self) -> Dict[str, Any]:
+        """Filter matching exactly this claim, for updates"""
+        return {"_id": self.object_id}
+
+
+def claim_match(identifier: str) -> Dict[str, Any]:
+    """
+    The filter matching a claim by any of its identifiers
+
+    Args:
+        identifier: A claimId, or a claim _id (ObjectId hex or legacy string)
+    """
+    if ObjectId.is_valid(identifier):
+        return {"$or": [{"_id": ObjectId(identifier)}, {"claimId": identifier}]}
+    return {"$or": [{"claimId": identifier}, {"_id": identifier}]}
+
+
+class ClaimResolver:
+    """Resolves claim identifiers against one claims collection, with an LRU + TTL of the mappings"""
+
+    def __init__(self, collection: Collection, max_entries: int = CLAIM_RESOLVER_MAX_ENTRIES,
+                 ttl_seconds: float = CLAIM_RESOLVER_TTL):
+        self.collection = collection
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._resolved: "OrderedDict[str, Tuple[ResolvedClaim, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._indexed = False
+        self.hits = 0
+        self.misses = 0
+
+    def _ensure_index(self) -> None:
+        if self._indexed:
+            return
+        try:
+            self.collection.create_index("claimId")
+        except Exception as e:
+            # An existing (e.g. unique) index on claimId serves the lookup just as well
+            print(f"Could not create claimId index: {str(e)}")
+        self._indexed = True
+
+    def _remember(self, resolved: ResolvedClaim) -> None:
+        expires_at = time.monotonic() + self.ttl_seconds
+        with self._lock:
+            for key in (str(resolved.object_id), resolved.claim_id):
+                if key:
+                    self._resolved[key] = (resolved, expires_at)
+                    self._resolved.move_to_end(key)
+            while len(self._resolved) > self.max_entries:
+                self._resolved.popitem(last=False)
+
+    def find(self, identifier: str, projection: Optional[Dict[str, Any]] = None) -> Optional[dict]:
+        """
+        Load a claim by any identifier with one query, remembering its mapping
+
+        Args:
+            identifier: A claimId or claim _id
+            projection: Fields to return (the whole document if omitted; ``_id`` and
+                ``claimId`` are always read)
+
+        Returns:
+            The stored document, or None if no claim matches
+        """
+        self._ensure_index()
+        if projection is not None:
+            projection = {**projection, "_id": 1, "claimId": 1}
+        candidates: List[dict] = list(self.collection.find(claim_match(identifier), projection).limit(2))
+        if not candidates:
+            return None
+        # An exact _id match wins over a claim whose claimId happens to look the same
+        claim = next((candidate for candidate in candidates if str(candidate["_id"]) == identifier), candidates[0])
+        self._remember(ResolvedClaim(claim["_id"], claim.get("claimId")))
+        return claim
+
+    def resolve(self, identifier: Optional[str]) -> Optional[ResolvedClaim]:
+        """
+        Map any claim identifier to the claim's _id and claimId
+
+        Args:
+            identifier: A claimId or claim _id
+
+        Returns:
+            The resolved claim, or None if no claim matches
+        """
+        if not identifier:
+            return None
+        with self._lock:
+            entry = self._resolved.get(identifier)
+            if entry is not None and entry[1] > time.monotonic():
+                self._resolved.move_to_end(identifier)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                self._resolved.pop(identifier)
+            self.misses += 1
+        claim = self.find(identifier, {"_id": 1})
+        if claim is None:
+            return None
+        return ResolvedClaim(claim["_id"], claim.get("claimId"))
+
+    def forget(self, *identifiers: Any) -> None:
+        """Drop cached mappings (after a delete or a claimId change), by either identifier"""
+        with self._lock:
+            for identifier in identifiers:
+                entry = self._resolved.pop(str(identifier), None) if identifier else None
+                if entry is not None:
+                    for key in (str(entry[0].object_id), entry[0].claim_id):
+                        self._resolved.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._resolved),
+            }
+
+
+claim_resolver = ClaimResolver(get_claims_collection())
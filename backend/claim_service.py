@@ -1,13 +1,20 @@
 import uuid
 from datetime import datetime
-from typing import List, Optional
-from pymongo import MongoClient
+from typing import Iterable, List, Optional
+from pymongo import MongoClient, ReturnDocument
 from pymongo.collection import Collection
-from pymongo.results import InsertOneResult, UpdateResult, DeleteResult
+from pymongo.results import InsertOneResult, DeleteResult
 from bson import ObjectId
 
 from database import get_claims_collection
-from claim_models import Claim, ClaimInDB, ClaimStatus
+from claim_cache import CLAIM_CACHE_WATCH, claim_cache
+from claim_resolver import claim_match, claim_resolver
+from pydantic import AliasPath, BaseModel
+
+from claim_models import Claim, ClaimInDB, ClaimStatus, ClaimSummary
+from file_storage import (
+    FILE_REFS_COLLECTION, LEGACY_INFO_PROJECTION, REF_INFO_PROJECTION, ensure_file_indexes, file_infos,
+)
 
 # Helper function to convert ObjectId to string
 def _convert_objectid_to_str(claim_dict):
@@ -15,9 +22,131 @@ def _convert_objectid_to_str(claim_dict):
         claim_dict["_id"] = str(claim_dict["_id"])
     return claim_dict
 
+# The claim model's fields and nothing else. Not every writer goes through Claim (seed and
+# test scripts insert documents directly), so read paths still validate what they serialize;
+# the projection just keeps unrelated fields from being read. _id is left out: ClaimInDB
+# never serialized it (it is a private attribute).
+CLAIM_PROJECTION = {"_id": 0, **{field: 1 for field in Claim.model_fields}}
+
+def _field_paths(model: type, prefix: str = "") -> List[str]:
+    """Every field path of a model, including dotted paths into nested models"""
+    paths = []
+    for name, field in model.model_fields.items():
+        path = f"{prefix}{name}"
+        paths.append(path)
+        if isinstance(field.annotation, type) and issubclass(field.annotation, BaseModel):
+            paths.extend(_field_paths(field.annotation, f"{path}."))
+    return paths
+
+# Fields that can be requested through ``fields=`` on the claim list
+CLAIM_FIELD_PATHS = frozenset(_field_paths(Claim))
+
+# Only the stored fields ClaimSummary reads
+SUMMARY_PROJECTION = {"_id": 0, **{
+    ".".join(str(part) for part in field.validation_alias.path) if isinstance(field.validation_alias, AliasPath) else name: 1
+    for name, field in ClaimSummary.model_fields.items()
+}}
+
+# Appended to by add_files only: a whole-claim update setting it would drop files attached meanwhile
+APPEND_ONLY_PATHS = frozenset({"service.uploadedFiles"})
+
+def _dotted(fields: dict, prefix: str = "") -> dict:
+    """Flatten nested subdocuments into dotted ``$set`` paths, leaving out APPEND_ONLY_PATHS"""
+    flat = {}
+    for name, value in fields.items():
+        path = f"{prefix}{name}"
+        if path in APPEND_ONLY_PATHS:
+            continue
+        if isinstance(value, dict) and value:
+            flat.update(_dotted(value, f"{path}."))
+        else:
+            flat[path] = value
+    return flat
+
+def claim_projection(fields: Iterable[str]) -> dict:
+    """
+    Build a Mongo projection for the requested claim fields
+
+    Args:
+        fields: Field names, dotted for nested fields (e.g. ``patient.patientName``)
+
+    Returns:
+        An inclusion projection without ``_id``
+
+    Raises:
+        ValueError: If a field isn't part of the claim model
+    """
+    fields = [field.strip() for field in fields if field.strip()]
+    unknown = [field for field in fields if field not in CLAIM_FIELD_PATHS]
+    if unknown:
+        raise ValueError(f"Unknown claim fields: {', '.join(unknown)}")
+    if not fields:
+        return dict(CLAIM_PROJECTION)
+    # A parent path already includes its children, and Mongo rejects projecting both
+    fields = [field for field in fields if not any(field.startswith(f"{other}.") for other in fields)]
+    return {"_id": 0, **{field: 1 for field in fields}}
+
+# Claim dossier: the claim and all of its files' metadata in one aggregation. Files are found
+# the ways they have been attached over time: by ID in service.uploadedFiles, by claimId or
+# the claim's _id (as a string) in the file's claim_id, and, for legacy GridFS files, by the
+# claim's ObjectId in metadata.mongodb_id / metadata.claim_mongodb_id. Every join is an
+# equality $lookup, so each uses an index.
+_DOSSIER_REF_LOOKUPS = {"_refs_by_id": ("_file_oids", "_id"), "_refs_by_claim": ("_claim_keys", "claim_id")}
+_DOSSIER_LEGACY_LOOKUPS = {
+    "_legacy_by_id": ("_file_oids", "_id"),
+    "_legacy_by_claim": ("_claim_keys", "metadata.claim_id"),
+    "_legacy_by_mongodb_id": ("_id", "metadata.mongodb_id"),
+    "_legacy_by_claim_mongodb_id": ("_id", "metadata.claim_mongodb_id"),
+}
+# uploadedFiles holds file IDs as strings; anything that isn't an ObjectId becomes null and matches nothing
+_UPLOADED_FILE_OIDS = {"$map": {
+    "input": {"$ifNull": ["$service.uploadedFiles", []]},
+    "as": "file_id",
+    "in": {"$convert": {"input": "$$file_id", "to": "objectId", "onError": None, "onNull": None}},
+}}
+
+def _dossier_pipeline(match: dict) -> List[dict]:
+    projection = {"_id": 1, **{field: 1 for field in Claim.model_fields}}
+    stages = [
+        {"$match": match},
+        {"$limit": 1},
+        {"$addFields": {"_claim_keys": ["$claimId", {"$toString": "$_id"}], "_file_oids": _UPLOADED_FILE_OIDS}},
+    ]
+    for lookups, collection, fields in (
+        (_DOSSIER_REF_LOOKUPS, FILE_REFS_COLLECTION, REF_INFO_PROJECTION),
+        (_DOSSIER_LEGACY_LOOKUPS, "fs.files", LEGACY_INFO_PROJECTION),
+    ):
+        for name, (local_field, foreign_field) in lookups.items():
+            stages.append({"$lookup": {
+                "from": collection, "localField": local_field, "foreignField": foreign_field, "as": name,
+            }})
+            projection.update({f"{name}._id": 1, **{f"{name}.{field}": 1 for field in fields}})
+    stages.append({"$project": projection})
+    return stages
+
+def _without_id(claim: dict) -> dict:
+    return {key: value for key, value in claim.items() if key != "_id"}
+
 class ClaimService:
     def __init__(self):
         self.collection: Collection = get_claims_collection()
+        self.cache = claim_cache
+        self.resolver = claim_resolver
+        if CLAIM_CACHE_WATCH:
+            self.cache.watch(self.collection, on_change=self.resolver.forget)
+    
+    def _load(self, claim_id: Optional[str] = None, object_id: Optional[ObjectId] = None) -> Optional[dict]:
+        """Read-through: the full stored claim (``_id`` as a string) by claimId or _id"""
+        cached = self.cache.get(claim_id=claim_id, object_id=str(object_id) if object_id is not None else None)
+        if cached is not None:
+            return cached
+        generation = self.cache.generation
+        query = {"claimId": claim_id} if claim_id is not None else {"_id": object_id}
+        claim = self.collection.find_one(query)
+        if claim:
+            claim = _convert_objectid_to_str(claim)
+            self.cache.put(claim, generation)
+        return claim
     
     def create_claim(self, claim: Claim) -> ClaimInDB:
         """Create a new claim"""
@@ -38,9 +167,9 @@ class ClaimService:
     
     def get_claim_by_id(self, claim_id: str) -> Optional[ClaimInDB]:
         """Get a claim by its ID"""
-        claim = self.collection.find_one({"claimId": claim_id})
+        claim = self._load(claim_id=claim_id)
         if claim:
-            return ClaimInDB(**_convert_objectid_to_str(claim))
+            return ClaimInDB(**claim)
         return None
     
     def get_claims(self, status: Optional[ClaimStatus] = None, limit: int = 100, offset: int = 0) -> List[ClaimInDB]:
@@ -57,42 +186,143 @@ class ClaimService:
         
         return claims
     
-    def update_claim(self, claim_id: str, updated_claim: Claim) -> Optional[ClaimInDB]:
-        """Update an existing claim"""
-        # Get the existing claim
-        existing_claim = self.get_claim_by_id(claim_id)
-        if not existing_claim:
+    def get_claim_raw(self, claim_id: str) -> Optional[dict]:
+        """Get a claim's stored document without ``_id``, unvalidated (validate before serializing it)"""
+        claim = self._load(claim_id=claim_id)
+        if claim:
+            return _without_id(claim)
+        return None
+    
+    def get_claims_raw(self, status: Optional[ClaimStatus] = None, limit: int = 100, offset: int = 0,
+                       projection: Optional[dict] = None) -> List[dict]:
+        """
+        Like ``get_claims``, but returns the stored documents, for callers that validate them in bulk
+
+        Args:
+            status: Optional status filter
+            limit: Maximum number of claims
+            offset: Number of claims to skip
+            projection: Fields to read (see ``claim_projection``); the claim model's fields by default
+
+        Returns:
+            The stored claim documents, unvalidated
+        """
+        query = {}
+        if status:
+            query["status"] = status.value
+        cursor = self.collection.find(query, projection or CLAIM_PROJECTION)
+        return list(cursor.skip(offset).limit(limit))
+    
+    def get_dossier(self, claim_id: str) -> Optional[dict]:
+        """
+        Get a claim together with its files' metadata in one round trip
+
+        Args:
+            claim_id: The claim's claimId, or its _id as a string
+
+        Returns:
+            ``{"claim": the claim, validated and JSON-ready, "files": file details}``, or None if not found
+        """
+        ensure_file_indexes(self.collection.database)
+        found = next(self.collection.aggregate(_dossier_pipeline(claim_match(claim_id))), None)
+        if not found:
             return None
-        
-        # Prepare update data
-        update_data = updated_claim.model_dump(exclude_unset=True)
-        
-        # Update in MongoDB
-        result: UpdateResult = self.collection.update_one(
+        refs = [ref for name in _DOSSIER_REF_LOOKUPS for ref in found.pop(name)]
+        legacy_files = [file_doc for name in _DOSSIER_LEGACY_LOOKUPS for file_doc in found.pop(name)]
+        claim = ClaimInDB.model_validate(_without_id(found)).model_dump(mode="json")
+        return {"claim": claim, "files": file_infos(refs, legacy_files)}
+    
+    def patch_claim(self, claim_id: str, set_fields: Optional[dict] = None, push: Optional[dict] = None,
+                    projection: Optional[dict] = None) -> Optional[dict]:
+        """
+        Apply a partial update atomically and return the updated document in one round trip
+
+        Args:
+            claim_id: The claimId of the claim
+            set_fields: Dotted field paths to ``$set``
+            push: Array field paths to append to; list values are pushed with ``$each``
+            projection: Fields to return (the whole document if omitted)
+
+        Returns:
+            The updated document (``_id`` as a string), or None if the claim doesn't exist
+        """
+        update = {}
+        if set_fields:
+            update["$set"] = set_fields
+        if push:
+            update["$push"] = {
+                field: {"$each": value} if isinstance(value, list) else value
+                for field, value in push.items()
+            }
+        if not update:
+            claim = self.collection.find_one({"claimId": claim_id}, projection)
+            return _convert_objectid_to_str(claim) if claim else None
+
+        claim = self.collection.find_one_and_update(
             {"claimId": claim_id},
-            {"$set": update_data}
+            update,
+            projection=projection,
+            return_document=ReturnDocument.AFTER,
         )
-        
-        if result.modified_count == 1:
-            return self.get_claim_by_id(claim_id)
-        
+        # Not refilled from the result: a concurrent write may already have superseded it
+        self.cache.invalidate(claim_id)
+        if set_fields and "claimId" in set_fields:
+            self.resolver.forget(claim_id)
+        if claim:
+            return _convert_objectid_to_str(claim)
+        return None
+    
+    def add_files(self, claim_id: str, file_ids: List[str]) -> Optional[List[str]]:
+        """
+        Attach file IDs to a claim without rewriting the rest of the document
+
+        Args:
+            claim_id: The claimId of the claim
+            file_ids: IDs of the stored files to append
+
+        Returns:
+            The claim's full list of uploaded file IDs, or None if the claim doesn't exist
+        """
+        claim = self.patch_claim(
+            claim_id,
+            push={"service.uploadedFiles": list(file_ids)},
+            projection={"_id": 0, "service.uploadedFiles": 1},
+        )
+        if claim is None:
+            return None
+        return claim.get("service", {}).get("uploadedFiles", [])
+    
+    def update_claim(self, claim_id: str, updated_claim: Claim) -> Optional[ClaimInDB]:
+        """
+        Update an existing claim
+
+        Only the fields sent are set, each by its own dotted path, and the
+        uploaded file list is left to ``add_files``: an upload attaching
+        files while this runs keeps them.
+        """
+        claim = self.patch_claim(claim_id, set_fields=_dotted(updated_claim.model_dump(exclude_unset=True)))
+        if claim:
+            return ClaimInDB(**claim)
         return None
     
     def update_claim_status(self, claim_id: str, status: ClaimStatus) -> Optional[ClaimInDB]:
         """Update the status of a claim"""
-        result: UpdateResult = self.collection.update_one(
-            {"claimId": claim_id},
-            {"$set": {"status": status.value}}
-        )
-        
-        if result.modified_count == 1:
-            return self.get_claim_by_id(claim_id)
-        
+        claim = self.patch_claim(claim_id, set_fields={"status": status.value})
+        if claim:
+            return ClaimInDB(**claim)
         return None
     
+    def claim_exists(self, claim_id: str) -> bool:
+        """Check for a claim without loading the document"""
+        if self.cache.get(claim_id=claim_id) is not None:
+            return True
+        return self.collection.find_one({"claimId": claim_id}, {"_id": 1}) is not None
+    
     def delete_claim(self, claim_id: str) -> bool:
         """Delete a claim"""
         result: DeleteResult = self.collection.delete_one({"claimId": claim_id})
+        self.cache.invalidate(claim_id)
+        self.resolver.forget(claim_id)
         return result.deleted_count == 1
     
     def get_claim_by_object_id(self, object_id: ObjectId) -> Optional[ClaimInDB]:
@@ -105,7 +335,7 @@ class ClaimService:
         Returns:
             The claim if found, None otherwise
         """
-        claim_dict = self.collection.find_one({"_id": object_id})
+        claim_dict = self._load(object_id=object_id)
         if claim_dict:
             return ClaimInDB(**claim_dict)
         return None 
\ No newline at end of file
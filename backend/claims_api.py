@@ -1,23 +1,57 @@
-from fastapi import APIRouter, HTTPException, Query, Body, File, UploadFile, Form, Depends, FastAPI
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import APIRouter, HTTPException, Query, Body, File, UploadFile, Form, Depends, FastAPI, Header, Request
+from fastapi.responses import FileResponse as FileDownloadResponse, JSONResponse, ORJSONResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from typing import List, Optional, Dict, Any
 from pydantic import BaseModel
 import json
 import base64
+import orjson
 from pymongo import MongoClient
 from pymongo.collection import Collection
 from bson import ObjectId
 from datetime import datetime
 import os
+from urllib.parse import quote
 
-from claim_models import Claim, ClaimInDB, ClaimStatus
-from claim_service import ClaimService
+from claim_models import Claim, ClaimInDB, ClaimStatus, ClaimSummary
+from claim_service import ClaimService, SUMMARY_PROJECTION, claim_projection
 from file_storage import FileStorage
+from blob_store import sendfile_headers
+from upload_sessions import UploadError, UploadSessions
+from zip_stream import archive_size, check_limits, stream_zip
 
 router = APIRouter(prefix="/claims", tags=["claims"])
 claim_service = ClaimService()
 
+def _attachment(filename: str) -> Dict[str, str]:
+    """
+    Content-Disposition header for downloading a file under the given name
+
+    The quoted ``filename`` is an ASCII fallback with quotes and backslashes
+    escaped and control characters replaced; ``filename*`` carries the exact
+    UTF-8 name (RFC 6266 / RFC 5987) for clients that understand it.
+    """
+    fallback = "".join(c if " " <= c < "\x7f" else "_" for c in filename)
+    fallback = fallback.replace("\\", "\\\\").replace('"', '\\"')
+    return {"Content-Disposition": f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"}
+
+async def _attach_files(claim_id: str, file_ids: List[str]) -> None:
+    """
+    Append stored files to a claim, deleting them again if the claim is gone
+
+    Raises:
+        HTTPException: 404 if the claim no longer exists
+    """
+    # Appended atomically, so concurrent uploads to the same claim can't overwrite each other
+    if await run_in_threadpool(claim_service.add_files, claim_id, file_ids) is not None:
+        return
+    # Deleted since the upload started: don't leave unreachable files (and blob references) behind
+    for file_id in file_ids:
+        if not await FileStorage.delete_file(file_id):
+            print(f"Could not delete file {file_id} of missing claim {claim_id}")
+    raise HTTPException(status_code=404, detail=f"Claim {claim_id} not found")
+
 # Create a standalone app for backward compatibility
 app = FastAPI(title="Claims API")
 app.add_middleware(
@@ -26,6 +60,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Location", "Upload-Offset", "Upload-Length", "Tus-Resumable"],
 )
 app.include_router(router)
 
@@ -38,24 +73,18 @@ async def app_upload_files(
 ):
     """Direct endpoint for file uploads"""
     # Check if the claim exists
-    claim = claim_service.get_claim_by_id(claim_id)
-    if not claim:
+    if not claim_service.claim_exists(claim_id):
         raise HTTPException(status_code=404, detail=f"Claim {claim_id} not found")
     
-    # Save files to GridFS with user_id if provided
-    file_ids = await FileStorage.save_files(files, claim_id, user_id)
-    
-    # Update the claim with the file IDs
-    claim_dict = claim.model_dump()
-    if 'service' in claim_dict and 'uploadedFiles' in claim_dict['service']:
-        claim_dict['service']['uploadedFiles'].extend(file_ids)
-    else:
-        claim_dict['service']['uploadedFiles'] = file_ids
+    # Store the files in parallel; one failing doesn't fail the rest
+    results = await FileStorage.save_files(files, claim_id, user_id)
+    file_ids = [result["file_id"] for result in results if result["success"]]
+    if not file_ids:
+        raise HTTPException(status_code=500, detail={"message": "No files could be stored", "files": results})
     
-    # Update the claim in the database
-    updated_claim = claim_service.update_claim(claim_id, Claim(**claim_dict))
+    await _attach_files(claim_id, file_ids)
     
-    return {"file_ids": file_ids}
+    return {"file_ids": file_ids, "files": results}
 
 @app.get("/claims/{claim_id}/files")
 async def app_get_claim_files(claim_id: str):
@@ -76,38 +105,15 @@ async def app_get_files_by_object_id(object_id: str):
     Get files associated with a MongoDB Object ID (either as the claim's _id or
     where the Object ID is in the claim_id field of file metadata)
     """
-    # First check if there's a claim with this ObjectId
-    try:
-        obj_id = ObjectId(object_id)
-        claim = claim_service.get_claim_by_object_id(obj_id)
-        
-        if claim:
-            # If claim exists, get files by claim ID
-            files = await FileStorage.get_files_for_claim(claim.claimId)
-            return {"success": True, "files": files}
-    except Exception as e:
-        print(f"Error checking claim by ObjectId: {str(e)}")
+    # First check if there's a claim with this ID (one cached lookup)
+    resolved = claim_service.resolver.resolve(object_id)
+    if resolved and resolved.claim_id:
+        files = await FileStorage.get_files_for_claim(resolved.claim_id)
+        return {"success": True, "files": files}
     
-    # If no claim found or error occurred, search directly in GridFS metadata
+    # If no claim found or error occurred, search directly in file metadata
     try:
-        db = claim_service.db
-        files = []
-        
-        # Check for files with this specific ObjectId as claim_id in metadata
-        cursor = db.fs.files.find({"metadata.claim_id": object_id})
-        async for file_doc in cursor:
-            files.append({
-                "_id": str(file_doc["_id"]),
-                "filename": file_doc.get("filename", "unknown"),
-                "uploadDate": file_doc.get("uploadDate", datetime.now()),
-                "metadata": {
-                    "content_type": file_doc.get("metadata", {}).get("content_type", "application/octet-stream"),
-                    "user_id": file_doc.get("metadata", {}).get("user_id"),
-                    "claim_id": file_doc.get("metadata", {}).get("claim_id"),
-                    "uploaded_at": file_doc.get("metadata", {}).get("uploaded_at")
-                }
-            })
-        
+        files = await FileStorage.get_files_by_object_id(object_id)
         return {"success": True, "files": files}
     except Exception as e:
         print(f"Error searching files by ObjectId: {str(e)}")
@@ -120,11 +126,24 @@ class ClaimsResponse(BaseModel):
     claims: List[ClaimInDB]
     total: int
 
+class ClaimSummariesResponse(BaseModel):
+    claims: List[ClaimSummary]
+    total: int
+
 class FileResponse(BaseModel):
     file_id: str
     filename: str
     content_type: str
     uploaded_at: Optional[Any] = None
+    size: Optional[int] = None
+
+class ClaimFilesBatchRequest(BaseModel):
+    claim_ids: List[str]
+
+class ClaimFilesBatchResponse(BaseModel):
+    files: Dict[str, List[FileResponse]]
+
+MAX_BATCH_CLAIM_IDS = 500
 
 @router.post("", response_model=ClaimResponse)
 async def create_claim(claim: Claim = Body(...)):
@@ -147,27 +166,177 @@ async def upload_files(
         user_id: Optional ID of the user uploading the files
         
     Returns:
-        List of file IDs
+        IDs of the stored files, and a result per file (failures included)
     """
     # Check if the claim exists
-    claim = claim_service.get_claim_by_id(claim_id)
-    if not claim:
+    if not claim_service.claim_exists(claim_id):
         raise HTTPException(status_code=404, detail=f"Claim {claim_id} not found")
     
-    # Save files to GridFS with user_id if provided
-    file_ids = await FileStorage.save_files(files, claim_id, user_id)
+    # Store the files in parallel; one failing doesn't fail the rest
+    results = await FileStorage.save_files(files, claim_id, user_id)
+    file_ids = [result["file_id"] for result in results if result["success"]]
+    if not file_ids:
+        raise HTTPException(status_code=500, detail={"message": "No files could be stored", "files": results})
     
-    # Update the claim with the file IDs
-    claim_dict = claim.model_dump()
-    if 'service' in claim_dict and 'uploadedFiles' in claim_dict['service']:
-        claim_dict['service']['uploadedFiles'].extend(file_ids)
-    else:
-        claim_dict['service']['uploadedFiles'] = file_ids
+    await _attach_files(claim_id, file_ids)
+    
+    return {"file_ids": file_ids, "files": results}
+
+TUS_VERSION = "1.0.0"
+
+def _parse_upload_metadata(header: Optional[str]) -> Dict[str, str]:
+    """Decode a tus Upload-Metadata header: comma-separated "key base64value" pairs"""
+    metadata = {}
+    for pair in (header or "").split(","):
+        parts = pair.strip().split(" ", 1)
+        if not parts[0]:
+            continue
+        try:
+            metadata[parts[0]] = base64.b64decode(parts[1]).decode("utf-8") if len(parts) > 1 else ""
+        except Exception:
+            raise HTTPException(status_code=400, detail=f"Invalid Upload-Metadata value for {parts[0]}")
+    return metadata
+
+@router.post("/{claim_id}/uploads", status_code=201)
+async def create_upload(
+    claim_id: str,
+    upload_length: int = Header(..., alias="Upload-Length"),
+    upload_metadata: Optional[str] = Header(None, alias="Upload-Metadata")
+):
+    """
+    Start a resumable upload of one file for a claim (tus creation)
+    
+    Args:
+        claim_id: The ID of the claim
+        upload_length: The file's total size in bytes
+        upload_metadata: tus metadata; filename, content_type, user_id and sha256 are used
+        
+    Returns:
+        The upload session, with its URL in the Location header
+    """
+    if not claim_service.claim_exists(claim_id):
+        raise HTTPException(status_code=404, detail=f"Claim {claim_id} not found")
+    metadata = _parse_upload_metadata(upload_metadata)
+    try:
+        session = await run_in_threadpool(
+            UploadSessions.create,
+            claim_id,
+            upload_length,
+            filename=metadata.get("filename"),
+            content_type=metadata.get("content_type") or metadata.get("filetype"),
+            user_id=metadata.get("user_id"),
+            sha256=metadata.get("sha256"),
+        )
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    
+    return JSONResponse(
+        status_code=201,
+        content={**session, "expires_at": session["expires_at"].isoformat()},
+        headers={
+            "Location": f"{router.prefix}/uploads/{session['upload_id']}",
+            "Upload-Offset": "0",
+            "Tus-Resumable": TUS_VERSION,
+        },
+    )
+
+@router.head("/uploads/{upload_id}")
+async def get_upload_offset(upload_id: str):
+    """
+    How much of a resumable upload the server has (tus HEAD); resume from Upload-Offset
+    
+    Args:
+        upload_id: The ID of the upload session
+    """
+    session = await run_in_threadpool(UploadSessions.get, upload_id)
+    if not session:
+        raise HTTPException(status_code=404, detail=f"Upload {upload_id} not found")
+    
+    return Response(headers={
+        "Upload-Offset": str(session["offset"]),
+        "Upload-Length": str(session["length"]),
+        "Tus-Resumable": TUS_VERSION,
+        "Cache-Control": "no-store",
+    })
+
+@router.patch("/uploads/{upload_id}", status_code=204)
+async def append_upload(
+    upload_id: str,
+    request: Request,
+    upload_offset: int = Header(..., alias="Upload-Offset"),
+    content_type: Optional[str] = Header(None)
+):
+    """
+    Send the next byte range of a resumable upload (tus PATCH)
+    
+    Args:
+        upload_id: The ID of the upload session
+        upload_offset: Where the request body starts; must match the session's offset
+        
+    Returns:
+        The new offset in the Upload-Offset header
+    """
+    if content_type != "application/offset+octet-stream":
+        raise HTTPException(status_code=415, detail="Content-Type must be application/offset+octet-stream")
+    try:
+        offset = await UploadSessions.append(upload_id, upload_offset, request.stream())
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
     
-    # Update the claim in the database
-    updated_claim = claim_service.update_claim(claim_id, Claim(**claim_dict))
+    return Response(status_code=204, headers={"Upload-Offset": str(offset), "Tus-Resumable": TUS_VERSION})
+
+@router.post("/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str, sha256: Optional[str] = Body(None, embed=True)):
+    """
+    Finalize a fully sent resumable upload: verify its checksum, store it and attach it to the claim
     
-    return {"file_ids": file_ids}
+    Args:
+        upload_id: The ID of the upload session
+        sha256: Hex SHA-256 of the whole file (optional if given in Upload-Metadata at creation)
+        
+    Returns:
+        The stored file's details
+    """
+    try:
+        file_info = await UploadSessions.complete(upload_id, sha256)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    
+    await _attach_files(file_info["claim_id"], [file_info["file_id"]])
+    
+    return file_info
+
+@router.delete("/uploads/{upload_id}", status_code=204)
+async def abort_upload(upload_id: str):
+    """
+    Abandon a resumable upload and discard what was sent (tus termination)
+    
+    Args:
+        upload_id: The ID of the upload session
+    """
+    if not await run_in_threadpool(UploadSessions.abort, upload_id):
+        raise HTTPException(status_code=404, detail=f"Upload {upload_id} not found")
+    
+    return Response(status_code=204, headers={"Tus-Resumable": TUS_VERSION})
+
+@router.post("/files/batch", response_model=ClaimFilesBatchResponse)
+async def get_files_for_claims(request: ClaimFilesBatchRequest = Body(...)):
+    """
+    Get the files of many claims in one call (e.g. a dashboard page), grouped by claim ID
+    
+    Claims aren't loaded: an unknown claim ID simply has no files.
+    
+    Args:
+        request: The claim IDs
+        
+    Returns:
+        File details per claim ID
+    """
+    if len(request.claim_ids) > MAX_BATCH_CLAIM_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_CLAIM_IDS} claim IDs per request")
+    
+    files = await FileStorage.get_files_for_claims(request.claim_ids)
+    return {"files": files}
 
 @router.get("/{claim_id}/files", response_model=List[FileResponse])
 async def get_claim_files(claim_id: str):
@@ -190,6 +359,41 @@ async def get_claim_files(claim_id: str):
     
     return files
 
+@router.get("/{claim_id}/files/archive")
+async def download_claim_files_archive(
+    claim_id: str,
+    compression: str = Query("auto", pattern="^(auto|store)$", description="'store' skips deflate so Content-Length is set")
+):
+    """
+    Download all files attached to a claim as one ZIP, built while streaming
+    
+    Args:
+        claim_id: The ID of the claim
+        compression: 'auto' deflates compressible types (text, PDF...) and stores the rest;
+            'store' stores everything
+        
+    Returns:
+        The ZIP archive
+    """
+    if not claim_service.claim_exists(claim_id):
+        raise HTTPException(status_code=404, detail=f"Claim {claim_id} not found")
+    files = await FileStorage.get_files_for_claim(claim_id)
+    if not files:
+        raise HTTPException(status_code=404, detail=f"Claim {claim_id} has no files")
+    
+    entries = FileStorage.archive_entries(files, compress=compression == "auto")
+    try:
+        check_limits(entries)
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    
+    headers = _attachment(f"{claim_id}-files.zip")
+    size = archive_size(entries)
+    if size is not None:
+        headers["Content-Length"] = str(size)
+    # A sync generator: Starlette runs it in the threadpool, so blob reads don't block the loop
+    return StreamingResponse(stream_zip(entries), media_type="application/zip", headers=headers)
+
 @router.get("/user/{user_id}/files", response_model=List[FileResponse])
 async def get_user_files(user_id: str):
     """
@@ -216,22 +420,30 @@ async def get_file(file_id: str, download: bool = Query(False)):
     Returns:
         File details or the file itself for download
     """
-    file = await FileStorage.get_file(file_id)
-    if not file:
+    opened = await FileStorage.open_file(file_id)
+    if not opened:
         raise HTTPException(status_code=404, detail=f"File {file_id} not found")
+    file_info, open_content, local_path = opened
     
     if download:
-        # Return the file for download
-        content = base64.b64decode(file["content"])
+        disposition = _attachment(file_info["filename"] or file_id)
+        if local_path:
+            # Uncompressed blob on local disk: let the proxy sendfile it, or stream it from disk
+            headers = sendfile_headers(local_path)
+            if headers:
+                return Response(headers={**headers, **disposition}, media_type=file_info["content_type"])
+            return FileDownloadResponse(local_path, media_type=file_info["content_type"], headers=disposition)
         
+        # Stream the stored chunks rather than loading the whole file
+        chunks = await run_in_threadpool(open_content)
+        if chunks is None:
+            raise HTTPException(status_code=404, detail=f"Content of file {file_id} not found")
         return StreamingResponse(
-            iter([content]),
-            media_type=file["content_type"],
-            headers={"Content-Disposition": f"attachment; filename={file['filename']}"}
+            chunks,
+            media_type=file_info["content_type"],
+            headers=disposition
         )
     
-    # Remove the content to avoid sending large base64 data
-    file_info = {k: v for k, v in file.items() if k != "content"}
     return file_info
 
 @router.delete("/files/{file_id}")
@@ -251,11 +463,13 @@ async def delete_file(file_id: str):
     
     return {"detail": "File deleted successfully"}
 
-@router.get("", response_model=ClaimsResponse)
+@router.get("", response_model=ClaimsResponse, responses={200: {"model": ClaimSummariesResponse}})
 async def get_claims(
     status: Optional[str] = Query(None, description="Filter by claim status"),
     limit: int = Query(100, ge=1, le=1000),
-    offset: int = Query(0, ge=0)
+    offset: int = Query(0, ge=0),
+    view: str = Query("full", pattern="^(full|summary)$", description="'summary' returns flat list rows"),
+    fields: Optional[str] = Query(None, description="Comma-separated claim fields to return, e.g. claimId,status,patient.patientName")
 ):
     """Get claims with optional filtering"""
     # Convert status string to enum if provided
@@ -266,7 +480,17 @@ async def get_claims(
         except ValueError:
             raise HTTPException(status_code=400, detail=f"Invalid status: {status}")
     
-    claims = claim_service.get_claims(status=status_enum, limit=limit, offset=offset)
+    if fields:
+        try:
+            projection = claim_projection(fields.split(","))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    elif view == "summary":
+        projection = SUMMARY_PROJECTION
+    else:
+        projection = None
+    
+    claims = claim_service.get_claims_raw(status=status_enum, limit=limit, offset=offset, projection=projection)
     
     # Count total for pagination
     # In a production app, you might want to optimize this count query
@@ -275,15 +499,46 @@ async def get_claims(
     else:
         total = claim_service.collection.count_documents({})
     
-    return {"claims": claims, "total": total}
+    if projection is SUMMARY_PROJECTION:
+        # Only the projected fields are validated and serialized
+        summaries = ClaimSummariesResponse.model_validate({"claims": claims, "total": total})
+        return Response(content=summaries.model_dump_json(), media_type="application/json")
+    
+    if fields:
+        # Partial claims don't validate as ClaimInDB; the projection only reads model fields,
+        # and anything stored as a BSON type JSON lacks (ObjectId, Decimal128) is stringified
+        content = orjson.dumps({"claims": claims, "total": total}, default=str)
+        return Response(content=content, media_type="application/json")
+    
+    # One validation and dump of the whole response, rather than each claim through ClaimInDB
+    # and again through ClaimsResponse. Not every writer validated the stored claims.
+    response = ClaimsResponse.model_validate({"claims": claims, "total": total})
+    return Response(content=response.model_dump_json(), media_type="application/json")
 
 @router.get("/{claim_id}", response_model=ClaimResponse)
 async def get_claim(claim_id: str):
     """Get a claim by ID"""
-    claim = claim_service.get_claim_by_id(claim_id)
+    claim = claim_service.get_claim_raw(claim_id)
     if not claim:
         raise HTTPException(status_code=404, detail=f"Claim {claim_id} not found")
-    return {"claim": claim}
+    response = ClaimResponse.model_validate({"claim": claim})
+    return Response(content=response.model_dump_json(), media_type="application/json")
+
+@router.get("/{claim_id}/dossier")
+async def get_claim_dossier(claim_id: str):
+    """
+    Get a claim with the metadata of all its files in one database round trip (claim detail view)
+    
+    Args:
+        claim_id: The claim's claimId or MongoDB ObjectId
+        
+    Returns:
+        The claim and its files
+    """
+    dossier = claim_service.get_dossier(claim_id)
+    if not dossier:
+        raise HTTPException(status_code=404, detail=f"Claim {claim_id} not found")
+    return ORJSONResponse(dossier)
 
 @router.put("/{claim_id}", response_model=ClaimResponse)
 async def update_claim(claim_id: str, updated_claim: Claim = Body(...)):
@@ -323,17 +578,10 @@ async def get_files_by_object_id(object_id: str):
     Returns:
         List of file details
     """
-    # First check if there's a claim with this ObjectId
-    try:
-        obj_id = ObjectId(object_id)
-        claim = claim_service.get_claim_by_object_id(obj_id)
-        
-        if claim:
-            # If claim exists, get files by claim ID
-            files = await FileStorage.get_files_for_claim(claim.claimId)
-            return files
-    except Exception as e:
-        print(f"Error checking claim by ObjectId: {str(e)}")
+    # First check if there's a claim with this ID (one cached lookup)
+    resolved = claim_service.resolver.resolve(object_id)
+    if resolved and resolved.claim_id:
+        return await FileStorage.get_files_for_claim(resolved.claim_id)
     
     # If no claim found or error occurred, try to get files directly by ObjectId metadata
     files = await FileStorage.get_files_by_object_id(object_id)
@@ -0,0 +1,222 @@
+"""
+Token-budgeted context assembly for the RAG prompts.
+
+Precedent metadata is stored with a ``rationale`` field that is a JSON dump of
+the whole source record, so ``json.dumps(metadata)`` sends most fields twice.
+``ContextBuilder`` renders each precedent once as compact ``key: value``
+lines, drops duplicate and near-duplicate precedents, trims every section to
+its token budget, and reports how many tokens each prompt section used
+(recorded as a ``prompt.context`` span on the request's trace).
+
+Tokens are counted with tiktoken when it is installed, otherwise with a
+word/punctuation approximation.
+"""
+
+import json
+import os
+import re
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+from tracing import record_span
+
+CONTEXT_PRECEDENT_TOKENS = int(os.getenv("CONTEXT_PRECEDENT_TOKENS", "1500"))
+CONTEXT_LEGAL_TOKENS = int(os.getenv("CONTEXT_LEGAL_TOKENS", "1500"))
+CONTEXT_GUIDANCE_TOKENS = int(os.getenv("CONTEXT_GUIDANCE_TOKENS", "2000"))
+
+# Per-precedent cap so one long rationale cannot take a whole section
+CONTEXT_ITEM_TOKENS = int(os.getenv("CONTEXT_ITEM_TOKENS", "600"))
+
+# Precedents whose text shingles overlap at least this much are treated as duplicates
+NEAR_DUPLICATE_JACCARD = 0.9
+
+_WORD_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:  # tiktoken missing or its encoding files unavailable offline
+    _encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Number of tokens in ``text`` (approximate without tiktoken)"""
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(_WORD_PATTERN.findall(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut ``text`` to at most ``max_tokens`` tokens, preferring a paragraph or line boundary"""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+
+    if _encoding is not None:
+        cut = _encoding.decode(_encoding.encode(text, disallowed_special=())[:max_tokens])
+    else:
+        matches = list(_WORD_PATTERN.finditer(text))
+        cut = text[:matches[max_tokens - 1].end()] if matches else ""
+
+    boundary = max(cut.rfind("\n\n"), cut.rfind("\n"))
+    if boundary > len(cut) // 2:
+        cut = cut[:boundary]
+    return cut.rstrip() + " ..."
+
+
+def _shingles(text: str, size: int = 5) -> set:
+    words = re.findall(r"\w+", text.lower())
+    return {" ".join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+
+def _jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _normalize_key(key: str) -> str:
+    return re.sub(r"[^a-z0-9]", "", key.lower())
+
+
+def render_precedent(metadata: Dict[str, Any]) -> str:
+    """
+    Compact text form of one precedent's metadata
+
+    The JSON ``rationale`` is unpacked and any field already present at the
+    top level (decision, condition, treatment, ...) is not repeated.
+    """
+    lines = []
+    seen_keys = set()
+    for key, value in metadata.items():
+        if key == "rationale" or value in (None, ""):
+            continue
+        lines.append(f"{key}: {value}")
+        seen_keys.add(_normalize_key(key))
+
+    rationale = metadata.get("rationale")
+    if rationale:
+        try:
+            record = json.loads(rationale)
+        except (TypeError, ValueError):
+            record = None
+        if isinstance(record, dict):
+            for key, value in record.items():
+                normalized = _normalize_key(key)
+                # "Decision Date" is stored as epoch millis; decision_date already covers it
+                if normalized in seen_keys or normalized == "decisiondate" or value in (None, ""):
+                    continue
+                lines.append(f"{key}: {value}")
+        else:
+            lines.append(f"rationale: {rationale}")
+    return "\n".join(lines)
+
+
+class PromptReport:
+    """Token usage of one assembled prompt, per section"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.sections: Dict[str, Dict[str, int]] = {}
+
+    def add(self, section: str, tokens: int, items: int = 0, dropped: int = 0, truncated: int = 0) -> None:
+        self.sections[section] = {"tokens": tokens, "items": items, "dropped": dropped, "truncated": truncated}
+
+    @property
+    def total_tokens(self) -> int:
+        return sum(section["tokens"] for section in self.sections.values())
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"prompt": self.name, "total_tokens": self.total_tokens, "sections": self.sections}
+
+    def span_attributes(self) -> Dict[str, Any]:
+        """Flat span attributes: the prompt's total (``tokens.prompt``) and each section's usage"""
+        attributes: Dict[str, Any] = {"prompt.name": self.name, "tokens.prompt": self.total_tokens}
+        for name, section in self.sections.items():
+            for key, value in section.items():
+                if key == "tokens" or value:
+                    attributes[f"prompt.{name}.{key}"] = value
+        return attributes
+
+    def record(self) -> None:
+        """Attach this report to the current trace as a ``prompt.context`` span"""
+        record_span("prompt.context", 0.0, **self.span_attributes())
+
+    def __str__(self) -> str:
+        parts = ", ".join(f"{name}={section['tokens']}" for name, section in self.sections.items())
+        return f"[{self.name}] prompt tokens: {self.total_tokens} ({parts})"
+
+
+class ContextBuilder:
+    """Assembles prompt sections within token budgets and records their size"""
+
+    def __init__(self, name: str):
+        self.report = PromptReport(name)
+
+    def precedents(self, section: str, matches: Sequence[Dict[str, Any]],
+                   budget_tokens: int = CONTEXT_PRECEDENT_TOKENS,
+                   item_tokens: int = CONTEXT_ITEM_TOKENS) -> str:
+        """
+        Render retrieved precedents, best first, within a token budget
+
+        Args:
+            section: Section name used in the report
+            matches: Pinecone-style matches (``id`` and ``metadata``), ranked
+            budget_tokens: Token budget for the whole section
+            item_tokens: Token cap for any single precedent
+
+        Returns:
+            The section text
+        """
+        blocks: List[str] = []
+        seen_ids = set()
+        seen_shingles: List[set] = []
+        used = dropped = truncated = 0
+
+        for match in matches:
+            match_id = match.get("id")
+            if match_id is not None and match_id in seen_ids:
+                dropped += 1
+                continue
+            text = render_precedent(match.get("metadata") or {})
+            shingles = _shingles(text)
+            if any(_jaccard(shingles, other) >= NEAR_DUPLICATE_JACCARD for other in seen_shingles):
+                dropped += 1
+                continue
+
+            remaining = budget_tokens - used
+            if remaining <= 0:
+                dropped += 1
+                continue
+            limit = min(item_tokens, remaining)
+            if count_tokens(text) > limit:
+                text = truncate_to_tokens(text, limit)
+                truncated += 1
+
+            seen_ids.add(match_id)
+            seen_shingles.append(shingles)
+            blocks.append(text)
+            used += count_tokens(text)
+
+        self.report.add(section, used, items=len(blocks), dropped=dropped, truncated=truncated)
+        return "\n\n".join(f"[{i + 1}]\n{block}" for i, block in enumerate(blocks))
+
+    def text(self, section: str, text: str, budget_tokens: Optional[int] = None) -> str:
+        """Add free text (claim details, prior guidance), trimmed to a budget if given"""
+        truncated = 0
+        if budget_tokens is not None and count_tokens(text) > budget_tokens:
+            text = truncate_to_tokens(text, budget_tokens)
+            truncated = 1
+        self.report.add(section, count_tokens(text), items=1, truncated=truncated)
+        return text
+
+    def messages(self, messages: Iterable[Dict[str, str]]) -> List[Dict[str, str]]:
+        """Count any message content not already added as a section"""
+        messages = list(messages)
+        counted = sum(tokens["tokens"] for name, tokens in self.report.sections.items() if name != "other")
+        total = sum(count_tokens(message.get("content") or "") for message in messages)
+        if total > counted:
+            self.report.add("other", total - counted)
+        return messages
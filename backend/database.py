@@ -4,17 +4,20 @@ from pymongo import MongoClient
 from pymongo.collection import Collection
 from pymongo.database import Database
 
+from tracing import mongo_tracer
+
 # Load environment variables
 load_dotenv()
 
 # Get MongoDB connection string from environment variables
 MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
+DB_NAME = os.getenv("DB_NAME", "claims-management")
 
-# Create MongoDB client
-client = MongoClient(MONGODB_URI)
+# Create MongoDB client; every command is recorded as a trace span
+client = MongoClient(MONGODB_URI, event_listeners=[mongo_tracer])
 
 # Connect to database
-db: Database = client.get_database("claims-management")
+db: Database = client.get_database(DB_NAME)
 
 # Define collections
 claims_collection: Collection = db.get_collection("claims")
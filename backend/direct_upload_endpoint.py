@@ -11,6 +11,10 @@ from pymongo import MongoClient
 from pymongo.collection import Collection
 from bson import ObjectId
 
+from claim_resolver import claim_resolver
+from file_storage import FileStorage
+from tracing import mongo_tracer
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -30,7 +34,7 @@ app.add_middleware(
 )
 
 # Database connection
-client = MongoClient(MONGODB_URI)
+client = MongoClient(MONGODB_URI, event_listeners=[mongo_tracer])
 db = client[DB_NAME]
 
 @app.post("/direct-upload")
@@ -44,113 +48,58 @@ async def direct_upload(
     """
     print(f"Received upload request for claim: {claim_id}, user: {user_id}, files: {len(files)}")
     
-    # Check if claim exists when claim_id is provided
+    # Check if claim exists when claim_id is provided (claimId or _id, one cached lookup)
+    resolved = None
     if claim_id:
         try:
-            # Try with ObjectId first
-            try:
-                claim = db.claims.find_one({"_id": ObjectId(claim_id)})
-            except:
-                claim = db.claims.find_one({"_id": claim_id})
-                
-            if not claim:
-                claim = db.claims.find_one({"claimId": claim_id})
-                
-            if not claim:
-                return {"error": f"Claim {claim_id} not found"}
+            resolved = claim_resolver.resolve(claim_id)
         except Exception as e:
             print(f"Error checking claim: {str(e)}")
             return {"error": f"Error checking claim: {str(e)}"}
+        if not resolved:
+            return {"error": f"Claim {claim_id} not found"}
+        # Files are recorded against the canonical claimId, so claim file listings find them
+        claim_id = resolved.claim_id or claim_id
     
     # Process files
     file_ids = []
     file_details = []
     
     try:
-        fs = db.fs
-        
-        for file in files:
-            # Read file content
-            content = await file.read()
-            
-            # Create file metadata
-            filename = file.filename
-            content_type = file.content_type or "application/octet-stream"
-            
-            metadata = {
-                "filename": filename,
-                "content_type": content_type,
-                "uploaded_at": datetime.now(),
-            }
-            
-            if claim_id:
-                metadata["claim_id"] = claim_id
-            
-            if user_id:
-                metadata["user_id"] = user_id
-            
-            # Insert file into GridFS
-            file_id = fs.files.insert_one({
-                "filename": filename,
-                "chunkSize": 261120,
-                "uploadDate": datetime.now(),
-                "metadata": metadata
-            }).inserted_id
-            
-            # Split content into chunks
-            chunk_size = 261120  # Default GridFS chunk size
-            chunks = [content[i:i+chunk_size] for i in range(0, len(content), chunk_size)]
-            
-            # Insert chunks
-            for i, chunk in enumerate(chunks):
-                fs.chunks.insert_one({
-                    "files_id": file_id,
-                    "n": i,
-                    "data": chunk
-                })
-            
-            # Reset file pointer
-            await file.seek(0)
-            
-            # Add file ID to list
-            file_id_str = str(file_id)
-            file_ids.append(file_id_str)
+        # Identical content is stored once; repeat uploads only add a reference. Files are
+        # stored in parallel and a failed one doesn't fail the others.
+        results = await FileStorage.save_files(files, claim_id, user_id)
+        failed = []
+        for saved in results:
+            if not saved["success"]:
+                failed.append({"filename": saved["filename"], "error": saved["error"]})
+                continue
+            file_ids.append(saved["file_id"])
             
             # Add file details
             file_details.append({
-                "file_id": file_id_str,
-                "filename": filename,
-                "content_type": content_type,
-                "size": len(content)
+                "file_id": saved["file_id"],
+                "filename": saved["filename"],
+                "content_type": saved["content_type"],
+                "size": saved["size"],
+                "deduplicated": saved["deduplicated"]
             })
             
-            print(f"Uploaded file {filename} with ID {file_id_str}")
+            print(f"Uploaded file {saved['filename']} with ID {saved['file_id']}")
         
         # Update claim record with file IDs if a claim ID was provided
-        if claim_id and file_ids:
+        if resolved and file_ids:
             try:
-                # Determine the correct _id format
-                claim_query = None
-                try:
-                    obj_id = ObjectId(claim_id)
-                    claim_query = {"_id": obj_id}
-                except:
-                    claim_query = {"_id": claim_id}
-                
-                # Try to update the claim
                 update_result = db.claims.update_one(
-                    claim_query,
+                    resolved.query,
                     {"$push": {"service.uploadedFiles": {"$each": file_ids}}}
                 )
-                
-                if update_result.modified_count == 0:
-                    # Try with claimId field as fallback
-                    update_result = db.claims.update_one(
-                        {"claimId": claim_id},
-                        {"$push": {"service.uploadedFiles": {"$each": file_ids}}}
-                    )
-                
-                print(f"Updated claim {claim_id} with {len(file_ids)} files")
+                if update_result.matched_count == 0:
+                    # Deleted since it was resolved
+                    claim_resolver.forget(claim_id)
+                    print(f"Claim {claim_id} no longer exists; files were stored but not attached")
+                else:
+                    print(f"Updated claim {claim_id} with {len(file_ids)} files")
             except Exception as e:
                 print(f"Error updating claim: {str(e)}")
         
@@ -158,6 +107,7 @@ async def direct_upload(
             "success": True,
             "file_ids": file_ids,
             "files": file_details,
+            "failed": failed,
             "message": f"Successfully uploaded {len(file_ids)} files"
         }
         
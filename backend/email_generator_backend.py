@@ -23,7 +23,9 @@ import uvicorn
 from pinecone import Pinecone, ServerlessSpec
 from langchain_pinecone import PineconeVectorStore
 from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
+
+from llm_client import get_llm_client
+from precedent_retrieval import filters_for_claim, search_with_widening
 
 
 load_dotenv()
@@ -86,8 +88,7 @@ Guidelines
 Draft e‑mail:
 """.strip()
 )
-llm   = ChatOpenAI(model_name="gpt-4o-mini", temperature=0.3, api_key=OPENAI_API_KEY)
-chain = LLMChain(llm=llm, prompt=prompt)
+llm = get_llm_client("openai")
 
 
 app = FastAPI(title="Claim‑Appeal Email Generator")
@@ -95,14 +96,25 @@ app = FastAPI(title="Claim‑Appeal Email Generator")
 class ClaimDocument(BaseModel):
     """Request schema."""
     content: str
+    condition: Optional[str] = None
+    health_insurance_provider: Optional[str] = None
 
 def _clean(text: str) -> str:
     """Very light cleaning before embedding search."""
     return " ".join(text.split())
 
-def _best_precedent(query_text: str) -> Optional[dict]:
-    """Return metadata of the most‑similar precedent (or None)."""
-    results = vectorstore.similarity_search_with_score(query_text, k=1)
+def _best_precedent(query_text: str, claim: Optional[ClaimDocument] = None) -> Optional[dict]:
+    """Return metadata of the most‑similar precedent (or None).
+
+    When the claim carries a condition / insurer the search is filtered to
+    matching precedents first, widening if nothing matches.
+    """
+    results = search_with_widening(
+        lambda flt, k: vectorstore.similarity_search_with_score(query_text, k=k, filter=flt),
+        filters_for_claim(claim),
+        top_k=1,
+        key=lambda result: result[0].page_content,
+    )
     if not results:
         return None
     doc, _score = results[0]
@@ -112,12 +124,16 @@ def _best_precedent(query_text: str) -> Optional[dict]:
 @app.post("/draft_email")
 def draft_email(doc: ClaimDocument):
     """Generate an appeal e‑mail based on the user’s claim document."""
-    precedent = _best_precedent(_clean(doc.content))
+    precedent = _best_precedent(_clean(doc.content), doc)
     if precedent is None:
         raise HTTPException(404, "No similar precedent found in Pinecone.")
 
     try:
-        email_text = chain.run(precedent)
+        email_text = llm.complete(
+            messages=[{"role": "user", "content": prompt.format(**precedent)}],
+            model="gpt-4o-mini",
+            temperature=0.3,
+        )
     except Exception as exc:
         raise HTTPException(500, str(exc)) from exc
 
@@ -0,0 +1,75 @@
+import os
+from typing import List
+
+import requests
+from dotenv import load_dotenv
+
+from rate_limiter import estimate_tokens, get_scheduler
+from tracing import span
+
+# Load environment variables
+load_dotenv()
+JINA_API_KEY = os.getenv("JINA_API_KEY")
+JINA_URL = os.getenv("JINA_URL", "https://api.jina.ai/v1/embeddings")
+JINA_MODEL = "jina-clip-v2"
+
+HEADERS = {
+    "Content-Type": "application/json",
+    "Authorization": f"Bearer {JINA_API_KEY}"
+}
+
+
+def get_embeddings(texts: List[str]) -> List[List[float]]:
+    """
+    Embed a batch of texts with a single Jina AI request
+
+    Args:
+        texts: The texts to embed
+
+    Returns:
+        One embedding per input text, in input order
+    """
+    payload = {
+        "model": JINA_MODEL,
+        "input": texts,
+        "normalized": False
+    }
+
+    def _post():
+        resp = requests.post(JINA_URL, headers=HEADERS, json=payload)
+        if resp.status_code == 429:
+            resp.raise_for_status()
+        return resp, resp.json()
+
+    with span("jina.embeddings", **{"jina.model": JINA_MODEL, "jina.texts": len(texts)}) as s:
+        resp, json_resp = get_scheduler("jina").call(
+            _post,
+            tokens=estimate_tokens(texts),
+            usage=lambda result: (result[1].get("usage") or {}).get("total_tokens"),
+        )
+        usage = json_resp.get("usage") or {}
+        s.set("http.status_code", resp.status_code)
+        s.set("payload.request_bytes", len(resp.request.body or b""))
+        s.set("payload.response_bytes", len(resp.content))
+        s.set("tokens.total", usage.get("total_tokens"))
+
+    if "data" not in json_resp:
+        print(f"Error: Jina response missing 'data' key (status {resp.status_code})")
+        if "error" in json_resp or "detail" in json_resp:
+            print(f"API Error: {json_resp.get('error') or json_resp.get('detail')}")
+        raise KeyError(f"Response missing 'data' key. Full response: {json_resp}")
+
+    if not json_resp["data"]:
+        raise ValueError("Response data is empty")
+
+    if "embedding" not in json_resp["data"][0]:
+        raise KeyError(f"Response missing 'embedding' key. Data keys: {list(json_resp['data'][0])}")
+
+    # Jina returns an index per item; don't rely on the response order
+    data = sorted(json_resp["data"], key=lambda item: item.get("index", 0))
+    return [item["embedding"] for item in data]
+
+
+def get_embedding(text: str) -> List[float]:
+    """Embed a single text with Jina AI"""
+    return get_embeddings([text])[0]
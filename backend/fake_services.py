@@ -0,0 +1,252 @@
+"""
+Local stand-ins for the external services, for load tests and offline runs.
+
+* ``FakeJinaHandler``: ``POST /v1/embeddings`` in the Jina format, returning a
+  deterministic unit vector per input text (seeded by its hash).
+* ``FakeChatHandler``: ``POST /chat/completions`` in the OpenAI format (also
+  streamed), answering JSON-mode / "return JSON" prompts with an object that
+  satisfies both ``HealthClaim`` and ``AppealGuidance`` and everything else
+  with guidance-style text.
+* ``synthetic_corpus``: a precedent corpus with realistic metadata for the
+  in-memory vector index (``VECTOR_BACKEND=memory``).
+
+Both servers add configurable latency (mean + uniform jitter) and can answer
+a fraction of requests with 429 to exercise the rate limiter.
+
+Usage:
+    python fake_services.py --jina-port 8601 --chat-port 8602 --chat-latency-ms 800
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+from precedent_search import PrecedentCorpus
+
+EMBEDDING_DIMENSION = 1024
+
+CONDITIONS = ["Mental Health", "Substance Abuse/ Addiction"]
+TREATMENTS = ["Residential Treatment Center", "Inpatient Hospital", "Intensive Outpatient Program",
+              "Psychotherapy", "Medication Management", "Partial Hospitalization"]
+COVERAGE_TYPES = ["Medicaid", "Medicare", "Essential Plan", "Child Health Plus", "Commercial"]
+INSURERS = ["Aetna", "Anthem Blue Cross", "UnitedHealthcare", "Cigna", "Medicaid Managed Care"]
+
+
+def deterministic_vector(text: str, dimension: int = EMBEDDING_DIMENSION) -> np.ndarray:
+    """Unit vector derived from the text's hash: the same text always embeds the same way"""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimension).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def synthetic_corpus(size: int = 2000, dimension: int = EMBEDDING_DIMENSION, seed: int = 0) -> PrecedentCorpus:
+    """Precedent corpus with the metadata fields pinecone-db.py writes"""
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    ids, rows, metadata = [], [], []
+    for i in range(size):
+        decided = now - timedelta(days=rng.randint(0, 15 * 365))
+        record = {
+            "Decision": rng.choice(["Overturned", "Upheld"]),
+            "Condition": rng.choice(CONDITIONS),
+            "Treatment": rng.choice(TREATMENTS),
+            "Coverage Type": rng.choice(COVERAGE_TYPES),
+            "Findings": " ".join(rng.choice(["medical", "necessity", "reviewer", "found", "criteria",
+                                             "patient", "symptoms", "level", "care", "appropriate"])
+                                 for _ in range(rng.randint(40, 160))),
+        }
+        text = json.dumps(record)
+        ids.append(f"precedent-{i}")
+        rows.append(deterministic_vector(text, dimension))
+        metadata.append({
+            "decision": record["Decision"],
+            "decision_date": decided.isoformat().replace("+00:00", "Z"),
+            "decision_ts": int(decided.timestamp()),
+            "condition": record["Condition"],
+            "treatment": record["Treatment"],
+            "coverage_type": record["Coverage Type"],
+            "rationale": text,
+        })
+    return PrecedentCorpus(ids, np.vstack(rows), metadata)
+
+
+# Satisfies HealthClaim and AppealGuidance (and the generate_structured_data prompt)
+STRUCTURED_RESPONSE = {
+    "condition": "Mental Health",
+    "date": "2024-03-01",
+    "health_insurance_provider": "Aetna",
+    "requested_treatment": "Residential Treatment Center",
+    "explanation": "Patient requires residential treatment after failed outpatient care.",
+    "coverage_type": "Commercial",
+    "rationale": "Symptoms persisted despite two levels of outpatient care.",
+    "guidelines": ["Guideline 1: Document failed lower levels of care",
+                   "Guideline 2: Cite the plan's medical necessity criteria"],
+    "reasoning": "Guideline 1: Document failed lower levels of care\nGuideline 2: Cite the criteria",
+    "summary": "The denial can be appealed on medical necessity grounds.",
+    "appeal": "Dear Appeals Department,\n\nI am writing to appeal the denial of residential treatment...",
+}
+
+GUIDANCE_TEXT = (
+    "Guideline 1: Demonstrate medical necessity with treatment history.\n"
+    "Guideline 2: Reference comparable overturned decisions.\n"
+    "Guideline 3: Include provider letters of support.\n"
+) * 4
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    """Shared behaviour: latency injection, 429s, JSON bodies, quiet logging"""
+
+    latency_ms = 0.0
+    jitter_ms = 0.0
+    error_rate = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _delay(self) -> None:
+        delay_ms = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+
+    def _throttled(self) -> bool:
+        if self.error_rate and random.random() < self.error_rate:
+            self._send_json(429, {"error": {"message": "Rate limit exceeded", "type": "rate_limit"}},
+                            {"Retry-After": "0.2"})
+            return True
+        return False
+
+    def _send_json(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class FakeJinaHandler(_FakeHandler):
+    def do_POST(self):
+        request = self._read_json()
+        if self._throttled():
+            return
+        self._delay()
+        texts = request.get("input") or []
+        data = [
+            {"object": "embedding", "index": i, "embedding": deterministic_vector(str(text)).tolist()}
+            for i, text in enumerate(texts)
+        ]
+        tokens = sum(len(str(text)) for text in texts) // 4
+        self._send_json(200, {
+            "model": request.get("model"),
+            "object": "list",
+            "usage": {"total_tokens": tokens, "prompt_tokens": tokens},
+            "data": data,
+        })
+
+
+class FakeChatHandler(_FakeHandler):
+    def _content_for(self, request: Dict[str, Any]) -> str:
+        messages = request.get("messages") or []
+        prompt = " ".join(str(message.get("content") or "") for message in messages)
+        wants_json = (request.get("response_format") or {}).get("type") == "json_object" or "JSON" in prompt
+        return json.dumps(STRUCTURED_RESPONSE) if wants_json else GUIDANCE_TEXT
+
+    def do_POST(self):
+        request = self._read_json()
+        if self._throttled():
+            return
+        self._delay()
+        content = self._content_for(request)
+        prompt_tokens = sum(len(str(message.get("content") or "")) for message in request.get("messages") or []) // 4
+        completion_tokens = len(content) // 4
+        created = int(time.time())
+
+        if request.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for start in range(0, len(content), 64):
+                chunk = {
+                    "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created,
+                    "model": request.get("model"),
+                    "choices": [{"index": 0, "delta": {"content": content[start:start + 64]}, "finish_reason": None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.write(b"data: [DONE]\n\n")
+            return
+
+        self._send_json(200, {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": created,
+            "model": request.get("model"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+
+def start_fake_server(handler: type, port: int = 0, latency_ms: float = 0.0, jitter_ms: float = 0.0,
+                      error_rate: float = 0.0) -> Tuple[ThreadingHTTPServer, str]:
+    """
+    Serve a fake in a daemon thread
+
+    Args:
+        handler: ``FakeJinaHandler`` or ``FakeChatHandler``
+        port: Port to bind on localhost (0 picks a free one)
+        latency_ms: Mean added latency per request
+        jitter_ms: Uniform jitter around the mean
+        error_rate: Fraction of requests answered with 429
+
+    Returns:
+        (server, base URL)
+    """
+    configured = type(handler.__name__, (handler,), {
+        "latency_ms": latency_ms, "jitter_ms": jitter_ms, "error_rate": error_rate,
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", port), configured)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name=handler.__name__).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run fake Jina and OpenAI-compatible chat servers")
+    parser.add_argument("--jina-port", type=int, default=8601)
+    parser.add_argument("--chat-port", type=int, default=8602)
+    parser.add_argument("--embed-latency-ms", type=float, default=50)
+    parser.add_argument("--chat-latency-ms", type=float, default=800)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    args = parser.parse_args()
+
+    _, jina_url = start_fake_server(FakeJinaHandler, args.jina_port, args.embed_latency_ms, args.jitter_ms,
+                                    args.error_rate)
+    _, chat_url = start_fake_server(FakeChatHandler, args.chat_port, args.chat_latency_ms, args.jitter_ms,
+                                    args.error_rate)
+    print(f"JINA_URL={jina_url}/v1/embeddings")
+    print(f"DEEPSEEK_URL={chat_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
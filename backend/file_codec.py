@@ -0,0 +1,365 @@
+"""
+Compression codecs for stored claim files.
+
+Each chunk of a blob is compressed on its own with zstd (one frame per chunk),
+so downloads decompress while streaming, whatever the read boundaries of the
+blob store. The policy is per content type:
+formats that are already compressed (JPEG, PNG, ZIP...) are stored as-is, and
+everything else is compressed only if a sample of the first chunk shrinks by
+at least ``FILE_COMPRESSION_MIN_SAVINGS``. The codec (and zstd dictionary id)
+is recorded with the blob, so the level and dictionary can change without
+affecting files already stored.
+
+A dictionary trained on our own documents helps the small ones (faxed forms,
+JSON sidecars) most:
+
+    python file_codec.py train --from-db 500 --output claims.zdict
+    FILE_ZSTD_DICT_PATH=claims.zdict
+
+New blobs are compressed with the dictionary at ``FILE_ZSTD_DICT_PATH``, which
+is registered by its id in the ``zstd_dictionaries`` collection when first
+loaded. Blobs are decoded with the dictionary they were written with, looked
+up by id there, so the path can move to a newly trained dictionary at any
+time. A dictionary that was in use before registration existed is added with:
+
+    python file_codec.py register old-claims.zdict
+
+and the storage saved versus CPU spent per MB can be measured with:
+
+    python file_codec.py benchmark samples/*.pdf --levels 1 3 6 12 19
+
+Requires the ``zstandard`` package (``poetry install -E compression``);
+without it files are stored uncompressed.
+"""
+
+import argparse
+import glob
+import json
+import mimetypes
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FILE_COMPRESSION = os.getenv("FILE_COMPRESSION", "zstd")
+FILE_ZSTD_LEVEL = int(os.getenv("FILE_ZSTD_LEVEL", "6"))
+FILE_ZSTD_DICT_PATH = os.getenv("FILE_ZSTD_DICT_PATH")
+ZSTD_DICTIONARIES_COLLECTION = "zstd_dictionaries"
+FILE_COMPRESSION_MIN_SAVINGS = float(os.getenv("FILE_COMPRESSION_MIN_SAVINGS", "0.05"))
+# Archived (cold) files are written once and rarely read: spend more CPU for a smaller footprint
+FILE_ARCHIVE_ZSTD_LEVEL = int(os.getenv("FILE_ARCHIVE_ZSTD_LEVEL", "19"))
+
+IDENTITY = "identity"
+ZSTD = "zstd"
+
+# Already compressed: recompressing costs CPU for (almost) no savings
+INCOMPRESSIBLE_TYPES = {
+    "image/jpeg", "image/png", "image/gif", "image/webp", "image/heic",
+    "application/zip", "application/gzip", "application/x-gzip", "application/x-7z-compressed",
+    "application/x-rar-compressed", "application/x-bzip2", "application/zstd",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+INCOMPRESSIBLE_PREFIXES = ("video/", "audio/")
+
+
+class IdentityCodec:
+    name = IDENTITY
+
+    def params(self) -> Dict[str, Any]:
+        return {"codec": self.name}
+
+    def encode(self, data: bytes) -> bytes:
+        return data
+
+    def decode(self, data: bytes) -> bytes:
+        return data
+
+    def decode_stream(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        return iter(chunks)
+
+
+class ZstdCodec:
+    """zstd per chunk, optionally with a trained dictionary"""
+
+    name = ZSTD
+
+    def __init__(self, level: int = FILE_ZSTD_LEVEL, dictionary: Optional["zstandard.ZstdCompressionDict"] = None):
+        if zstandard is None:
+            raise RuntimeError("zstandard is not installed (poetry install -E compression)")
+        self.level = level
+        self.dictionary = dictionary
+
+    def params(self) -> Dict[str, Any]:
+        params = {"codec": self.name, "level": self.level}
+        if self.dictionary is not None:
+            params["dict_id"] = self.dictionary.dict_id()
+        return params
+
+    def encode(self, data: bytes) -> bytes:
+        # Compressor objects aren't thread-safe; one per chunk is cheap next to 255 KB of input
+        return zstandard.ZstdCompressor(level=self.level, dict_data=self.dictionary).compress(data)
+
+    def decode(self, data: bytes) -> bytes:
+        return zstandard.ZstdDecompressor(dict_data=self.dictionary).decompress(data)
+
+    def decode_stream(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Decode a stream of concatenated frames read at arbitrary boundaries (S3 or disk reads)"""
+        decompressor = zstandard.ZstdDecompressor(dict_data=self.dictionary)
+        state = decompressor.decompressobj()
+        for data in chunks:
+            while data:
+                output = state.decompress(data)
+                if output:
+                    yield output
+                if not state.eof:
+                    break
+                # Each stored chunk is its own frame: continue with the next one
+                data = state.unused_data
+                state = decompressor.decompressobj()
+
+
+_identity = IdentityCodec()
+_dictionary = None
+# Every dictionary loaded so far, by dict_id
+_dictionaries: Dict[int, "zstandard.ZstdCompressionDict"] = {}
+_dictionaries_lock = threading.Lock()
+
+
+def _read_dictionary_file(path: str) -> "zstandard.ZstdCompressionDict":
+    with open(path, "rb") as f:
+        return zstandard.ZstdCompressionDict(f.read())
+
+
+def register_dictionary(dictionary: "zstandard.ZstdCompressionDict") -> int:
+    """
+    Store a dictionary where every process can load it by id
+
+    Returns:
+        The dictionary's dict_id
+    """
+    from database import get_db
+
+    dict_id = dictionary.dict_id()
+    get_db()[ZSTD_DICTIONARIES_COLLECTION].update_one(
+        {"_id": dict_id},
+        {"$setOnInsert": {"data": dictionary.as_bytes(), "registered_at": datetime.utcnow()}},
+        upsert=True,
+    )
+    with _dictionaries_lock:
+        _dictionaries[dict_id] = dictionary
+    return dict_id
+
+
+def _load_dictionary() -> Optional["zstandard.ZstdCompressionDict"]:
+    """The dictionary new blobs are compressed with (registered, so readers can find it)"""
+    global _dictionary
+    if _dictionary is None and FILE_ZSTD_DICT_PATH and zstandard is not None:
+        dictionary = _read_dictionary_file(FILE_ZSTD_DICT_PATH)
+        register_dictionary(dictionary)
+        _dictionary = dictionary
+    return _dictionary
+
+
+def _dictionary_for_id(dict_id: int) -> "zstandard.ZstdCompressionDict":
+    """
+    A dictionary blobs were written with, from the registered dictionaries
+
+    Raises:
+        RuntimeError: If no dictionary with that id is registered
+    """
+    with _dictionaries_lock:
+        dictionary = _dictionaries.get(dict_id)
+    if dictionary is not None:
+        return dictionary
+    from database import get_db
+
+    stored = get_db()[ZSTD_DICTIONARIES_COLLECTION].find_one({"_id": dict_id})
+    if stored is None:
+        raise RuntimeError(f"zstd dictionary {dict_id} is not registered (python file_codec.py register <path>)")
+    dictionary = zstandard.ZstdCompressionDict(stored["data"])
+    with _dictionaries_lock:
+        _dictionaries[dict_id] = dictionary
+    return dictionary
+
+
+def is_compressible_type(content_type: Optional[str]) -> bool:
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    return content_type not in INCOMPRESSIBLE_TYPES and not content_type.startswith(INCOMPRESSIBLE_PREFIXES)
+
+
+def choose_codec(content_type: Optional[str], sample: bytes):
+    """
+    Pick the codec for a new blob
+
+    Args:
+        content_type: The upload's declared content type
+        sample: The blob's first chunk
+
+    Returns:
+        A codec with ``encode``/``decode``/``params``
+    """
+    if FILE_COMPRESSION != ZSTD or zstandard is None or not sample or not is_compressible_type(content_type):
+        return _identity
+    codec = ZstdCodec(FILE_ZSTD_LEVEL, _load_dictionary())
+    if len(codec.encode(sample)) > len(sample) * (1 - FILE_COMPRESSION_MIN_SAVINGS):
+        return _identity
+    return codec
+
+
+def archive_codec(sample: bytes):
+    """
+    Pick the codec for a blob moving to cold storage: high-level zstd, if it pays off on the sample
+
+    Args:
+        sample: The blob's first (uncompressed) chunk
+    """
+    if FILE_COMPRESSION != ZSTD or zstandard is None or not sample:
+        return _identity
+    codec = ZstdCodec(FILE_ARCHIVE_ZSTD_LEVEL, _load_dictionary())
+    if len(codec.encode(sample)) > len(sample) * (1 - FILE_COMPRESSION_MIN_SAVINGS):
+        return _identity
+    return codec
+
+
+def codec_for(params: Optional[Dict[str, Any]]):
+    """
+    The codec a blob was stored with
+
+    Args:
+        params: What ``params()`` returned when it was written (None for uncompressed/legacy files)
+
+    Raises:
+        RuntimeError: If zstandard or the blob's dictionary isn't available
+    """
+    if not params or params.get("codec", IDENTITY) == IDENTITY:
+        return _identity
+    if params["codec"] != ZSTD:
+        raise RuntimeError(f"Unknown file codec: {params['codec']}")
+    if zstandard is None:
+        raise RuntimeError("zstandard is not installed (poetry install -E compression)")
+    dictionary = _dictionary_for_id(params["dict_id"]) if params.get("dict_id") else None
+    return ZstdCodec(params.get("level", FILE_ZSTD_LEVEL), dictionary)
+
+
+def train_dictionary(samples: Iterable[bytes], size: int = 112640) -> bytes:
+    """Train a zstd dictionary on sample documents"""
+    if zstandard is None:
+        raise RuntimeError("zstandard is not installed (poetry install -E compression)")
+    return zstandard.train_dictionary(size, list(samples)).as_bytes()
+
+
+def _samples_from_db(limit: int) -> List[bytes]:
+    from database import get_db
+    from file_storage import FILE_REFS_COLLECTION, read_file_bytes
+
+    db = get_db()
+    samples = []
+    for ref in db[FILE_REFS_COLLECTION].find({}, {"_id": 1}).sort("uploaded_at", -1).limit(limit):
+        found = read_file_bytes(db, str(ref["_id"]))
+        if found:
+            samples.append(found[1])
+    return samples
+
+
+def benchmark(paths: List[str], levels: List[int], chunk_size: int) -> Dict[str, Dict[str, Any]]:
+    """
+    Storage saved versus CPU per MB, for each content type and zstd level
+
+    Files are compressed chunk by chunk, as FileStorage stores them.
+    """
+    by_type: Dict[str, List[bytes]] = {}
+    for path in paths:
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        with open(path, "rb") as f:
+            by_type.setdefault(content_type, []).append(f.read())
+
+    dictionary = _read_dictionary_file(FILE_ZSTD_DICT_PATH) if FILE_ZSTD_DICT_PATH else None
+    results: Dict[str, Dict[str, Any]] = {}
+    for content_type, documents in sorted(by_type.items()):
+        chunks = [doc[i:i + chunk_size] for doc in documents for i in range(0, len(doc), chunk_size)]
+        raw = sum(len(chunk) for chunk in chunks)
+        megabytes = raw / (1024 * 1024)
+        report = {"files": len(documents), "bytes": raw, "policy_compresses": is_compressible_type(content_type)}
+        for level in levels:
+            codec = ZstdCodec(level, dictionary)
+            started = time.process_time()
+            encoded = [codec.encode(chunk) for chunk in chunks]
+            compress_cpu = time.process_time() - started
+            started = time.process_time()
+            for chunk in encoded:
+                codec.decode(chunk)
+            decompress_cpu = time.process_time() - started
+            stored = sum(len(chunk) for chunk in encoded)
+            report[f"level_{level}"] = {
+                "stored_bytes": stored,
+                "saved_pct": 100 * (1 - stored / raw) if raw else 0.0,
+                "compress_cpu_ms_per_mb": 1000 * compress_cpu / megabytes if megabytes else 0.0,
+                "decompress_cpu_ms_per_mb": 1000 * decompress_cpu / megabytes if megabytes else 0.0,
+            }
+        results[content_type] = report
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="zstd dictionary training and compression benchmark")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    train = subparsers.add_parser("train", help="Train a dictionary on stored or local documents")
+    train.add_argument("paths", nargs="*", help="Sample files (globs allowed)")
+    train.add_argument("--from-db", type=int, default=0, help="Also sample this many recently stored files")
+    train.add_argument("--size", type=int, default=112640, help="Dictionary size in bytes")
+    train.add_argument("--output", required=True)
+
+    register = subparsers.add_parser("register", help="Make dictionaries available for decoding by id")
+    register.add_argument("paths", nargs="+", help="Dictionary files (globs allowed)")
+
+    bench = subparsers.add_parser("benchmark", help="Storage saved vs CPU per MB by content type and level")
+    bench.add_argument("paths", nargs="+", help="Sample files (globs allowed)")
+    bench.add_argument("--levels", type=int, nargs="+", default=[1, 3, 6, 12, 19])
+    bench.add_argument("--chunk-size", type=int, default=255 * 1024)
+    bench.add_argument("--output", help="Write the JSON results to this path")
+
+    args = parser.parse_args()
+    paths = [path for pattern in args.paths for path in sorted(glob.glob(pattern))]
+
+    if args.command == "train":
+        samples = []
+        for path in paths:
+            with open(path, "rb") as f:
+                samples.append(f.read())
+        if args.from_db:
+            samples.extend(_samples_from_db(args.from_db))
+        dictionary = train_dictionary(samples, args.size)
+        with open(args.output, "wb") as f:
+            f.write(dictionary)
+        print(f"Trained a {len(dictionary)} byte dictionary on {len(samples)} documents: {args.output}")
+        return
+
+    if args.command == "register":
+        if zstandard is None:
+            raise RuntimeError("zstandard is not installed (poetry install -E compression)")
+        for path in paths:
+            print(f"{path}: registered as dictionary {register_dictionary(_read_dictionary_file(path))}")
+        return
+
+    results = benchmark(paths, args.levels, args.chunk_size)
+    print(f"{'content type':32} {'level':>5} {'saved %':>8} {'comp ms/MB':>11} {'decomp ms/MB':>13}")
+    for content_type, report in results.items():
+        for level in args.levels:
+            stats = report[f"level_{level}"]
+            print(f"{content_type[:32]:32} {level:5} {stats['saved_pct']:8.1f} "
+                  f"{stats['compress_cpu_ms_per_mb']:11.1f} {stats['decompress_cpu_ms_per_mb']:13.1f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,222 +1,772 @@
 import os
+import asyncio
 import base64
-from io import BytesIO
-from typing import List, Optional
-from datetime import datetime
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from datetime import datetime, timedelta
 from fastapi import UploadFile
-from motor.motor_asyncio import AsyncIOMotorGridFSBucket
-from pymongo import MongoClient
+from fastapi.concurrency import run_in_threadpool
+from pymongo import ReturnDocument
 from pymongo.collection import Collection
+from pymongo.database import Database
 from bson import ObjectId
 
 from database import get_db
+from blob_store import COLD_BACKENDS, GRIDFS, READ_CHUNK_SIZE, BlobStore, get_blob_store
+from file_codec import IDENTITY, choose_codec, codec_for, is_compressible_type
+from zip_stream import ZipEntry
+
+# Content-addressed layout: every upload gets a reference in file_refs (its _id is the file ID
+# handed to clients), and each distinct content is stored once under its SHA-256, tracked in
+# file_blobs with a reference count, the blob backend holding it (see blob_store) and its
+# location there (relocated blobs get a key per move). Files stored before this layout (fs.files
+# documents with an ObjectId _id) stay readable and deletable. Blob chunks are compressed per the content-type policy in
+# file_codec; the codec is recorded on the blob. retention.py moves old claims' content to a
+# cold backend: blob records then point there, and archived legacy files keep their fs.files
+# document as a stub whose metadata.archive says where the content went.
+FILE_REFS_COLLECTION = "file_refs"
+FILE_BLOBS_COLLECTION = "file_blobs"
+HASH_CHUNK_SIZE = 1024 * 1024
+BLOB_WAIT_TIMEOUT = float(os.getenv("BLOB_WAIT_TIMEOUT", "30"))
+# After this long, a relocation (migrate_blobs.py, retention.py) is presumed dead and can be taken over
+BLOB_RELOCATE_TIMEOUT = float(os.getenv("BLOB_RELOCATE_TIMEOUT", "3600"))
+# Files stored at once across all requests. Storing is blocking pymongo/blob-store I/O, so it runs
+# on this pool rather than the event loop; several files of a submission are written in parallel.
+# Reads, listings and deletes are blocking too and run on the default threadpool.
+FILE_UPLOAD_CONCURRENCY = int(os.getenv("FILE_UPLOAD_CONCURRENCY", "8"))
+
+# Blob states: "pending" while the first uploader writes the bytes, "deleting" while the last
+# reference's delete frees them. Other writers wait for either to settle.
+BLOB_READY = "ready"
+BLOB_PENDING = "pending"
+BLOB_DELETING = "deleting"
+
+_indexed = False
+_upload_pool = ThreadPoolExecutor(max_workers=FILE_UPLOAD_CONCURRENCY, thread_name_prefix="file-upload")
+
+
+def ensure_file_indexes(db: Database) -> None:
+    """Indexes for looking files up by claim, user and content (created once per process)"""
+    global _indexed
+    if _indexed:
+        return
+    refs = db[FILE_REFS_COLLECTION]
+    refs.create_index("claim_id")
+    refs.create_index("user_id")
+    refs.create_index("sha256")
+    # Legacy files are found by the claim they were attached to
+    db.fs.files.create_index("metadata.claim_id", sparse=True)
+    db.fs.files.create_index("metadata.mongodb_id", sparse=True)
+    db.fs.files.create_index("metadata.claim_mongodb_id", sparse=True)
+    _indexed = True
+
+
+def _refs(db: Database) -> Collection:
+    ensure_file_indexes(db)
+    return db[FILE_REFS_COLLECTION]
+
+
+def _blobs(db: Database) -> Collection:
+    return db[FILE_BLOBS_COLLECTION]
+
+
+def _as_object_id(file_id: str) -> Optional[ObjectId]:
+    try:
+        return ObjectId(file_id)
+    except Exception:
+        return None
+
+
+def _ref_info(ref: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "file_id": str(ref["_id"]),
+        "filename": ref.get("filename", "unknown"),
+        "content_type": ref.get("content_type", "application/octet-stream"),
+        "claim_id": ref.get("claim_id"),
+        "user_id": ref.get("user_id"),
+        "uploaded_at": ref.get("uploaded_at"),
+        "size": ref.get("size"),
+        "sha256": ref.get("sha256"),
+    }
+
+
+def _legacy_info(file_doc: Dict[str, Any]) -> Dict[str, Any]:
+    metadata = file_doc.get("metadata") or {}
+    return {
+        "file_id": str(file_doc["_id"]),
+        "filename": file_doc.get("filename", "unknown"),
+        "content_type": metadata.get("content_type", "application/octet-stream"),
+        "claim_id": metadata.get("claim_id"),
+        "user_id": metadata.get("user_id"),
+        "uploaded_at": metadata.get("uploaded_at"),
+        "size": file_doc.get("length"),
+        "sha256": None,
+    }
+
+
+def blob_location(blob: Dict[str, Any]) -> Tuple[BlobStore, Any]:
+    """The store and key holding a file_blobs record's bytes"""
+    # Blobs written before backends were recorded live in GridFS under their hash
+    return get_blob_store(blob.get("backend") or GRIDFS), blob.get("location", blob["_id"])
+
+
+def rechunk(chunks: Iterable[bytes], size: int = READ_CHUNK_SIZE) -> Iterator[bytes]:
+    """Regroup a byte stream into pieces of ``size`` bytes (the last one may be shorter)"""
+    buffer = bytearray()
+    for data in chunks:
+        buffer += data
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        yield bytes(buffer)
+
+
+def _rehydrate_after(chunks: Iterable[bytes], file_id: str) -> Iterator[bytes]:
+    """Serve a file straight from cold storage, then bring it back to the hot tier for next time"""
+    yield from chunks
+    from retention import schedule_rehydrate
+    schedule_rehydrate(file_id)
+
+
+def _encoded_chunks(source, codec) -> Iterator[bytes]:
+    while True:
+        data = source.read(READ_CHUNK_SIZE)
+        if not data:
+            break
+        yield codec.encode(data)
+
+
+def _locate(db: Database, file_id: str) -> Optional[Tuple[Dict[str, Any], BlobStore, Any, Optional[Dict[str, Any]]]]:
+    """The file's details, the store and key holding its bytes and the codec they're stored with"""
+    obj_id = _as_object_id(file_id)
+    if obj_id is None:
+        return None
+    ref = _refs(db).find_one({"_id": obj_id})
+    if ref:
+        blob = _blobs(db).find_one({"_id": ref["sha256"]}, {"codec": 1, "backend": 1, "location": 1})
+        if not blob:
+            return None
+        store, key = blob_location(blob)
+        return _ref_info(ref), store, key, blob.get("codec")
+    file_doc = db.fs.files.find_one({"_id": obj_id})
+    if file_doc:
+        archive = (file_doc.get("metadata") or {}).get("archive")
+        if archive:
+            return _legacy_info(file_doc), get_blob_store(archive["backend"]), archive["location"], archive.get("codec")
+        return _legacy_info(file_doc), get_blob_store(GRIDFS), obj_id, None
+    return None
+
+
+def _open_located(store: BlobStore, key: Any, codec_params: Optional[Dict[str, Any]]) -> Iterator[bytes]:
+    return codec_for(codec_params).decode_stream(store.open(key))
+
+
+def read_file_bytes(db: Database, file_id: str) -> Optional[Tuple[Dict[str, Any], bytes]]:
+    """
+    Read a stored file synchronously (for scripts with their own client)
+
+    Args:
+        db: The claims database
+        file_id: A file ID from a claim's uploadedFiles
+
+    Returns:
+        (file details, content), or None if the file doesn't exist
+    """
+    located = _locate(db, file_id)
+    if not located:
+        return None
+    info, store, key, codec_params = located
+    return info, b"".join(_open_located(store, key, codec_params))
+
+
+def open_file_chunks(db: Database, file_id: str) -> Optional[Iterator[bytes]]:
+    """
+    Iterate over a stored file's content synchronously, chunk by chunk
+
+    Args:
+        db: The claims database
+        file_id: A file ID from a claim's uploadedFiles
+
+    Returns:
+        The content iterator, or None if the file or its content doesn't exist
+    """
+    located = _locate(db, file_id)
+    if not located:
+        return None
+    _, store, key, codec_params = located
+    try:
+        return _open_located(store, key, codec_params)
+    except KeyError:
+        return None
+
+
+def _archive_name(filename: Optional[str], used: set) -> str:
+    """A flat, unique name inside a claim's archive ("report (2).pdf" for repeats)"""
+    name = os.path.basename((filename or "file").replace("\\", "/")) or "file"
+    stem, extension = os.path.splitext(name)
+    candidate = name
+    n = 2
+    while candidate.lower() in used:
+        candidate = f"{stem} ({n}){extension}"
+        n += 1
+    used.add(candidate.lower())
+    return candidate
+
+
+# Only what _ref_info/_legacy_info read
+REF_INFO_PROJECTION = {
+    "filename": 1, "content_type": 1, "claim_id": 1, "user_id": 1, "uploaded_at": 1, "size": 1, "sha256": 1,
+}
+LEGACY_INFO_PROJECTION = {
+    "filename": 1, "length": 1, "metadata.content_type": 1, "metadata.claim_id": 1, "metadata.user_id": 1,
+    "metadata.uploaded_at": 1,
+}
+
+
+def file_infos(refs: Iterable[Dict[str, Any]], legacy_files: Iterable[Dict[str, Any]]) -> List[dict]:
+    """
+    File details from file_refs and legacy fs.files documents found by the caller, without duplicates
+
+    Args:
+        refs: file_refs documents (at least ``REF_INFO_PROJECTION``)
+        legacy_files: fs.files documents (at least ``LEGACY_INFO_PROJECTION``)
+    """
+    files = {}
+    for ref in refs:
+        files.setdefault(ref["_id"], _ref_info(ref))
+    for file_doc in legacy_files:
+        files.setdefault(file_doc["_id"], _legacy_info(file_doc))
+    return list(files.values())
+
+
+def _list_files(db: Database, ref_query: Dict[str, Any], legacy_query: Dict[str, Any]) -> List[dict]:
+    files = [_ref_info(ref) for ref in _refs(db).find(ref_query, REF_INFO_PROJECTION)]
+    files.extend(_legacy_info(file_doc) for file_doc in db.fs.files.find(legacy_query, LEGACY_INFO_PROJECTION))
+    return files
+
+
+def _hash_source(source) -> Tuple[str, int]:
+    """SHA-256 and size of a binary file, read in chunks; leaves it rewound"""
+    source.seek(0)
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = source.read(HASH_CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        size += len(chunk)
+    source.seek(0)
+    return digest.hexdigest(), size
+
+
+def _claim_blob(db: Database, sha256: str, size: int) -> str:
+    """
+    One attempt at taking a reference on the blob for ``sha256``
+
+    Returns:
+        ``"new"`` if the caller must now store the bytes, ``"ready"`` if they are already
+        stored, or ``"busy"`` if another request is writing or freeing them (retry later)
+    """
+    previous = _blobs(db).find_one_and_update(
+        {"_id": sha256},
+        {"$inc": {"refcount": 1},
+         "$setOnInsert": {"size": size, "state": BLOB_PENDING, "created_at": datetime.now()}},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE,
+    )
+    if previous is None:
+        return "new"
+    if previous.get("state") == BLOB_READY:
+        return "ready"
+    return "busy"
+
+
+def _settled(db: Database, sha256: str) -> Optional[bool]:
+    """After "busy": True once the blob is ready (our reference holds), False if the record
+    disappeared (failed write or completed delete; our increment went with it), None meanwhile"""
+    current = _blobs(db).find_one({"_id": sha256}, {"state": 1})
+    if current is None:
+        return False
+    return True if current.get("state") == BLOB_READY else None
+
+
+def _store_blob(db: Database, sha256: str, size: int, source, content_type: Optional[str] = None,
+                backend: Optional[str] = None) -> None:
+    """Write a claimed blob's bytes to the blob store and mark it ready"""
+    store = get_blob_store(backend)
+    try:
+        # The codec is chosen per blob from its content type and how well the first chunk compresses
+        codec = choose_codec(content_type, source.read(READ_CHUNK_SIZE))
+        source.seek(0)
+        stored_size = store.put(sha256, _encoded_chunks(source, codec),
+                                {"content_addressed": True, "codec": codec.name, "size": size})
+        source.seek(0)
+    except Exception:
+        # Best-effort cleanup: a failure here mustn't replace the error that made the write fail
+        try:
+            store.delete(sha256)
+        except Exception as e:
+            print(f"Could not remove partial blob {sha256} from the {store.name} blob store: {str(e)}")
+        try:
+            _blobs(db).delete_one({"_id": sha256})
+        except Exception as e:
+            print(f"Could not remove the pending record of blob {sha256}: {str(e)}")
+        raise
+    _blobs(db).update_one({"_id": sha256}, {"$set": {
+        "state": BLOB_READY, "backend": store.name, "location": sha256,
+        "codec": codec.params(), "stored_size": stored_size,
+    }})
+
+
+def acquire_blob_sync(db: Database, sha256: str, size: int, source, content_type: Optional[str] = None,
+                      backend: Optional[str] = None) -> bool:
+    """
+    Take a reference on the blob for ``sha256``, storing the bytes from ``source`` if it's new
+
+    Args:
+        db: The claims database
+        sha256: Hash of the content
+        size: Size of the content
+        source: Seekable binary file with the content
+        content_type: Content type, for the compression policy
+        backend: Blob backend for new content (``FILE_BLOB_BACKEND`` if omitted)
+
+    Returns:
+        True if the content was already stored
+    """
+    deadline = time.monotonic() + BLOB_WAIT_TIMEOUT
+    while True:
+        claimed = _claim_blob(db, sha256, size)
+        if claimed == "ready":
+            return True
+        if claimed == "new":
+            _store_blob(db, sha256, size, source, content_type, backend)
+            return False
+
+        # Another request is writing or freeing this content: wait for it to settle
+        settled = None
+        while settled is None:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out waiting for blob {sha256}")
+            time.sleep(0.1)
+            settled = _settled(db, sha256)
+        if settled:
+            return True
+
+
+def relocate_blob(db: Database, blob: Dict[str, Any], target: BlobStore, chunks: Iterable[bytes],
+                  codec_params: Optional[Dict[str, Any]] = None, fields: Optional[Dict[str, Any]] = None,
+                  expected_size: Optional[int] = None, keep_source: bool = False) -> int:
+    """
+    Write a blob's bytes to another store and switch its record there
+
+    Args:
+        db: The claims database
+        blob: The file_blobs record, as read before the copy started
+        target: The store to move to
+        chunks: The bytes to store: as currently stored, or re-encoded with ``codec_params``
+        codec_params: The codec ``chunks`` are encoded with, if it changes
+        fields: Other fields to set on the record
+        expected_size: Fail (keeping the original) if a different number of bytes was written
+        keep_source: Don't delete the old copy
+
+    Returns:
+        Bytes written, or 0 if the blob changed meanwhile (e.g. its last reference was deleted)
+        or another relocation of it is running, and it was left where it was
+    """
+    source_store, source_key = blob_location(blob)
+    blobs = _blobs(db)
+    # Claim the move first, so only one relocation of a blob runs at a time (across processes).
+    # A claim left behind by a crashed run can be taken over once it's stale.
+    token = ObjectId()
+    unchanged = {"_id": blob["_id"], "state": BLOB_READY, "backend": blob.get("backend"),
+                 "location": blob["location"] if "location" in blob else {"$exists": False}}
+    unclaimed = {"$or": [
+        {"relocating": {"$exists": False}},
+        {"relocating.started_at": {"$lt": datetime.now() - timedelta(seconds=BLOB_RELOCATE_TIMEOUT)}},
+    ]}
+    claimed = blobs.update_one(
+        {**unchanged, **unclaimed},
+        {"$set": {"relocating": {"token": token, "target": target.name, "started_at": datetime.now()}}},
+    )
+    if not claimed.modified_count:
+        return 0
+
+    # Every attempt writes under its own key, so only the attempt that wrote an object deletes it
+    key = f"{blob['_id']}.{token}"
+    ours = {"_id": blob["_id"], "state": BLOB_READY, "relocating.token": token}
+    try:
+        stored = target.put(key, chunks, {"content_addressed": True})
+        if expected_size is not None and stored != expected_size:
+            raise RuntimeError(f"Size mismatch copying {blob['_id']}: {stored} != {expected_size}")
+    except Exception:
+        target.delete(key)
+        blobs.update_one(ours, {"$unset": {"relocating": ""}})
+        raise
+
+    update = {"backend": target.name, "location": key, "stored_size": stored, **(fields or {})}
+    if codec_params is not None:
+        update["codec"] = codec_params
+    # Still ours and still ready: not deleted meanwhile, nor taken over as stale
+    if not blobs.update_one(ours, {"$set": update, "$unset": {"relocating": ""}}).modified_count:
+        target.delete(key)
+        return 0
+    if not keep_source:
+        source_store.delete(source_key)
+    return stored
+
+
+def delete_legacy_file(db: Database, obj_id: ObjectId) -> bool:
+    """Delete a pre-content-addressing file, including its archived content if it's a stub"""
+    file_doc = db.fs.files.find_one_and_delete({"_id": obj_id})
+    db.fs.chunks.delete_many({"files_id": obj_id})
+    if file_doc is None:
+        return False
+    archive = (file_doc.get("metadata") or {}).get("archive")
+    if archive:
+        get_blob_store(archive["backend"]).delete(archive["location"])
+    return True
+
+
+def release_blob(db: Database, sha256: str) -> None:
+    """Drop a reference; free the bytes when it was the last one"""
+    blobs = _blobs(db)
+    blob = blobs.find_one_and_update(
+        {"_id": sha256}, {"$inc": {"refcount": -1}}, return_document=ReturnDocument.AFTER
+    )
+    if not blob or blob.get("refcount", 0) > 0:
+        return
+    # Only one release wins the transition, and new references wait while it's deleting. The
+    # location is read in the same step, in case migrate_blobs.py just moved the blob.
+    blob = blobs.find_one_and_update({"_id": sha256, "refcount": {"$lte": 0}, "state": BLOB_READY},
+                                     {"$set": {"state": BLOB_DELETING}}, return_document=ReturnDocument.AFTER)
+    if blob is None:
+        return
+    store, key = blob_location(blob)
+    store.delete(key)
+    blobs.delete_one({"_id": sha256})
+
+
+def _save_source(source, sha256: Optional[str], size: Optional[int], filename: Optional[str],
+                 content_type: Optional[str], claim_id: Optional[str], user_id: Optional[str]) -> dict:
+    """Store one file and add its reference (blocking; runs on the upload pool)"""
+    db = get_db()
+    if sha256 is None:
+        sha256, size = _hash_source(source)
+    deduplicated = acquire_blob_sync(db, sha256, size, source, content_type)
+
+    ref = {
+        "sha256": sha256,
+        "filename": filename,
+        "content_type": content_type or "application/octet-stream",
+        "size": size,
+        "claim_id": claim_id,
+        "uploaded_at": datetime.now(),
+    }
+    if user_id:
+        ref["user_id"] = user_id
+    try:
+        ref["_id"] = _refs(db).insert_one(ref).inserted_id
+    except Exception:
+        release_blob(db, sha256)
+        raise
+
+    info = _ref_info(ref)
+    info["deduplicated"] = deduplicated
+    return info
+
+
+def _open_for_streaming(file_id: str) -> Optional[Tuple[dict, Callable[[], Optional[Iterator[bytes]]], Optional[str]]]:
+    located = _locate(get_db(), file_id)
+    if not located:
+        return None
+    info, store, key, codec_params = located
+    local_path = None
+    if store.name not in COLD_BACKENDS and (codec_params or {}).get("codec", IDENTITY) == IDENTITY:
+        local_path = store.local_path(key)
+        if local_path and not os.path.isfile(local_path):
+            # Not on disk after all: leave it to open_content to report the content missing
+            local_path = None
+
+    # Opening holds a file handle / cursor / S3 body until the iterator is drained, so it's
+    # deferred until the caller knows it will stream the chunks
+    def open_content() -> Optional[Iterator[bytes]]:
+        try:
+            chunks = _open_located(store, key, codec_params)
+        except KeyError:
+            print(f"Content of file {file_id} is missing from the {store.name} blob store")
+            return None
+        if store.name in COLD_BACKENDS:
+            chunks = _rehydrate_after(chunks, file_id)
+        return chunks
+
+    return info, open_content, local_path
+
+
+def _read_base64(file_id: str) -> Optional[dict]:
+    """File details with the content base64-encoded chunk by chunk, never holding the raw bytes whole"""
+    located = _locate(get_db(), file_id)
+    if not located:
+        return None
+    info, store, key, codec_params = located
+    parts: List[bytes] = []
+    pending = b""
+    for chunk in _open_located(store, key, codec_params):
+        pending += chunk
+        # Encode whole 3-byte groups, so the parts concatenate to the encoding of the whole file
+        cut = len(pending) - len(pending) % 3
+        parts.append(base64.b64encode(pending[:cut]))
+        pending = pending[cut:]
+    parts.append(base64.b64encode(pending))
+    info["content"] = b"".join(parts).decode("ascii")
+    return info
+
+
+def _delete_file(file_id: str) -> bool:
+    db = get_db()
+    obj_id = _as_object_id(file_id)
+    if obj_id is None:
+        return False
+    ref = _refs(db).find_one_and_delete({"_id": obj_id})
+    if ref:
+        release_blob(db, ref["sha256"])
+        return True
+    return delete_legacy_file(db, obj_id)
+
+
+def _files_by_object_id(object_id: str) -> List[dict]:
+    db = get_db()
+    files = _list_files(db, {"claim_id": object_id}, {"metadata.claim_id": object_id})
+
+    # If we didn't find any files, try with the object_id as an ObjectId
+    obj_id = _as_object_id(object_id)
+    if not files and obj_id is not None:
+        cursor = db.fs.files.find({
+            "$or": [
+                {"metadata.mongodb_id": obj_id},
+                {"metadata.claim_mongodb_id": obj_id}
+            ]
+        })
+        files.extend(_legacy_info(file_doc) for file_doc in cursor)
+
+    return files
+
+
+async def _run_upload(source, sha256: Optional[str], size: Optional[int], filename: Optional[str],
+                      content_type: Optional[str], claim_id: Optional[str], user_id: Optional[str]) -> dict:
+    return await asyncio.get_running_loop().run_in_executor(
+        _upload_pool, _save_source, source, sha256, size, filename, content_type, claim_id, user_id
+    )
+
 
 class FileStorage:
-    """A utility class for storing and retrieving files from MongoDB using GridFS"""
-    
+    """A utility class for storing and retrieving claim files in MongoDB, deduplicated by content"""
+
     @staticmethod
-    async def save_files(files: List[UploadFile], claim_id: str, user_id: Optional[str] = None) -> List[str]:
+    async def save_file(file: UploadFile, claim_id: Optional[str] = None, user_id: Optional[str] = None) -> dict:
         """
-        Save multiple files to GridFS and return their IDs
-        
+        Store one uploaded file, keeping a single copy of identical content
+
+        Args:
+            file: The uploaded file
+            claim_id: The ID of the claim associated with the file (optional)
+            user_id: The ID of the user who uploaded the file (optional)
+
+        Returns:
+            File details, with ``deduplicated`` True if the content was already stored
+        """
+        return await _run_upload(file.file, None, None, file.filename, file.content_type, claim_id, user_id)
+
+    @staticmethod
+    async def save_stream(source, sha256: str, size: int, filename: Optional[str], content_type: Optional[str],
+                          claim_id: Optional[str] = None, user_id: Optional[str] = None) -> dict:
+        """
+        Store content the caller has already hashed, e.g. a finalized resumable upload
+
+        Args:
+            source: Binary file-like object with ``read`` and ``seek(0)``
+            sha256: Hex SHA-256 of the content
+            size: Size of the content in bytes
+            filename: The file's name
+            content_type: The file's content type
+            claim_id: The ID of the claim associated with the file (optional)
+            user_id: The ID of the user who uploaded the file (optional)
+
+        Returns:
+            File details, with ``deduplicated`` True if the content was already stored
+        """
+        return await _run_upload(source, sha256, size, filename, content_type, claim_id, user_id)
+
+    @staticmethod
+    async def save_files(files: List[UploadFile], claim_id: str, user_id: Optional[str] = None) -> List[dict]:
+        """
+        Save multiple files in parallel, on the shared upload pool
+
+        A file that fails to store doesn't fail the others.
+
         Args:
             files: List of uploaded files
             claim_id: The ID of the claim associated with these files
             user_id: The ID of the user who uploaded the files (optional)
-            
+
         Returns:
-            List of file IDs stored in GridFS
+            One result per file, in order: the file details with ``success`` True, or
+            ``filename``, ``success`` False and ``error``
         """
-        db = get_db()
-        fs = AsyncIOMotorGridFSBucket(db)
-        file_ids = []
-        
-        for file in files:
-            contents = await file.read()
-            file_metadata = {
-                "filename": file.filename,
-                "content_type": file.content_type,
-                "claim_id": claim_id,
-                "uploaded_at": datetime.now()
-            }
-            
-            if user_id:
-                file_metadata["user_id"] = user_id
-            
-            file_id = await fs.upload_from_stream(
-                file.filename,
-                BytesIO(contents),
-                metadata=file_metadata
-            )
-            file_ids.append(str(file_id))
-            
-            await file.seek(0)
-            
-        return file_ids
-    
+        saved = await asyncio.gather(
+            *(FileStorage.save_file(file, claim_id, user_id) for file in files), return_exceptions=True
+        )
+        results = []
+        for file, result in zip(files, saved):
+            if isinstance(result, BaseException):
+                print(f"Error storing file {file.filename}: {result}")
+                results.append({"filename": file.filename, "success": False, "error": str(result)})
+            else:
+                results.append({**result, "success": True})
+        return results
+
+    @staticmethod
+    async def open_file(file_id: str) -> Optional[Tuple[dict, Callable[[], Optional[Iterator[bytes]]], Optional[str]]]:
+        """
+        Locate a file for streaming, without opening its content yet
+
+        Args:
+            file_id: The ID of the file
+
+        Returns:
+            (file details, blocking function that opens the content and returns an iterator
+            over it, or None if the content is missing, path of the stored bytes if they are an
+            uncompressed file on local disk, which can be served directly), or None if not found
+        """
+        return await run_in_threadpool(_open_for_streaming, file_id)
+
     @staticmethod
     async def get_file(file_id: str) -> Optional[dict]:
         """
-        Retrieve a file from GridFS
-        
+        Retrieve a file with its content
+
         Args:
             file_id: The ID of the file to retrieve
-            
+
         Returns:
             File details including the base64 encoded content
         """
-        db = get_db()
-        fs = AsyncIOMotorGridFSBucket(db)
-        
         try:
-            grid_out = await fs.open_download_stream(ObjectId(file_id))
-            chunks = []
-            
-            async for chunk in grid_out:
-                chunks.append(chunk)
-            
-            content = b''.join(chunks)
-            
-            # Get the metadata
-            metadata = grid_out._file
-            
-            return {
-                "file_id": file_id,
-                "filename": metadata.get("filename", "unknown"),
-                "content_type": metadata.get("content_type", "application/octet-stream"),
-                "content": base64.b64encode(content).decode("utf-8"),
-                "claim_id": metadata.get("claim_id"),
-                "user_id": metadata.get("metadata", {}).get("user_id"),
-                "uploaded_at": metadata.get("uploaded_at")
-            }
+            return await run_in_threadpool(_read_base64, file_id)
         except Exception as e:
             print(f"Error retrieving file {file_id}: {e}")
             return None
-    
+
     @staticmethod
     async def get_files_for_claim(claim_id: str) -> List[dict]:
         """
         Get all files associated with a claim
-        
+
         Args:
             claim_id: The ID of the claim
-            
+
         Returns:
             List of file details (without content)
         """
+        return await run_in_threadpool(_list_files, get_db(), {"claim_id": claim_id}, {"metadata.claim_id": claim_id})
+
+    @staticmethod
+    async def get_files_for_claims(claim_ids: List[str]) -> Dict[str, List[dict]]:
+        """
+        Get the files of many claims at once: one query for file_refs and one for legacy files
+
+        Args:
+            claim_ids: The claims' IDs
+
+        Returns:
+            File details (without content) per claim ID; every requested ID is present
+        """
+        claim_ids = list(dict.fromkeys(claim_ids))
+        grouped: Dict[str, List[dict]] = {claim_id: [] for claim_id in claim_ids}
+        if not claim_ids:
+            return grouped
+        files = await run_in_threadpool(
+            _list_files, get_db(), {"claim_id": {"$in": claim_ids}}, {"metadata.claim_id": {"$in": claim_ids}}
+        )
+        for info in files:
+            grouped[info["claim_id"]].append(info)
+        return grouped
+
+    @staticmethod
+    def archive_entries(files: List[dict], compress: bool = True) -> List[ZipEntry]:
+        """
+        ZIP entries for files listed by ``get_files_for_claim``, each opened only when it's reached
+
+        Args:
+            files: File details (``file_id``, ``filename``, ``content_type``, ``size``, ``uploaded_at``)
+            compress: Deflate compressible types; False stores everything, so the archive's size is known
+
+        Returns:
+            Entries for ``zip_stream.stream_zip``
+        """
         db = get_db()
-        files = []
-        
-        # Find all files with matching claim_id in metadata
-        cursor = db.fs.files.find({"metadata.claim_id": claim_id})
-        
-        async for file_doc in cursor:
-            files.append({
-                "file_id": str(file_doc["_id"]),
-                "filename": file_doc.get("filename", "unknown"),
-                "content_type": file_doc.get("metadata", {}).get("content_type", "application/octet-stream"),
-                "user_id": file_doc.get("metadata", {}).get("user_id"),
-                "uploaded_at": file_doc.get("metadata", {}).get("uploaded_at")
-            })
-        
-        return files
-    
+        used = set()
+        entries = []
+        for info in files:
+            def _open(file_id=info["file_id"]):
+                chunks = open_file_chunks(db, file_id)
+                if chunks is None:
+                    raise ValueError(f"Content of file {file_id} is missing")
+                return chunks
+
+            uploaded_at = info.get("uploaded_at")
+            entries.append(ZipEntry(
+                _archive_name(info.get("filename"), used),
+                _open,
+                size=info.get("size"),
+                modified=uploaded_at if isinstance(uploaded_at, datetime) else None,
+                compress=compress and is_compressible_type(info.get("content_type")),
+            ))
+        return entries
+
     @staticmethod
     async def get_files_for_user(user_id: str) -> List[dict]:
         """
         Get all files uploaded by a specific user
-        
+
         Args:
             user_id: The ID of the user
-            
+
         Returns:
             List of file details (without content)
         """
-        db = get_db()
-        files = []
-        
-        # Find all files with matching user_id in metadata
-        cursor = db.fs.files.find({"metadata.user_id": user_id})
-        
-        async for file_doc in cursor:
-            files.append({
-                "file_id": str(file_doc["_id"]),
-                "filename": file_doc.get("filename", "unknown"),
-                "content_type": file_doc.get("metadata", {}).get("content_type", "application/octet-stream"),
-                "claim_id": file_doc.get("metadata", {}).get("claim_id"),
-                "uploaded_at": file_doc.get("metadata", {}).get("uploaded_at")
-            })
-        
-        return files
-    
+        return await run_in_threadpool(_list_files, get_db(), {"user_id": user_id}, {"metadata.user_id": user_id})
+
     @staticmethod
     async def delete_file(file_id: str) -> bool:
         """
-        Delete a file from GridFS
-        
+        Delete a file; its content is freed once no other file references it
+
         Args:
             file_id: The ID of the file to delete
-            
+
         Returns:
             True if deletion was successful, False otherwise
         """
-        db = get_db()
-        fs = AsyncIOMotorGridFSBucket(db)
-        
         try:
-            await fs.delete(ObjectId(file_id))
-            return True
+            return await run_in_threadpool(_delete_file, file_id)
         except Exception as e:
             print(f"Error deleting file {file_id}: {e}")
             return False
-    
+
     @staticmethod
     async def get_files_by_object_id(object_id: str) -> List[dict]:
         """
         Get all files that have a specific MongoDB ObjectId in their metadata.claim_id
-        
+
         Args:
             object_id: The MongoDB ObjectId to search for
-            
+
         Returns:
             List of file details (without content)
         """
-        db = get_db()
-        files = []
-        
-        # First try with the object_id as a string
-        cursor = db.fs.files.find({"metadata.claim_id": object_id})
-        
-        async for file_doc in cursor:
-            files.append({
-                "file_id": str(file_doc["_id"]),
-                "filename": file_doc.get("filename", "unknown"),
-                "content_type": file_doc.get("metadata", {}).get("content_type", "application/octet-stream"),
-                "user_id": file_doc.get("metadata", {}).get("user_id"),
-                "uploaded_at": file_doc.get("metadata", {}).get("uploaded_at")
-            })
-        
-        # If we didn't find any files, try with the object_id as an ObjectId
-        if not files:
-            try:
-                obj_id = ObjectId(object_id)
-                # Look for files where metadata.claim_id is the ObjectId
-                cursor = db.fs.files.find({
-                    "$or": [
-                        {"metadata.mongodb_id": obj_id},
-                        {"metadata.claim_mongodb_id": obj_id}
-                    ]
-                })
-                
-                async for file_doc in cursor:
-                    files.append({
-                        "file_id": str(file_doc["_id"]),
-                        "filename": file_doc.get("filename", "unknown"),
-                        "content_type": file_doc.get("metadata", {}).get("content_type", "application/octet-stream"),
-                        "user_id": file_doc.get("metadata", {}).get("user_id"),
-                        "uploaded_at": file_doc.get("metadata", {}).get("uploaded_at")
-                    })
-            except Exception as e:
-                print(f"Error searching files with ObjectId: {e}")
-        
-        return files 
\ No newline at end of file
+        return await run_in_threadpool(_files_by_object_id, object_id)
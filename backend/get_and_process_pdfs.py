@@ -10,6 +10,9 @@ from bson import ObjectId
 from dotenv import load_dotenv
 import argparse
 
+from claim_resolver import claim_resolver
+from file_storage import read_file_bytes
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -34,19 +37,8 @@ def get_claim_files(claim_id):
     client = MongoClient(MONGODB_URI)
     db = client[DB_NAME]
     
-    # First, find the claim to get associated file IDs
-    claim = None
-    
-    try:
-        # Try with ObjectId
-        claim = db.claims.find_one({"_id": ObjectId(claim_id)})
-    except:
-        # Try with string ID
-        claim = db.claims.find_one({"_id": claim_id})
-    
-    if not claim:
-        # Try with claimId field
-        claim = db.claims.find_one({"claimId": claim_id})
+    # First, find the claim to get associated file IDs (by claimId or _id, in one query)
+    claim = claim_resolver.find(claim_id, {"service.uploadedFiles": 1})
     
     if not claim:
         print(f"Error: No claim found with ID: {claim_id}")
@@ -65,34 +57,17 @@ def get_claim_files(claim_id):
     
     print(f"Found {len(file_ids)} files associated with the claim.")
     
-    # Retrieve each file from GridFS
+    # Retrieve each file (content-addressed or legacy GridFS)
     files = []
-    fs_files = db.fs.files
-    fs_chunks = db.fs.chunks
     
     for file_id in file_ids:
-        # Convert string ID to ObjectId if needed
-        try:
-            obj_id = ObjectId(file_id)
-        except:
-            obj_id = file_id
-            
-        # Get file metadata
-        file_metadata = fs_files.find_one({"_id": obj_id})
-        if not file_metadata:
-            print(f"Warning: File with ID {file_id} not found in GridFS")
+        found = read_file_bytes(db, file_id)
+        if not found:
+            print(f"Warning: File with ID {file_id} not found")
             continue
-            
-        filename = file_metadata.get("filename", f"file_{file_id}.pdf")
         
-        # Get all chunks for this file
-        chunks = list(fs_chunks.find({"files_id": obj_id}).sort("n", 1))
-        if not chunks:
-            print(f"Warning: No chunks found for file {file_id}")
-            continue
-            
-        # Combine chunks to get complete file data
-        file_data = b''.join(chunk["data"] for chunk in chunks)
+        file_metadata, file_data = found
+        filename = file_metadata.get("filename") or f"file_{file_id}.pdf"
         
         # Add to results
         files.append((file_id, filename, file_data))
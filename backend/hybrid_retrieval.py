@@ -0,0 +1,384 @@
+"""
+Hybrid sparse + dense precedent retrieval with cross-encoder re-ranking.
+
+Dense search alone misses precedents that share exact CPT / ICD codes or drug
+names with a claim. The ``HybridRetriever`` runs
+
+1. a local BM25 inverted index over each precedent's ``rationale`` text,
+2. the dense (Pinecone or exact in-memory) vector query,
+
+in parallel, fuses both rankings with reciprocal rank fusion, and re-ranks
+the top candidates with a small CPU cross-encoder. Every stage has a latency
+budget (``StageBudgets``) so each endpoint can trade quality for speed. A
+stage that misses its budget, or that can't start because every worker is
+still busy with earlier stages, is dropped from fusion; the drop is counted
+in ``timings`` and recorded as a ``hybrid.<stage>.dropped`` span.
+
+Searches that widen their filter step by step gather each step's fused
+candidates with ``candidates`` and re-rank them all with one ``rank`` call,
+so the cross-encoder scores each precedent once per request. Without
+``sentence-transformers`` (``poetry install -E rerank``) re-ranking is
+skipped and candidates keep their fused order.
+"""
+
+import math
+import os
+import re
+import contextvars
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from pydantic import BaseModel
+
+from precedent_search import PrecedentCorpus, matches_filter
+from tracing import record_span
+
+# Keeps codes such as "F42.2", "90837" or "H0015" as single tokens
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:\.[a-z0-9]+)*")
+
+DEFAULT_CROSS_ENCODER = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+# Reciprocal rank fusion constant (Cormack et al.); larger values flatten rank differences
+RRF_K = 60
+
+# Stage threads shared by all requests; each request holds up to two (dense + sparse)
+HYBRID_RETRIEVAL_WORKERS = int(os.getenv("HYBRID_RETRIEVAL_WORKERS", "32"))
+
+
+class StageBudgets(BaseModel):
+    """Per-stage latency budgets (milliseconds) and candidate counts for one endpoint"""
+    dense_ms: float = 1500
+    sparse_ms: float = 200
+    rerank_ms: float = 400
+    sparse_candidates: int = 50
+    dense_candidates: int = 50
+    rerank_candidates: int = 50
+    rerank: bool = True
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word/code tokens; dotted codes also emit their category (F42.2 -> f42)"""
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(token)
+        if "." in token:
+            tokens.append(token.split(".", 1)[0])
+    return tokens
+
+
+class BM25Index:
+    """In-memory Okapi BM25 inverted index"""
+
+    def __init__(self, texts: Sequence[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.num_docs = len(texts)
+        doc_lengths = np.zeros(self.num_docs, dtype=np.float32)
+
+        postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        for doc_id, text in enumerate(texts):
+            counts = Counter(tokenize(text or ""))
+            doc_lengths[doc_id] = sum(counts.values())
+            for token, tf in counts.items():
+                postings[token].append((doc_id, tf))
+
+        avg_length = float(doc_lengths.mean()) if self.num_docs else 0.0
+        # Length normalization is per-document, so fold it in once at build time
+        self._length_norm = k1 * (1 - b + b * doc_lengths / (avg_length or 1.0))
+
+        self._postings: Dict[str, Tuple[np.ndarray, np.ndarray, float]] = {}
+        for token, entries in postings.items():
+            docs = np.fromiter((doc for doc, _ in entries), dtype=np.int64, count=len(entries))
+            tfs = np.fromiter((tf for _, tf in entries), dtype=np.float32, count=len(entries))
+            df = len(entries)
+            idf = math.log(1 + (self.num_docs - df + 0.5) / (df + 0.5))
+            self._postings[token] = (docs, tfs, idf)
+
+    def search(self, query: str, k: int, candidates: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """
+        Top-k documents for a query
+
+        Args:
+            query: Free-text query
+            k: Number of results
+            candidates: Only score these document rows (optional)
+
+        Returns:
+            (row, score) pairs, best first; documents sharing no term are omitted
+        """
+        scores = np.zeros(self.num_docs, dtype=np.float32)
+        for token in set(tokenize(query)):
+            posting = self._postings.get(token)
+            if posting is None:
+                continue
+            docs, tfs, idf = posting
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + self._length_norm[docs])
+
+        if candidates is not None:
+            mask = np.zeros(self.num_docs, dtype=bool)
+            mask[candidates] = True
+            scores[~mask] = 0.0
+
+        hits = np.flatnonzero(scores)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        hits = hits[np.argsort(-scores[hits])]
+        return [(int(row), float(scores[row])) for row in hits]
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]], k: int = RRF_K) -> List[Tuple[str, float]]:
+    """Fuse several ranked id lists into one ranking"""
+    fused: Dict[str, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking):
+            fused[item_id] += 1.0 / (k + rank + 1)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+
+class CrossEncoderReranker:
+    """Batched CPU cross-encoder; the model is loaded on first use (or by ``load``)"""
+
+    def __init__(self, model_name: str = DEFAULT_CROSS_ENCODER, batch_size: int = 16, max_length: int = 512):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self._model = None
+        self._unavailable = False
+        self._lock = threading.Lock()
+
+    def _get_model(self):
+        with self._lock:
+            if self._model is None and not self._unavailable:
+                try:
+                    from sentence_transformers import CrossEncoder
+                except ImportError:
+                    print("sentence-transformers is not installed; skipping cross-encoder re-ranking")
+                    self._unavailable = True
+                    return None
+                self._model = CrossEncoder(self.model_name, max_length=self.max_length, device="cpu")
+        return self._model
+
+    def load(self) -> bool:
+        """Load the model now rather than on the first request; False if it isn't available"""
+        return self._get_model() is not None
+
+    def rerank(self, query: str, passages: Sequence[str], budget_ms: float) -> List[Optional[float]]:
+        """
+        Score (query, passage) pairs in batches until the budget runs out
+
+        Returns:
+            One score per passage; None for passages not reached within budget
+            (all of them if the model isn't available)
+        """
+        model = self._get_model()
+        scores: List[Optional[float]] = [None] * len(passages)
+        if model is None:
+            return scores
+        deadline = time.perf_counter() + budget_ms / 1000
+        for start in range(0, len(passages), self.batch_size):
+            if time.perf_counter() >= deadline:
+                break
+            batch = passages[start:start + self.batch_size]
+            predictions = model.predict([(query, passage) for passage in batch], batch_size=self.batch_size)
+            for offset, score in enumerate(predictions):
+                scores[start + offset] = float(score)
+        return scores
+
+
+def precedent_text(metadata: Dict[str, Any]) -> str:
+    """Text a precedent is matched on: the rationale plus its treatment and condition"""
+    return " ".join(
+        str(metadata.get(field) or "") for field in ("condition", "treatment", "rationale")
+    )
+
+
+class HybridRetriever:
+    """BM25 + dense retrieval with RRF fusion and optional cross-encoder re-ranking"""
+
+    def __init__(self, corpus: PrecedentCorpus, dense_index, reranker: Optional[CrossEncoderReranker] = None,
+                 namespace: str = "", workers: int = HYBRID_RETRIEVAL_WORKERS):
+        self.corpus = corpus
+        self.dense_index = dense_index
+        self.reranker = reranker
+        self.namespace = namespace
+        self.bm25 = BM25Index([precedent_text(meta) for meta in corpus.metadata])
+        self._rows = {vector_id: row for row, vector_id in enumerate(corpus.ids)}
+        self._workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hybrid-retrieval")
+        # Stages submitted and not yet finished, including ones their request gave up on
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+
+    def _release(self, _future) -> None:
+        with self._in_flight_lock:
+            self._in_flight -= 1
+
+    def _submit(self, fn, *args) -> Optional[Future]:
+        """Start a stage on the pool, or return None rather than queue it behind busy workers"""
+        with self._in_flight_lock:
+            if self._in_flight >= self._workers:
+                return None
+            self._in_flight += 1
+        # Run the stage in a copy of this context so its spans join the request's trace
+        future = self._executor.submit(contextvars.copy_context().run, fn, *args)
+        future.add_done_callback(self._release)
+        return future
+
+    @staticmethod
+    def _result(stage: str, future: Optional[Future], timeout: float, timings: Dict[str, float]):
+        """A stage's result, or None if it was never started or missed its budget"""
+        reason = "backlog"
+        if future is not None:
+            try:
+                return future.result(timeout=timeout)
+            except FutureTimeoutError:
+                reason = "timeout"
+        timings[f"{stage}_dropped"] = timings.get(f"{stage}_dropped", 0) + 1
+        record_span(f"hybrid.{stage}.dropped", timeout * 1000, reason=reason)
+        return None
+
+    def _dense(self, vector: List[float], k: int, metadata_filter) -> List[Dict[str, Any]]:
+        result = self.dense_index.query(
+            vector=vector,
+            top_k=k,
+            include_metadata=True,
+            filter=metadata_filter,
+            namespace=self.namespace,
+        )
+        return list(result["matches"])
+
+    def _sparse(self, query: str, k: int, metadata_filter) -> List[str]:
+        candidates = None
+        if metadata_filter:
+            candidates = np.flatnonzero([matches_filter(meta, metadata_filter) for meta in self.corpus.metadata])
+        return [self.corpus.ids[row] for row, _ in self.bm25.search(query, k, candidates)]
+
+    def _metadata(self, item_id: str, metadata_by_id: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+        if item_id in metadata_by_id:
+            return metadata_by_id[item_id]
+        row = self._rows.get(item_id)
+        return self.corpus.metadata[row] if row is not None else {}
+
+    def candidates(self, query: str, vector: List[float], budgets: Optional[StageBudgets] = None,
+                   filter: Optional[Dict[str, Any]] = None,
+                   timings: Optional[Dict[str, float]] = None) -> List[Dict[str, Any]]:
+        """
+        Fused BM25 + dense candidates, not yet re-ranked
+
+        Args:
+            query: The claim query text (for BM25)
+            vector: The claim query embedding (for the dense stage)
+            budgets: Stage budgets; defaults to ``StageBudgets()``
+            filter: Pinecone metadata filter applied to both stages
+            timings: Milliseconds spent per stage are added to this dict, and
+                ``<stage>_dropped`` counts stages left out of fusion
+
+        Returns:
+            Up to ``rerank_candidates`` Pinecone-style matches (``id``, fused
+            ``score``, ``metadata``), best first
+        """
+        budgets = budgets or StageBudgets()
+        timings = timings if timings is not None else {}
+        started = time.perf_counter()
+
+        dense_future = self._submit(self._dense, vector, budgets.dense_candidates, filter)
+        sparse_future = self._submit(self._sparse, query, budgets.sparse_candidates, filter)
+
+        # A stage that blows its budget is dropped from fusion rather than waited on
+        sparse_ids = self._result("sparse", sparse_future, budgets.sparse_ms / 1000, timings) or []
+        timings["sparse_ms"] = timings.get("sparse_ms", 0.0) + (time.perf_counter() - started) * 1000
+
+        remaining = max(budgets.dense_ms / 1000 - (time.perf_counter() - started), 0)
+        dense_matches = self._result("dense", dense_future, remaining, timings) or []
+        timings["dense_ms"] = timings.get("dense_ms", 0.0) + (time.perf_counter() - started) * 1000
+
+        metadata_by_id = {match["id"]: match.get("metadata") or {} for match in dense_matches}
+        fused = reciprocal_rank_fusion([[match["id"] for match in dense_matches], sparse_ids])
+        return [
+            {"id": item_id, "score": score, "metadata": self._metadata(item_id, metadata_by_id)}
+            for item_id, score in fused[:budgets.rerank_candidates]
+        ]
+
+    def rank(self, query: str, groups: Sequence[Sequence[Dict[str, Any]]], top_k: int = 3,
+             budgets: Optional[StageBudgets] = None,
+             timings: Optional[Dict[str, float]] = None) -> List[Dict[str, Any]]:
+        """
+        Re-rank candidate lists with one cross-encoder pass and take the top-k
+
+        Each precedent is scored once however many lists it appears in;
+        earlier lists are scored first, so they get the budget. Lists keep
+        their order: the result is each list's best ``top_k`` (skipping
+        precedents already taken), concatenated and cut to ``top_k``.
+
+        ``score`` stays the fused RRF score for every match; the ones the
+        cross-encoder reached also get its logit as ``rerank_score``. The
+        two are on different scales, so compare ``score`` across matches.
+
+        Args:
+            query: The claim query text
+            groups: Lists from ``candidates``, strictest filter first
+            top_k: Number of precedents to return
+            budgets: Stage budgets; defaults to ``StageBudgets()``
+            timings: ``rerank_ms`` is added to this dict when re-ranking ran
+        """
+        budgets = budgets or StageBudgets()
+        unique: Dict[str, Dict[str, Any]] = {}
+        for group in groups:
+            for match in group:
+                unique.setdefault(match["id"], match)
+
+        scores: Dict[str, float] = {}
+        if budgets.rerank and self.reranker is not None and len(unique) > 1:
+            rerank_started = time.perf_counter()
+            ids = list(unique)
+            passages = [precedent_text(unique[item_id]["metadata"]) for item_id in ids]
+            for item_id, score in zip(ids, self.reranker.rerank(query, passages, budgets.rerank_ms)):
+                if score is not None:
+                    scores[item_id] = score
+            if timings is not None:
+                timings["rerank_ms"] = (time.perf_counter() - rerank_started) * 1000
+
+        results: List[Dict[str, Any]] = []
+        taken = set()
+        for group in groups:
+            # Scored candidates first by cross-encoder score; unscored keep fused order behind them
+            scored = sorted((match for match in group if match["id"] in scores),
+                            key=lambda match: scores[match["id"]], reverse=True)
+            unscored = [match for match in group if match["id"] not in scores]
+            ranked = [{**match, "rerank_score": scores[match["id"]]} for match in scored] + unscored
+            for match in ranked[:top_k]:
+                if match["id"] not in taken:
+                    taken.add(match["id"])
+                    results.append(match)
+            if len(results) >= top_k:
+                break
+        return results[:top_k]
+
+    def search(self, query: str, vector: List[float], top_k: int = 3,
+               budgets: Optional[StageBudgets] = None,
+               filter: Optional[Dict[str, Any]] = None) -> Tuple[List[Dict[str, Any]], Dict[str, float]]:
+        """
+        Hybrid top-k search
+
+        Args:
+            query: The claim query text (for BM25 and the cross-encoder)
+            vector: The claim query embedding (for the dense stage)
+            top_k: Number of precedents to return
+            budgets: Stage budgets; defaults to ``StageBudgets()``
+            filter: Pinecone metadata filter applied to both stages
+
+        Returns:
+            (matches, timings): Pinecone-style matches (``id``, fused ``score``,
+            ``metadata`` and, when re-ranked, ``rerank_score``) and the
+            milliseconds spent per stage
+        """
+        timings: Dict[str, float] = {}
+        started = time.perf_counter()
+        candidates = self.candidates(query, vector, budgets, filter, timings)
+        matches = self.rank(query, [candidates], top_k, budgets, timings)
+        timings["total_ms"] = (time.perf_counter() - started) * 1000
+        return matches, timings
@@ -0,0 +1,310 @@
+"""
+Shared chat-completion client with an exact-match completion cache.
+
+Every DeepSeek / OpenAI call in the backend runs at temperature 0-0.3 with a
+deterministic prompt, so an identical request can be answered from disk. A
+request is fingerprinted by (model, messages, temperature, max_tokens and any
+extra parameters); completions are stored in a local SQLite database with a
+TTL and a maximum entry count. Hit / miss counters and the LLM latency saved
+by hits are kept per client.
+
+Usage:
+    from llm_client import get_llm_client
+
+    llm = get_llm_client("deepseek")
+    text = llm.complete(messages, model="deepseek-chat", temperature=0.1, max_tokens=1000)
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from openai import OpenAI
+
+from rate_limiter import estimate_tokens, get_scheduler
+from tracing import record_span, span
+
+# Load environment variables
+load_dotenv()
+DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
+DEEPSEEK_URL = os.getenv("DEEPSEEK_URL", "https://api.deepseek.com")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".llm_cache.sqlite"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+
+# Sampling above this temperature is not reproducible enough to cache
+LLM_CACHE_MAX_TEMPERATURE = 0.3
+
+
+def fingerprint(model: str, messages: List[Dict[str, Any]], temperature: Optional[float],
+                max_tokens: Optional[int], **params: Any) -> str:
+    """Stable hash of everything that determines a completion"""
+    request = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "params": params,
+    }
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _message_bytes(messages: List[Dict[str, Any]]) -> int:
+    return sum(len(str(message.get("content") or "").encode("utf-8")) for message in messages)
+
+
+class CompletionCache:
+    """SQLite-backed completion store with TTL and least-recently-used eviction"""
+
+    def __init__(self, path: str = LLM_CACHE_PATH, ttl_seconds: float = LLM_CACHE_TTL,
+                 max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                content TEXT NOT NULL,
+                latency_ms REAL NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        """Return (content, original latency in ms) for a live entry, else None"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content, latency_ms, created_at FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            content, latency_ms, created_at = row
+            if created_at + self.ttl_seconds <= now:
+                self._conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE completions SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            return content, latency_ms
+
+    def put(self, key: str, model: str, content: str, latency_ms: float) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completions (key, model, content, latency_ms, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, content, latency_ms, now, now),
+            )
+            self._conn.execute("DELETE FROM completions WHERE created_at <= ?", (now - self.ttl_seconds,))
+            self._conn.execute(
+                "DELETE FROM completions WHERE key IN ("
+                "SELECT key FROM completions ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+
+
+class CachedLLMClient:
+    """Wraps an OpenAI-compatible client; identical deterministic requests are served from the cache"""
+
+    def __init__(self, client: OpenAI, cache: Optional[CompletionCache] = None, name: str = "llm"):
+        self.client = client
+        self.cache = cache
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.latency_saved_ms = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _estimate_tokens(messages: List[Dict[str, Any]], max_tokens: Optional[int]) -> int:
+        """Prompt tokens plus the completion budget, for the tokens-per-minute bucket"""
+        prompt = estimate_tokens([message.get("content") or "" for message in messages])
+        return prompt + (max_tokens or 1000)
+
+    def complete(self, messages: List[Dict[str, Any]], model: str = "deepseek-chat",
+                 temperature: Optional[float] = 0.1, max_tokens: Optional[int] = None,
+                 use_cache: bool = True, **params: Any) -> str:
+        """
+        Run a chat completion and return the message content
+
+        Args:
+            messages: Chat messages
+            model: Model name
+            temperature: Sampling temperature
+            max_tokens: Completion token limit (None for the provider default)
+            use_cache: Set False to always call the provider
+            **params: Extra ``chat.completions.create`` parameters (part of the fingerprint)
+
+        Returns:
+            The completion text
+        """
+        cacheable = (
+            use_cache
+            and self.cache is not None
+            and (temperature or 0) <= LLM_CACHE_MAX_TEMPERATURE
+            and not params.get("stream")
+        )
+        key = fingerprint(model, messages, temperature, max_tokens, **params) if cacheable else None
+
+        with span("llm.chat", **{"llm.provider": self.name, "llm.model": model}) as s:
+            s.set("payload.request_bytes", _message_bytes(messages))
+            if key is not None:
+                cached = self.cache.get(key)
+                s.set("cache.hit", cached is not None)
+                if cached is not None:
+                    content, latency_ms = cached
+                    with self._lock:
+                        self.hits += 1
+                        self.latency_saved_ms += latency_ms
+                    s.set("payload.response_bytes", len(content.encode("utf-8")))
+                    return content
+
+            request = {"model": model, "messages": messages, "temperature": temperature, **params}
+            if max_tokens is not None:
+                request["max_tokens"] = max_tokens
+
+            started = time.perf_counter()
+            response = get_scheduler(self.name).call(
+                lambda: self.client.chat.completions.create(**request),
+                tokens=self._estimate_tokens(messages, max_tokens),
+                usage=lambda response: response.usage.total_tokens if getattr(response, "usage", None) else None,
+            )
+            latency_ms = (time.perf_counter() - started) * 1000
+            content = response.choices[0].message.content
+
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                s.set("tokens.prompt", usage.prompt_tokens)
+                s.set("tokens.completion", usage.completion_tokens)
+                s.set("tokens.total", usage.total_tokens)
+            s.set("payload.response_bytes", len((content or "").encode("utf-8")))
+
+        with self._lock:
+            self.misses += 1
+        if key is not None and content is not None:
+            self.cache.put(key, model, content, latency_ms)
+        return content
+
+    def stream(self, messages: List[Dict[str, Any]], model: str = "deepseek-chat",
+               temperature: Optional[float] = 0.1, max_tokens: Optional[int] = None,
+               use_cache: bool = True, **params: Any) -> Iterator[str]:
+        """
+        Stream a chat completion, yielding content deltas
+
+        Shares cache entries with ``complete``: a hit yields the whole cached
+        completion at once, and a streamed completion is cached when it ends.
+        """
+        params.pop("stream", None)
+        cacheable = use_cache and self.cache is not None and (temperature or 0) <= LLM_CACHE_MAX_TEMPERATURE
+        key = fingerprint(model, messages, temperature, max_tokens, **params) if cacheable else None
+
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                content, latency_ms = cached
+                with self._lock:
+                    self.hits += 1
+                    self.latency_saved_ms += latency_ms
+                record_span("llm.stream", 0.0, **{"llm.provider": self.name, "llm.model": model, "cache.hit": True})
+                yield content
+                return
+
+        request = {"model": model, "messages": messages, "temperature": temperature, "stream": True, **params}
+        if max_tokens is not None:
+            request["max_tokens"] = max_tokens
+
+        started = time.perf_counter()
+        parts: List[str] = []
+        # The concurrency slot is held until the stream is drained
+        scheduler = get_scheduler(self.name)
+        with scheduler.acquire(self._estimate_tokens(messages, max_tokens)) as permit:
+            for chunk in self.client.chat.completions.create(**request):
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield delta
+            permit.record_tokens(estimate_tokens(parts) + estimate_tokens([m.get("content") or "" for m in messages]))
+        latency_ms = (time.perf_counter() - started) * 1000
+        # A span can't stay open across yields (the caller owns the context), so record it afterwards
+        record_span("llm.stream", latency_ms, **{
+            "llm.provider": self.name,
+            "llm.model": model,
+            "cache.hit": False if key is not None else None,
+            "payload.request_bytes": _message_bytes(messages),
+            "payload.response_bytes": sum(len(part.encode("utf-8")) for part in parts),
+        })
+
+        with self._lock:
+            self.misses += 1
+        if key is not None and parts:
+            self.cache.put(key, model, "".join(parts), latency_ms)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "latency_saved_ms": self.latency_saved_ms,
+            }
+
+
+_cache: Optional[CompletionCache] = None
+_clients: Dict[str, CachedLLMClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_llm_client(provider: str = "deepseek") -> CachedLLMClient:
+    """
+    Shared cached client for a provider ("deepseek" or "openai")
+
+    All providers share one completion cache; the model name in the
+    fingerprint keeps their entries apart.
+    """
+    global _cache
+    with _clients_lock:
+        if provider not in _clients:
+            # The SDK's own retries would hide 429s from the rate limiter, which retries them itself
+            if provider == "deepseek":
+                client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url=DEEPSEEK_URL, max_retries=0)
+            elif provider == "openai":
+                client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+            else:
+                raise ValueError(f"Unknown LLM provider: {provider}")
+            if LLM_CACHE_ENABLED and _cache is None:
+                _cache = CompletionCache()
+            _clients[provider] = CachedLLMClient(client, _cache if LLM_CACHE_ENABLED else None, name=provider)
+        return _clients[provider]
+
+
+def llm_stats() -> Dict[str, Dict[str, Any]]:
+    """Cache counters for every client created so far"""
+    with _clients_lock:
+        return {name: client.stats() for name, client in _clients.items()}
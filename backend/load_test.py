@@ -0,0 +1,460 @@
+"""
+Reproducible load test for the FastAPI backend, against local stand-ins.
+
+Boots ``main.app`` with
+
+* MongoDB: mongomock (default) or a real local mongod on a throwaway database,
+* Jina: ``fake_services.FakeJinaHandler`` (deterministic vectors),
+* DeepSeek: ``fake_services.FakeChatHandler`` (configurable latency),
+* Pinecone: the in-memory exact index over a synthetic precedent corpus,
+
+then drives a weighted mix of claim CRUD, uploads, downloads, PDF
+extraction and guidance calls from ``--concurrency`` closed-loop workers and
+writes throughput and p50/p95/p99 latency per endpoint to a JSON report.
+``--baseline`` compares against an earlier report and exits non-zero when
+any endpoint's p95 regressed by more than ``--max-regression``.
+
+Usage:
+    python load_test.py --duration 60 --concurrency 16 --output report.json
+    python load_test.py --mix get_claim=10,appeal_guidance=1 --baseline report.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import httpx
+import numpy as np
+
+from fake_services import FakeChatHandler, FakeJinaHandler, start_fake_server, synthetic_corpus
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_PDF = os.path.join(BACKEND_DIR, "Patient 1 - OCD Inpatient Request.pdf")
+
+# Relative weight of each scenario in the default mix
+DEFAULT_MIX: Dict[str, float] = {
+    "create_claim": 2,
+    "list_claims": 4,
+    "get_claim": 6,
+    "update_status": 1,
+    "upload": 2,
+    "claim_files": 2,
+    "download": 3,
+    "process_pdfs": 1,
+    "appeal_guidance": 1,
+    "legal_guidance": 1,
+}
+
+INSURERS = ["Aetna", "Anthem Blue Cross", "UnitedHealthcare", "Cigna", "Medicaid Managed Care"]
+TREATMENTS = ["Residential Treatment Center", "Intensive Outpatient Program", "Psychotherapy",
+              "Medication Management", "Partial Hospitalization"]
+
+
+class LoadState:
+    """Ids created during the run, shared by the scenarios"""
+
+    def __init__(self, rng: random.Random):
+        self.rng = rng
+        self.claim_ids: List[str] = []
+        self.file_ids: List[str] = []
+        self.pdf_bytes = open(SAMPLE_PDF, "rb").read() if os.path.exists(SAMPLE_PDF) else b"%PDF-1.4\n"
+
+    def any_claim(self) -> Optional[str]:
+        return self.rng.choice(self.claim_ids) if self.claim_ids else None
+
+    def any_file(self) -> Optional[str]:
+        return self.rng.choice(self.file_ids) if self.file_ids else None
+
+
+def claim_payload(rng: random.Random) -> Dict[str, Any]:
+    return {
+        "provider": {"providerType": rng.choice(["psychologist", "psychiatrist", "therapist"]),
+                     "providerName": f"Dr. Load {rng.randint(1, 500)}", "providerNPI": str(rng.randint(10**9, 10**10))},
+        "patient": {"patientName": f"Patient {rng.randint(1, 10**6)}", "patientDob": "1990-01-01",
+                    "patientInsuranceId": f"INS-{rng.randint(1, 10**6)}",
+                    "patientInsuranceProvider": rng.choice(INSURERS)},
+        "service": {"serviceType": rng.choice(["individual-therapy", "group-therapy", "evaluation"]),
+                    "serviceDate": "2024-03-01", "totalCharge": str(rng.randint(100, 5000)),
+                    "cptCode": "90837", "diagnosisCode": "F42.2",
+                    "serviceDescription": "Weekly psychotherapy sessions"},
+    }
+
+
+def health_claim_payload(rng: random.Random) -> Dict[str, Any]:
+    return {
+        "condition": rng.choice(["Mental Health", "Substance Abuse/ Addiction"]),
+        "date": "2024-03-01",
+        "health_insurance_provider": rng.choice(INSURERS),
+        "requested_treatment": rng.choice(TREATMENTS),
+        "explanation": "Coverage was denied as not medically necessary after two failed outpatient programs.",
+    }
+
+
+Scenario = Callable[[httpx.AsyncClient, LoadState], Awaitable[Optional[Tuple[str, httpx.Response]]]]
+
+
+async def create_claim(client, state):
+    response = await client.post("/claims", json=claim_payload(state.rng))
+    if response.status_code == 200:
+        state.claim_ids.append(response.json()["claim"]["claimId"])
+    return "POST /claims", response
+
+
+async def list_claims(client, state):
+    return "GET /claims", await client.get("/claims", params={"limit": 50})
+
+
+async def get_claim(client, state):
+    claim_id = state.any_claim()
+    if claim_id is None:
+        return None
+    return "GET /claims/{claim_id}", await client.get(f"/claims/{claim_id}")
+
+
+async def update_status(client, state):
+    claim_id = state.any_claim()
+    if claim_id is None:
+        return None
+    status = state.rng.choice(["pending", "approved", "denied", "appealed"])
+    return "PATCH /claims/{claim_id}/status", await client.patch(f"/claims/{claim_id}/status", json={"status": status})
+
+
+async def upload(client, state):
+    claim_id = state.any_claim()
+    if claim_id is None:
+        return None
+    files = [("files", (f"record-{state.rng.randint(1, 10**6)}.pdf", state.pdf_bytes, "application/pdf"))]
+    response = await client.post("/direct-upload", params={"claim_id": claim_id}, files=files)
+    if response.status_code == 200:
+        state.file_ids.extend(response.json().get("file_ids") or [])
+    return "POST /direct-upload", response
+
+
+async def claim_files(client, state):
+    claim_id = state.any_claim()
+    if claim_id is None:
+        return None
+    return "GET /claims/{claim_id}/files", await client.get(f"/claims/{claim_id}/files")
+
+
+async def download(client, state):
+    file_id = state.any_file()
+    if file_id is None:
+        return None
+    return "GET /claims/files/{file_id}", await client.get(f"/claims/files/{file_id}", params={"download": True})
+
+
+async def process_pdfs(client, state):
+    files = [("files", ("claim.pdf", state.pdf_bytes, "application/pdf"))]
+    return "POST /process-pdfs", await client.post("/process-pdfs", files=files)
+
+
+async def appeal_guidance(client, state):
+    return "POST /get-appeal-guidance", await client.post("/get-appeal-guidance",
+                                                          json=health_claim_payload(state.rng))
+
+
+async def legal_guidance(client, state):
+    return "POST /get-legal-sourcing-guidance", await client.post("/get-legal-sourcing-guidance",
+                                                                  json=health_claim_payload(state.rng))
+
+
+SCENARIOS: Dict[str, Scenario] = {
+    "create_claim": create_claim,
+    "list_claims": list_claims,
+    "get_claim": get_claim,
+    "update_status": update_status,
+    "upload": upload,
+    "claim_files": claim_files,
+    "download": download,
+    "process_pdfs": process_pdfs,
+    "appeal_guidance": appeal_guidance,
+    "legal_guidance": legal_guidance,
+}
+
+
+class EndpointStats:
+    def __init__(self):
+        self.latencies_ms: List[float] = []
+        self.statuses: Dict[str, int] = {}
+        self.errors = 0
+
+    def record(self, latency_ms: float, status: Optional[int]) -> None:
+        self.latencies_ms.append(latency_ms)
+        key = str(status) if status is not None else "exception"
+        self.statuses[key] = self.statuses.get(key, 0) + 1
+        if status is None or status >= 400:
+            self.errors += 1
+
+    def summary(self, elapsed_s: float) -> Dict[str, Any]:
+        values = np.asarray(self.latencies_ms) if self.latencies_ms else np.zeros(1)
+        return {
+            "requests": len(self.latencies_ms),
+            "errors": self.errors,
+            "error_rate": self.errors / len(self.latencies_ms) if self.latencies_ms else 0.0,
+            "statuses": self.statuses,
+            "throughput_rps": len(self.latencies_ms) / elapsed_s if elapsed_s else 0.0,
+            "mean_ms": float(values.mean()),
+            "p50_ms": float(np.percentile(values, 50)),
+            "p95_ms": float(np.percentile(values, 95)),
+            "p99_ms": float(np.percentile(values, 99)),
+            "max_ms": float(values.max()),
+        }
+
+
+def parse_mix(spec: Optional[str]) -> Dict[str, float]:
+    """Parse "name=weight,..." (unlisted scenarios are dropped); None gives DEFAULT_MIX"""
+    if not spec:
+        return dict(DEFAULT_MIX)
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise ValueError(f"Unknown scenario {name!r}; choose from {', '.join(SCENARIOS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+async def run_load(client: httpx.AsyncClient, mix: Dict[str, float], concurrency: int, duration_s: float,
+                   max_requests: Optional[int], state: LoadState) -> Tuple[Dict[str, EndpointStats], float]:
+    """Closed-loop workers issuing weighted scenarios until the time or request budget is spent"""
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    stats: Dict[str, EndpointStats] = {}
+    issued = 0
+    started = time.perf_counter()
+    deadline = started + duration_s
+
+    async def worker():
+        nonlocal issued
+        while time.perf_counter() < deadline and (max_requests is None or issued < max_requests):
+            issued += 1
+            scenario = SCENARIOS[state.rng.choices(names, weights)[0]]
+            t0 = time.perf_counter()
+            label, status = None, None
+            try:
+                result = await scenario(client, state)
+                if result is None:
+                    issued -= 1
+                    await asyncio.sleep(0)
+                    continue
+                label, response = result
+                status = response.status_code
+            except Exception as e:
+                label = label or scenario.__name__
+                print(f"{scenario.__name__} failed: {type(e).__name__}: {e}")
+            stats.setdefault(label, EndpointStats()).record((time.perf_counter() - t0) * 1000, status)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return stats, time.perf_counter() - started
+
+
+async def seed_data(client: httpx.AsyncClient, state: LoadState, claims: int, files: int) -> None:
+    """Create claims and files up front so read scenarios have something to read"""
+    for _ in range(claims):
+        await create_claim(client, state)
+    for _ in range(files):
+        await upload(client, state)
+    print(f"Seeded {len(state.claim_ids)} claims and {len(state.file_ids)} files")
+
+
+def configure_environment(args, workdir: str) -> None:
+    """Point every external dependency of main.py at a local stand-in (before it is imported)"""
+    _, jina_url = start_fake_server(FakeJinaHandler, latency_ms=args.embed_latency_ms,
+                                    jitter_ms=args.embed_latency_ms * args.jitter, error_rate=args.error_rate)
+    _, chat_url = start_fake_server(FakeChatHandler, latency_ms=args.llm_latency_ms,
+                                    jitter_ms=args.llm_latency_ms * args.jitter, error_rate=args.error_rate)
+
+    snapshot = os.path.join(workdir, "precedents.npz")
+    synthetic_corpus(args.corpus_size, seed=args.seed).save(snapshot)
+
+    os.environ.update({
+        "JINA_URL": f"{jina_url}/v1/embeddings",
+        "DEEPSEEK_URL": chat_url,
+        "VECTOR_BACKEND": "memory",
+        "PRECEDENT_SNAPSHOT": snapshot,
+        "LEGAL_SNAPSHOT": snapshot,
+        "LLM_CACHE_ENABLED": "true" if args.caches else "false",
+        "LLM_CACHE_PATH": os.path.join(workdir, "llm_cache.sqlite"),
+        "SEMANTIC_CACHE_THRESHOLD": "0.97" if args.caches else "2",
+        "TRACE_BUFFER_SIZE": "50",
+        # Keys only need to be non-empty: nothing leaves localhost
+        "JINA_API_KEY": "load-test",
+        "DEEPSEEK_API_KEY": "load-test",
+        "OPENAI_API_KEY": "load-test",
+        "PINECONE_API_KEY": "load-test",
+    })
+    if args.mongo == "mongomock":
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+        # Override any MONGODB_URI from .env: mongomock can't parse mongodb+srv:// URIs,
+        # and a real cluster's address must not leak into a test run
+        os.environ["MONGODB_URI"] = "mongodb://localhost:27017"
+        os.environ["DB_NAME"] = "claims-load-test"
+    else:
+        os.environ["MONGODB_URI"] = args.mongo
+        os.environ["DB_NAME"] = f"claims-load-test-{int(time.time())}"
+
+
+class _UvicornThread:
+    """Serve the app on a free localhost port from a background thread"""
+
+    def __init__(self, app):
+        import socket
+        import uvicorn
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=self.port, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def __enter__(self) -> str:
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.05)
+        return f"http://127.0.0.1:{self.port}"
+
+    def __exit__(self, *exc) -> None:
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_reports(report: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> bool:
+    """Print per-endpoint deltas against a baseline; False if any p95 regressed beyond the threshold"""
+    ok = True
+    print(f"\n{'endpoint':40} {'p50':>16} {'p95':>16} {'rps':>14}")
+    for endpoint, current in sorted(report["endpoints"].items()):
+        previous = baseline.get("endpoints", {}).get(endpoint)
+        if previous is None:
+            print(f"{endpoint:40} (new)")
+            continue
+        change = (current["p95_ms"] - previous["p95_ms"]) / previous["p95_ms"] if previous["p95_ms"] else 0.0
+        flag = ""
+        if change > max_regression:
+            ok = False
+            flag = "  REGRESSION"
+        print(f"{endpoint:40} {previous['p50_ms']:7.1f}->{current['p50_ms']:7.1f} "
+              f"{previous['p95_ms']:7.1f}->{current['p95_ms']:7.1f} "
+              f"{previous['throughput_rps']:6.1f}->{current['throughput_rps']:6.1f}{flag}")
+    return ok
+
+
+async def _run(args, app) -> Dict[str, Any]:
+    mix = parse_mix(args.mix)
+    if "process_pdfs" in mix:
+        try:
+            import PyPDF2  # noqa: F401
+        except ImportError:
+            print("PyPDF2 not installed; dropping process_pdfs from the mix")
+            mix.pop("process_pdfs")
+
+    state = LoadState(random.Random(args.seed))
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    timeout = httpx.Timeout(args.timeout)
+
+    async def _drive(client):
+        await seed_data(client, state, args.seed_claims, args.seed_files)
+        return await run_load(client, mix, args.concurrency, args.duration, args.requests, state)
+
+    if args.server == "asgi":
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://load-test", timeout=timeout) as client:
+            stats, elapsed = await _drive(client)
+    else:
+        with _UvicornThread(app) as base_url:
+            async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as client:
+                stats, elapsed = await _drive(client)
+
+    endpoints = {label: endpoint.summary(elapsed) for label, endpoint in sorted(stats.items())}
+    overall = EndpointStats()
+    for endpoint in stats.values():
+        overall.latencies_ms.extend(endpoint.latencies_ms)
+        overall.errors += endpoint.errors
+    return {
+        "generated_at": datetime.utcnow().isoformat() + "Z",
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "mix": mix,
+        "elapsed_s": elapsed,
+        "overall": overall.summary(elapsed),
+        "endpoints": endpoints,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the backend against local fakes")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to drive load for")
+    parser.add_argument("--requests", type=int, help="Stop after this many requests instead")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent closed-loop workers")
+    parser.add_argument("--mix", help='Scenario weights, e.g. "get_claim=5,upload=1" (default: all)')
+    parser.add_argument("--mongo", default="mongomock", help='"mongomock" or a MongoDB URI (uses a throwaway db)')
+    parser.add_argument("--server", choices=["uvicorn", "asgi"], default="uvicorn",
+                        help="Real HTTP server on localhost, or in-process ASGI calls")
+    parser.add_argument("--llm-latency-ms", type=float, default=800, help="Fake chat completion latency")
+    parser.add_argument("--embed-latency-ms", type=float, default=50, help="Fake embedding latency")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Latency jitter as a fraction of the mean")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of fake API calls answered 429")
+    parser.add_argument("--corpus-size", type=int, default=2000, help="Synthetic precedents in the vector index")
+    parser.add_argument("--seed-claims", type=int, default=20, help="Claims created before measuring")
+    parser.add_argument("--seed-files", type=int, default=10, help="Files uploaded before measuring")
+    parser.add_argument("--caches", action="store_true", help="Keep the LLM and semantic caches enabled")
+    parser.add_argument("--timeout", type=float, default=120, help="Per-request timeout in seconds")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for data and scenario choice")
+    parser.add_argument("--output", default="load_test_report.json", help="Where to write the JSON report")
+    parser.add_argument("--baseline", help="Earlier report to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="Allowed relative p95 increase before --baseline fails")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="load-test-") as workdir:
+        configure_environment(args, workdir)
+        sys.path.insert(0, BACKEND_DIR)
+        import main as backend
+
+        try:
+            report = asyncio.run(_run(args, backend.app))
+        finally:
+            if args.mongo != "mongomock":
+                backend.mongo_client.drop_database(os.environ["DB_NAME"])
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    overall = report["overall"]
+    print(f"\n{overall['requests']} requests in {report['elapsed_s']:.1f}s "
+          f"({overall['throughput_rps']:.1f} rps, p95 {overall['p95_ms']:.1f} ms, {overall['errors']} errors)")
+    for endpoint, summary in report["endpoints"].items():
+        print(f"  {endpoint:40} n={summary['requests']:5} p50={summary['p50_ms']:8.1f} "
+              f"p95={summary['p95_ms']:8.1f} p99={summary['p99_ms']:8.1f} errors={summary['errors']}")
+    print(f"Report written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare_reports(report, baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,11 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
 from typing import List, Optional
 import json
+import hashlib
 from datetime import datetime
 import PyPDF2
 import io
@@ -16,6 +19,7 @@ from langchain.chains import RetrievalQA
 from langchain_pinecone import PineconeVectorStore
 import pinecone
 import os
+import threading
 from dotenv import load_dotenv
 from pymongo import MongoClient
 from pymongo.collection import Collection
@@ -26,6 +30,19 @@ from claims_api import router as claims_router
 from classifier import router as classifier_router, register_routes as register_classifier_routes
 from submit_claim_to_provider import router as provider_router, register_routes as register_provider_routes
 from openai import OpenAI
+from embedding_client import get_embedding
+from llm_client import get_llm_client, llm_stats
+from precedent_retrieval import query_precedents, query_precedents_hybrid
+from precedent_search import PrecedentCorpus, ExactSearchIndex
+from hybrid_retrieval import HybridRetriever, CrossEncoderReranker, StageBudgets
+from semantic_cache import SemanticCache
+from context_builder import ContextBuilder, CONTEXT_GUIDANCE_TOKENS, CONTEXT_LEGAL_TOKENS
+from structured_output import complete_structured, StructuredOutputError
+from rate_limiter import BATCH, RateLimitedIndex, priority, scheduler_stats
+from claim_cache import claim_cache
+from claim_resolver import claim_resolver
+from file_storage import FileStorage
+from tracing import TraceMiddleware, mongo_tracer, render_prometheus, span, trace_buffer
 
 # Load environment variables
 load_dotenv()
@@ -43,7 +60,10 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Location", "Upload-Offset", "Upload-Length", "Tus-Resumable"],
 )
+# One root trace span per request; external calls below attach child spans
+app.add_middleware(TraceMiddleware)
 
 # Include routers
 app.include_router(claims_router)
@@ -55,46 +75,11 @@ app.include_router(provider_router)
 # register_provider_routes(app)
 
 # Database connection for direct uploads
-mongo_client = MongoClient(MONGODB_URI)
+mongo_client = MongoClient(MONGODB_URI, event_listeners=[mongo_tracer])
 mongo_db = mongo_client[DB_NAME]
 
 # Initialize Pinecone
 pc = pinecone.Pinecone(api_key=PINECONE_API_KEY)
-JINA_URL = "https://api.jina.ai/v1/embeddings"
-
-HEADERS = {
-    "Content-Type": "application/json",
-    "Authorization": f"Bearer {JINA_API_KEY}"
-}
-
-
-def get_embedding(text: str) -> list[float]:
-    payload = {
-        "model": "jina-clip-v2",
-        "input": [text],
-        "normalized": False
-    }
-    resp = requests.post(JINA_URL, headers=HEADERS, json=payload)
-    print(resp.content)
-    print(f"Response received from Jina AI, status: {resp.status_code}")
-    json_resp = resp.json()
-    print(f"Full response: {json_resp}")
-    
-    if "data" not in json_resp:
-        print(f"Error: Response missing 'data' key. Full response: {json_resp}")
-        if "error" in json_resp:
-            print(f"API Error: {json_resp['error']}")
-        raise KeyError(f"Response missing 'data' key. Full response: {json_resp}")
-    
-    if not json_resp["data"]:
-        raise ValueError("Response data is empty")
-    
-    if "embedding" not in json_resp["data"][0]:
-        raise KeyError(f"Response missing 'embedding' key. Data: {json_resp['data'][0]}")
-    
-    embeddings = json_resp["data"][0]["embedding"]
-    
-    return embeddings
 
 # Initialize OpenAI
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
@@ -116,15 +101,77 @@ llm = ChatDeepSeek(
 # Initialize Pinecone indexes
 index_name = "health-claims"
 legal_index_name = "health-claims-legal-sourcing"
-index = pc.Index(index_name)
-legal_index = pc.Index(legal_index_name)
-vectorstore = PineconeVectorStore(pinecone_api_key=PINECONE_API_KEY, index=index, embedding=embeddings)
-legal_vectorstore = PineconeVectorStore(pinecone_api_key=PINECONE_API_KEY, index=legal_index, embedding=embeddings)
+# "memory" serves both indexes from snapshots written by precedent_search.py instead of
+# Pinecone (local runs and load_test.py)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "pinecone")
+PRECEDENT_SNAPSHOT = os.getenv("PRECEDENT_SNAPSHOT")
+LEGAL_SNAPSHOT = os.getenv("LEGAL_SNAPSHOT")
+
+if VECTOR_BACKEND == "memory":
+    index = ExactSearchIndex(PrecedentCorpus.load(PRECEDENT_SNAPSHOT))
+    legal_index = ExactSearchIndex(PrecedentCorpus.load(LEGAL_SNAPSHOT or PRECEDENT_SNAPSHOT))
+    vectorstore = legal_vectorstore = None
+else:
+    # Direct queries go through the Pinecone rate limiter; the LangChain stores get the raw index
+    index = RateLimitedIndex(pc.Index(index_name), name=index_name)
+    legal_index = RateLimitedIndex(pc.Index(legal_index_name), name=legal_index_name)
+    vectorstore = PineconeVectorStore(pinecone_api_key=PINECONE_API_KEY, index=index.index, embedding=embeddings)
+    legal_vectorstore = PineconeVectorStore(pinecone_api_key=PINECONE_API_KEY, index=legal_index.index, embedding=embeddings)
+
+# Hybrid (BM25 + dense + cross-encoder) retrieval, off unless HYBRID_RETRIEVAL=true.
+# The BM25 index needs every precedent in memory: it is built in the background at startup
+# from a snapshot written by precedent_search.py (PRECEDENT_SNAPSHOT) or, failing that, from
+# Pinecone. Requests use dense retrieval until it is ready (or if building it fails).
+HYBRID_RETRIEVAL = os.getenv("HYBRID_RETRIEVAL", "false").lower() == "true"
+DENSE_BACKEND = os.getenv("DENSE_BACKEND", "pinecone")  # or "exact" for in-memory search
+CROSS_ENCODER_MODEL = os.getenv("CROSS_ENCODER_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+
+# Per-endpoint latency budgets for the hybrid retriever
+RETRIEVAL_BUDGETS = {
+    "appeal-guidance": StageBudgets(),
+    "legal-sourcing": StageBudgets(rerank_ms=250, rerank_candidates=30),
+}
 
-# DeepSeek configuration
-DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
-DEEPSEEK_URL = "https://api.deepseek.com"  # Replace with actual DeepSeek API endpoint
-client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url=DEEPSEEK_URL)
+_hybrid_retriever: Optional[HybridRetriever] = None
+
+def _build_hybrid_retriever() -> None:
+    """Load the precedent corpus, build the BM25 index and load the cross-encoder"""
+    global _hybrid_retriever
+    started = datetime.now()
+    try:
+        # Reading the whole index is background work; it mustn't crowd out user requests
+        with priority(BATCH):
+            if PRECEDENT_SNAPSHOT and os.path.exists(PRECEDENT_SNAPSHOT):
+                corpus = PrecedentCorpus.load(PRECEDENT_SNAPSHOT)
+            else:
+                corpus = PrecedentCorpus.from_pinecone(index)
+        dense_index = ExactSearchIndex(corpus) if DENSE_BACKEND == "exact" else index
+        reranker = CrossEncoderReranker(CROSS_ENCODER_MODEL)
+        reranker.load()
+        _hybrid_retriever = HybridRetriever(corpus, dense_index, reranker)
+        print(f"Hybrid retrieval ready: {len(corpus.ids)} precedents in {datetime.now() - started}")
+    except Exception as e:
+        print(f"Could not build the hybrid retriever, using dense retrieval: {str(e)}")
+
+if HYBRID_RETRIEVAL:
+    threading.Thread(target=_build_hybrid_retriever, daemon=True, name="hybrid-retriever").start()
+
+def retrieve_precedents(claim, query: str, query_embedding: list, endpoint: str, top_k: int = 3) -> list:
+    """Filtered precedent retrieval, hybrid once its index is built and dense-only otherwise"""
+    retriever = _hybrid_retriever
+    if retriever is not None:
+        return query_precedents_hybrid(
+            retriever, query, query_embedding, claim,
+            top_k=top_k, budgets=RETRIEVAL_BUDGETS.get(endpoint),
+        )
+    return query_precedents(index, query_embedding, claim, top_k=top_k)
+
+# Near-identical claims (same condition, treatment and insurer) that retrieve the same
+# precedents reuse the claim-independent part of earlier guidance
+semantic_cache = SemanticCache()
+
+# DeepSeek configuration; identical deterministic requests are served from the completion cache
+llm_client = get_llm_client("deepseek")
 
 async def process_with_deepseek(text: str) -> dict:
     """
@@ -148,49 +195,22 @@ async def process_with_deepseek(text: str) -> dict:
     {text}
     """ 
     
-    payload = {
-        "model": "deepseek-chat",  # Replace with actual model name
-        "messages": [
-            {"role": "system", "content": "You are a helpful assistant that extracts health claim information from documents."},
-            {"role": "user", "content": prompt}
-        ],
-        "temperature": 0.1,
-        "max_tokens": 1000
-    }
-    
     try:
-        response = client.chat.completions.create(
-            model= "deepseek-chat",  # Replace with actual model name
-            messages= [
+        claim = await run_in_threadpool(
+            complete_structured,
+            llm_client,
+            model="deepseek-chat",  # Replace with actual model name
+            messages=[
                 {"role": "system", "content": "You are a helpful assistant that extracts health claim information from documents."},
                 {"role": "user", "content": prompt}
             ],
-            temperature= 0.1,
-            max_tokens= 1000
+            schema=HealthClaim,
+            temperature=0.1,
+            max_tokens=1000
         )
+        return claim.model_dump()
         
-        # Extract the JSON response from DeepSeek's completion
-        extracted_text = response.choices[0].message.content
-
-        # Parse the JSON response
-        try:
-            # If the response is already JSON, use it directly
-            extracted_data = json.loads(extracted_text)
-        except json.JSONDecodeError:
-            # If the response is text, try to extract JSON from it
-            # This is a fallback in case the model returns text with JSON embedded
-            import re
-            json_match = re.search(r'\{.*\}', extracted_text, re.DOTALL)
-            if json_match:
-                extracted_data = json.loads(json_match.group())
-            else:
-                raise ValueError("Could not extract JSON from DeepSeek response")
-        
-        return extracted_data
-        
-    except requests.exceptions.RequestException as e:
-        raise HTTPException(status_code=500, detail=f"Error calling DeepSeek API: {str(e)}")
-    except (KeyError, json.JSONDecodeError) as e:
+    except StructuredOutputError as e:
         raise HTTPException(status_code=500, detail=f"Error processing DeepSeek response: {str(e)}")
 
 # Pydantic models for request/response validation
@@ -201,11 +221,137 @@ class HealthClaim(BaseModel):
     requested_treatment: str
     explanation: str
 
-class AppealGuidance(BaseModel):
+class SharedGuidance(BaseModel):
+    """Guidance that depends only on the case profile and the precedents, so claimants can share it"""
     guidelines: List[str]
     reasoning: str
     summary: str
 
+class AppealGuidance(SharedGuidance):
+    appeal: Optional[str] = None
+
+def extract_guidelines(guidance_text: str) -> List[str]:
+    """Pull "Guideline ..." lines out of the guidance, with generic defaults"""
+    guidelines = [line.strip() for line in guidance_text.split("\n") if line.strip().startswith("Guideline")]
+    if not guidelines:
+        guidelines = ["Demonstrate medical necessity", "Ensure all required documentation is provided", "Justify the requested treatment"]
+    return guidelines
+
+def claim_details(claim: HealthClaim) -> str:
+    return (f"Condition: {claim.condition}\nTreatment: {claim.requested_treatment}\n"
+            f"Provider: {claim.health_insurance_provider}\nExplanation: {claim.explanation}")
+
+def claim_profile(claim: HealthClaim) -> str:
+    """The claim without its free-text explanation: all that guidance shared between claimants is written from"""
+    return (f"Condition: {claim.condition}\nTreatment: {claim.requested_treatment}\n"
+            f"Provider: {claim.health_insurance_provider}")
+
+def profile_scope(claim: HealthClaim) -> str:
+    """Semantic cache scope: shared guidance is only reused for the same condition, treatment and insurer"""
+    return hashlib.sha256(" ".join(claim_profile(claim).lower().split()).encode("utf-8")).hexdigest()
+
+def summarize_guidance(guidance_text: str, system_prompt: str, endpoint: str) -> str:
+    """Patient-friendly summary of generated guidance, trimmed to CONTEXT_GUIDANCE_TOKENS"""
+    context = ContextBuilder(f"{endpoint}/summary")
+    guidance = context.text("guidance", guidance_text, CONTEXT_GUIDANCE_TOKENS)
+    messages = context.messages([
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": "Summarize the following guidance, as well as the appeal as a whole, in a short, patient-friendly summary."},
+        {"role": "user", "content": guidance}
+    ])
+    context.report.record()
+    return llm_client.complete(
+        model="deepseek-chat",
+        messages=messages,
+        temperature=0.1,
+        max_tokens=1000
+    )
+
+def draft_appeal(claim: HealthClaim, guidance_text: str, endpoint: str) -> str:
+    """
+    Updated appeal letter for one claim
+
+    The only patient-specific output, so it is written for every request,
+    from the (possibly shared) guidance and this claim's full details.
+    """
+    context = ContextBuilder(f"{endpoint}/appeal")
+    guidance = context.text("guidance", guidance_text, CONTEXT_GUIDANCE_TOKENS)
+    details = context.text("claim", claim_details(claim))
+    messages = context.messages([
+        {"role": "system", "content": "You are a health insurance claims expert."},
+        {"role": "user", "content": "Provide a complete, updated appeal letter based on the guidance and the original appeal."},
+        {"role": "user", "content": guidance},
+        {"role": "user", "content": details}
+    ])
+    context.report.record()
+    return llm_client.complete(
+        model="deepseek-chat",
+        messages=messages,
+        temperature=0.1,
+        max_tokens=8192
+    )
+
+# "multi": guidance and summary in two calls (default).
+# "single": one JSON completion with both, falling back to "multi" if it doesn't validate.
+# Either way the appeal letter is drafted in its own call, per claim.
+GUIDANCE_MODE = os.getenv("GUIDANCE_MODE", "multi")
+
+SINGLE_CALL_INSTRUCTIONS = """
+Respond with a single JSON object and nothing else, with exactly these keys:
+- "guidelines": a list of short, actionable guideline strings, each starting with "Guideline"
+- "reasoning": the full guidance described above
+- "summary": a short, patient-friendly summary of the guidance and the appeal as a whole
+JSON schema:
+""" + json.dumps(SharedGuidance.model_json_schema())
+
+def generate_guidance_single(messages: List[dict]) -> Optional[SharedGuidance]:
+    """
+    Guidance and summary from one JSON-mode completion
+
+    Returns:
+        The validated guidance, or None if the response doesn't match the schema
+    """
+    messages = messages[:-1] + [
+        {"role": messages[-1]["role"], "content": messages[-1]["content"] + SINGLE_CALL_INSTRUCTIONS}
+    ]
+    try:
+        guidance = complete_structured(
+            llm_client,
+            model="deepseek-chat",
+            messages=messages,
+            schema=SharedGuidance,
+            max_reprompts=0,
+            temperature=0.1,
+            max_tokens=8192,
+            response_format={"type": "json_object"}
+        )
+    except StructuredOutputError as e:
+        print(f"Single-call guidance did not match the schema, falling back to multi-call: {e}")
+        return None
+    if not guidance.guidelines:
+        guidance.guidelines = extract_guidelines(guidance.reasoning)
+    return guidance
+
+def generate_shared_guidance(messages: List[dict], system_prompt: str, endpoint: str,
+                             mode: Optional[str] = None) -> SharedGuidance:
+    """Guidelines, reasoning and summary for a claim-independent guidance prompt"""
+    if (mode or GUIDANCE_MODE) == "single":
+        guidance = generate_guidance_single(messages)
+        if guidance is not None:
+            return guidance
+
+    guidance_text = llm_client.complete(
+        model="deepseek-chat",
+        messages=messages,
+        temperature=0.1,
+        max_tokens=8192
+    )
+    return SharedGuidance(
+        guidelines=extract_guidelines(guidance_text),
+        reasoning=guidance_text,
+        summary=summarize_guidance(guidance_text, system_prompt, endpoint)
+    )
+
 @app.post("/process-pdfs", response_model=List[HealthClaim])
 async def process_pdfs(files: List[UploadFile] = File(...)):
     """
@@ -221,13 +367,15 @@ async def process_pdfs(files: List[UploadFile] = File(...)):
         
         # Read PDF content
         contents = await file.read()
-        pdf_file = io.BytesIO(contents)
-        pdf_reader = PyPDF2.PdfReader(pdf_file)
-        
-        # Extract text from PDF
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text()
+        with span("pdf.extract_text", **{"payload.request_bytes": len(contents)}) as s:
+            pdf_file = io.BytesIO(contents)
+            pdf_reader = PyPDF2.PdfReader(pdf_file)
+
+            # Extract text from PDF
+            text = ""
+            for page in pdf_reader.pages:
+                text += page.extract_text()
+            s.set("pdf.pages", len(pdf_reader.pages))
         
         # Process text with DeepSeek
         try:
@@ -240,7 +388,7 @@ async def process_pdfs(files: List[UploadFile] = File(...)):
     return results
 
 @app.post("/get-appeal-guidance", response_model=AppealGuidance)
-async def get_appeal_guidance(claim: HealthClaim):
+async def get_appeal_guidance(claim: HealthClaim, mode: Optional[str] = Query(None, description="single or multi")):
     """
     Provide guidelines for improving the appeal using RAG with Pinecone database.
     """
@@ -252,90 +400,52 @@ async def get_appeal_guidance(claim: HealthClaim):
     Explanation: {claim.explanation}
     """
     
-    # Get embeddings directly from Jina API
-    query_embedding = get_embedding(query)    
-    
-    # Query Pinecone
-    query_results = index.query(
-        vector=query_embedding,
-        top_k=3,
-        include_metadata=True
-    )
-    
-    # Process results and format response
-    contexts = [item['metadata'] for item in query_results['matches']]
+    # Get embeddings directly from Jina API. Provider calls wait on the rate limiter, so
+    # they run in the threadpool rather than on the event loop
+    query_embedding = await run_in_threadpool(get_embedding, query)
     
-    # Pass contexts to DeepSeek for generating guidance
-    combined_context = "\n\n".join(json.dumps(context) for context in contexts)
-    
-    prompt = f"""
+    # Query Pinecone, filtered to precedents matching this claim's condition/coverage
+    matches = await run_in_threadpool(retrieve_precedents, claim, query, query_embedding, "appeal-guidance")
+    precedent_ids = [item['id'] for item in matches]
+
+    scope = profile_scope(claim)
+    with span("semantic_cache.lookup", **{"cache.endpoint": "appeal-guidance"}) as s:
+        shared = semantic_cache.lookup("appeal-guidance", query_embedding, precedent_ids, scope)
+        s.set("cache.hit", shared is not None)
+
+    system_prompt = "You are a health insurance claims expert."
+    if shared is None:
+        # Deduplicated, token-budgeted precedents and the claim's profile, without its
+        # explanation, so the guidance can be reused for other claimants
+        context = ContextBuilder("appeal-guidance")
+        combined_context = context.precedents("precedents", matches)
+        profile = context.text("claim", claim_profile(claim))
+
+        prompt = f"""
     Based on the following reference information about health claims:
     {combined_context}
     
     Provide appeal guidance for this claim:
-    Condition: {claim.condition}
-    Treatment: {claim.requested_treatment}
-    Provider: {claim.health_insurance_provider}
-    Explanation: {claim.explanation}
+    {profile}
     
     Give specific, actionable guidance for improving the appeal. Use the reference information to identify similar cases and provide examples.
     """
-    
-    response = client.chat.completions.create(
-        model="deepseek-chat",
-        messages=[
-            {"role": "system", "content": "You are a health insurance claims expert."},
-            {"role": "user", "content": prompt},
-        ],
-        temperature=0.1,
-        max_tokens=8192
-    )
-    
-    print(response.choices)
-    guidance_text = response.choices[0].message.content
 
-    response = client.chat.completions.create(
-        model="deepseek-chat",
-        messages=[
-            {"role": "system", "content": "You are a health insurance claims expert."},
-            {"role": "user", "content": "Summarize the following guidance, as well as the appeal as a whole, in a short, patient-friendly summary."},
-            {"role": "user", "content": guidance_text}
-        ],
-        temperature=0.1,
-        max_tokens=1000
-    )
+        messages = context.messages([
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt},
+        ])
+        context.report.record()
 
-    summary = response.choices[0].message.content
+        shared = await run_in_threadpool(generate_shared_guidance, messages, system_prompt, "appeal-guidance", mode)
+        semantic_cache.store("appeal-guidance", query_embedding, precedent_ids, shared, scope)
 
-    response = client.chat.completions.create(
-        model="deepseek-chat",
-        messages=[
-            {"role": "system", "content": "You are a health insurance claims expert."},
-            {"role": "user", "content": "Provide a complete, updated appeal letter based on the guidance and the original appeal."},
-            {"role": "user", "content": guidance_text},
-            {"role": "user", "content": (f"Condition: {claim.condition}\nTreatment: {claim.requested_treatment}\nProvider: {claim.health_insurance_provider}\nExplanation: {claim.explanation}")}
-        ],
-        temperature=0.1,
-        max_tokens=8192
-    )
-
-    appeal_text = response.choices[0].message.content
-
-    
-    # Extract guidelines (assuming DeepSeek returns them in a list format)
-    guidelines = [line.strip() for line in guidance_text.split("\n") if line.strip().startswith("Guideline")]
-    if not guidelines:
-        guidelines = ["Demonstrate medical necessity", "Ensure all required documentation is provided", "Justify the requested treatment"]
-    
-    return AppealGuidance(
-        guidelines=guidelines,
-        reasoning=guidance_text,
-        summary=summary,
-        appeal=appeal_text  
-    )
+    # The appeal letter carries this claim's details: always written for this request
+    appeal_text = await run_in_threadpool(draft_appeal, claim, shared.reasoning, "appeal-guidance")
+    return AppealGuidance(**shared.model_dump(), appeal=appeal_text)
 
 @app.post("/get-legal-sourcing-guidance", response_model=AppealGuidance)
-async def get_legal_sourcing_guidance(claim: HealthClaim):
+async def get_legal_sourcing_guidance(claim: HealthClaim, mode: Optional[str] = Query(None, description="single or multi")):
     """
     Provide legal sourcing guidance using RAG with both Pinecone databases.
     """
@@ -347,39 +457,42 @@ async def get_legal_sourcing_guidance(claim: HealthClaim):
     Explanation: {claim.explanation}
     """
     
-    # Get embeddings directly from Jina API
-    query_embedding = get_embedding(query)    
+    # Get embeddings directly from Jina API. Provider calls wait on the rate limiter, so
+    # they run in the threadpool rather than on the event loop
+    query_embedding = await run_in_threadpool(get_embedding, query)
     
-    # Query both Pinecone indexes
-    health_results = index.query(
-        vector=query_embedding,
-        top_k=3,
-        include_metadata=True
-    )
+    # Query both Pinecone indexes; only the health index carries claim metadata to filter on
+    health_matches = await run_in_threadpool(retrieve_precedents, claim, query, query_embedding, "legal-sourcing")
     
-    legal_results = legal_index.query(
+    legal_results = await run_in_threadpool(
+        legal_index.query,
         vector=query_embedding,
         top_k=3,
         include_metadata=True
     )
-    
-    # Process results and format response
-    health_contexts = [item['metadata'] for item in health_results['matches']]
-    legal_contexts = [item['metadata'] for item in legal_results['matches']]
-    
-    # Combine contexts
-    combined_context = "\n\nHealth Claims Context:\n" + "\n\n".join(json.dumps(context) for context in health_contexts)
-    combined_context += "\n\nLegal Sourcing Context:\n" + "\n\n".join(json.dumps(context) for context in legal_contexts)
-    
-    prompt = f"""
+    precedent_ids = [item['id'] for item in health_matches] + [f"legal:{item['id']}" for item in legal_results['matches']]
+
+    scope = profile_scope(claim)
+    with span("semantic_cache.lookup", **{"cache.endpoint": "legal-sourcing"}) as s:
+        shared = semantic_cache.lookup("legal-sourcing", query_embedding, precedent_ids, scope)
+        s.set("cache.hit", shared is not None)
+
+    system_prompt = "You are a legal expert specializing in health insurance claims and appeals."
+    if shared is None:
+        # Combine deduplicated, token-budgeted contexts; the claim enters as its profile only,
+        # so the guidance can be reused for other claimants
+        context = ContextBuilder("legal-sourcing")
+        health_context = context.precedents("precedents", health_matches)
+        legal_context = context.precedents("legal", legal_results['matches'], budget_tokens=CONTEXT_LEGAL_TOKENS)
+        combined_context = f"Health Claims Context:\n{health_context}\n\nLegal Sourcing Context:\n{legal_context}"
+        profile = context.text("claim", claim_profile(claim))
+
+        prompt = f"""
     Based on the following reference information about health claims and legal precedents:
     {combined_context}
     
     Provide legal sourcing guidance for this claim:
-    Condition: {claim.condition}
-    Treatment: {claim.requested_treatment}
-    Provider: {claim.health_insurance_provider}
-    Explanation: {claim.explanation}
+    {profile}
     
     Give specific, actionable guidance for:
     1. Legal precedents that support this claim
@@ -389,55 +502,51 @@ async def get_legal_sourcing_guidance(claim: HealthClaim):
     
     Use both the health claims and legal sourcing contexts to provide comprehensive guidance.
     """
-    
-    response = client.chat.completions.create(
-        model="deepseek-chat",
-        messages=[
-            {"role": "system", "content": "You are a legal expert specializing in health insurance claims and appeals."},
-            {"role": "user", "content": prompt},
-        ],
-        temperature=0.1,
-        max_tokens=8192
-    )
-    
-    guidance_text = response.choices[0].message.content
-
-    response = client.chat.completions.create(
-        model="deepseek-chat",
-        messages=[
-            {"role": "system", "content": "You are a legal expert specializing in health insurance claims and appeals."},
-            {"role": "user", "content": "Summarize the following guidance, as well as the appeal as a whole, in a short, patient-friendly summary."},
-            {"role": "user", "content": guidance_text}
-        ],
-        temperature=0.1,
-        max_tokens=1000
-    )
-
-    summary = response.choices[0].message.content
-
-
-    response = client.chat.completions.create(
-        model="deepseek-chat",
-        messages=[
-            {"role": "system", "content": "You are a health insurance claims expert."},
-            {"role": "user", "content": "Provide a complete, updated appeal letter based on the guidance and the original appeal."},
-            {"role": "user", "content": guidance_text},
-            {"role": "user", "content": (f"Condition: {claim.condition}\nTreatment: {claim.requested_treatment}\nProvider: {claim.health_insurance_provider}\nExplanation: {claim.explanation}")}
-        ],
-        temperature=0.1,
-        max_tokens=8192
-    )
 
-    appeal_text = response.choices[0].message.content
-
-    
-    
-    return AppealGuidance(
-        guidelines=guidelines,
-        reasoning=guidance_text,
-        summary=summary,
-        appeal=appeal_text  
-    )
+        messages = context.messages([
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt},
+        ])
+        context.report.record()
+
+        shared = await run_in_threadpool(generate_shared_guidance, messages, system_prompt, "legal-sourcing", mode)
+        semantic_cache.store("legal-sourcing", query_embedding, precedent_ids, shared, scope)
+
+    # The appeal letter carries this claim's details: always written for this request
+    appeal_text = await run_in_threadpool(draft_appeal, claim, shared.reasoning, "legal-sourcing")
+    return AppealGuidance(**shared.model_dump(), appeal=appeal_text)
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Hit rates of the semantic guidance cache (per endpoint), the LLM completion cache and the claim cache"""
+    return {"semantic": semantic_cache.stats(), "llm": llm_stats(), "claims": claim_cache.stats()}
+
+@app.get("/debug/traces")
+async def debug_traces(
+    limit: int = Query(50, ge=1, le=500),
+    name: Optional[str] = Query(None, description="Only traces whose root span name contains this"),
+    min_duration_ms: float = Query(0.0, ge=0)
+):
+    """Most recent request traces (newest first) with all their spans"""
+    return trace_buffer.recent(limit=limit, name=name, min_duration_ms=min_duration_ms)
+
+@app.get("/debug/traces/{trace_id}")
+async def debug_trace(trace_id: str):
+    """One trace from the ring buffer"""
+    trace = trace_buffer.get(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Trace not found (it may have been evicted)")
+    return trace
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Span latency histograms and payload / token / cache counters in Prometheus format"""
+    return render_prometheus()
+
+@app.get("/rate-limits/stats")
+async def rate_limit_stats():
+    """Concurrency limit, queue depth per priority lane and throttling counts for each AI provider"""
+    return scheduler_stats()
 
 @app.post("/direct-upload")
 async def direct_upload(
@@ -450,113 +559,64 @@ async def direct_upload(
     """
     print(f"Received direct upload request: claim={claim_id}, user={user_id}, files={len(files)}")
     
-    # Check if claim exists when claim_id is provided
+    # Check if claim exists when claim_id is provided (claimId or _id, one cached lookup)
+    resolved = None
     if claim_id:
         try:
-            # Try with ObjectId first
-            try:
-                claim = mongo_db.claims.find_one({"_id": ObjectId(claim_id)})
-            except:
-                claim = mongo_db.claims.find_one({"_id": claim_id})
-                
-            if not claim:
-                claim = mongo_db.claims.find_one({"claimId": claim_id})
-                
-            if not claim:
-                return {"error": f"Claim {claim_id} not found"}
+            resolved = await run_in_threadpool(claim_resolver.resolve, claim_id)
         except Exception as e:
             print(f"Error checking claim: {str(e)}")
             return {"error": f"Error checking claim: {str(e)}"}
+        if not resolved:
+            return {"error": f"Claim {claim_id} not found"}
+        # Files are recorded against the canonical claimId, so claim file listings find them
+        claim_id = resolved.claim_id or claim_id
     
     # Process files
     file_ids = []
     file_details = []
     
     try:
-        fs = mongo_db.fs
-        
-        for file in files:
-            # Read file content
-            content = await file.read()
-            
-            # Create file metadata
-            filename = file.filename
-            content_type = file.content_type or "application/octet-stream"
-            
-            metadata = {
-                "filename": filename,
-                "content_type": content_type,
-                "uploaded_at": datetime.now(),
-            }
-            
-            if claim_id:
-                metadata["claim_id"] = claim_id
-            
-            if user_id:
-                metadata["user_id"] = user_id
-            
-            # Insert file into GridFS
-            file_id = fs.files.insert_one({
-                "filename": filename,
-                "chunkSize": 261120,
-                "uploadDate": datetime.now(),
-                "metadata": metadata
-            }).inserted_id
-            
-            # Split content into chunks
-            chunk_size = 261120  # Default GridFS chunk size
-            chunks = [content[i:i+chunk_size] for i in range(0, len(content), chunk_size)]
-            
-            # Insert chunks
-            for i, chunk in enumerate(chunks):
-                fs.chunks.insert_one({
-                    "files_id": file_id,
-                    "n": i,
-                    "data": chunk
-                })
-            
-            # Reset file pointer
-            await file.seek(0)
-            
-            # Add file ID to list
-            file_id_str = str(file_id)
-            file_ids.append(file_id_str)
+        # Identical content is stored once; repeat uploads only add a reference. Files are
+        # stored in parallel and a failed one doesn't fail the others.
+        results = await FileStorage.save_files(files, claim_id, user_id)
+        failed = []
+        for saved in results:
+            if not saved["success"]:
+                failed.append({"filename": saved["filename"], "error": saved["error"]})
+                continue
+            file_ids.append(saved["file_id"])
             
             # Add file details
             file_details.append({
-                "file_id": file_id_str,
-                "filename": filename,
-                "content_type": content_type,
-                "size": len(content)
+                "file_id": saved["file_id"],
+                "filename": saved["filename"],
+                "content_type": saved["content_type"],
+                "size": saved["size"],
+                "deduplicated": saved["deduplicated"]
             })
             
-            print(f"Successfully uploaded file {filename} with ID {file_id_str}")
+            print(f"Successfully uploaded file {saved['filename']} with ID {saved['file_id']}")
         
         # Update claim record with file IDs if a claim ID was provided
-        if claim_id and file_ids:
+        if resolved and file_ids:
             try:
-                # Determine the correct _id format
-                claim_query = None
-                try:
-                    obj_id = ObjectId(claim_id)
-                    claim_query = {"_id": obj_id}
-                except:
-                    claim_query = {"_id": claim_id}
-                
-                # Try to update the claim
-                update_result = mongo_db.claims.update_one(
-                    claim_query,
+                update_result = await run_in_threadpool(
+                    mongo_db.claims.update_one,
+                    resolved.query,
                     {"$push": {"service.uploadedFiles": {"$each": file_ids}}}
                 )
-                
-                if update_result.modified_count == 0:
-                    # Try with claimId field as fallback
-                    update_result = mongo_db.claims.update_one(
-                        {"claimId": claim_id},
-                        {"$push": {"service.uploadedFiles": {"$each": file_ids}}}
-                    )
-                
-                print(f"Updated claim {claim_id} with {len(file_ids)} files")
+                if update_result.matched_count == 0:
+                    # Deleted since it was resolved: don't leave unreachable files (and blob
+                    # references) behind
+                    claim_resolver.forget(claim_id)
+                    for file_id in file_ids:
+                        if not await FileStorage.delete_file(file_id):
+                            print(f"Could not delete file {file_id} of missing claim {claim_id}")
+                    return {"error": f"Claim {claim_id} not found"}
+                else:
+                    claim_cache.invalidate(claim_id)
+                    print(f"Updated claim {claim_id} with {len(file_ids)} files")
             except Exception as e:
                 print(f"Error updating claim: {str(e)}")
         
@@ -564,6 +624,7 @@ async def direct_upload(
             "success": True,
             "file_ids": file_ids,
             "files": file_details,
+            "failed": failed,
             "message": f"Successfully uploaded {len(file_ids)} files"
         }
         
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Move stored file content between blob backends, in parallel.
+
+* Content-addressed blobs (file_blobs) not yet in the target backend are
+  copied as stored (already compressed), their size is checked, the blob
+  record is switched to the new location, and the old copy is deleted.
+* Files from before content addressing (fs.files with an ObjectId _id) are
+  converted: hashed, stored once in the target backend (deduplicated and
+  compressed like new uploads) and given a file_refs entry with the same
+  ObjectId, so claims' uploadedFiles keep working; the GridFS copy is then
+  deleted.
+
+Usage:
+    python migrate_blobs.py --to local --workers 8 --dry-run
+    python migrate_blobs.py --to s3 --workers 16 --limit 1000
+"""
+
+import argparse
+import hashlib
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Optional
+
+from blob_store import COLD_BACKENDS, FILE_BLOB_BACKEND, GRIDFS, get_blob_store
+from database import get_db
+from file_storage import (
+    BLOB_READY, FILE_BLOBS_COLLECTION, FILE_REFS_COLLECTION, acquire_blob_sync, blob_location, delete_legacy_file,
+    open_file_chunks, relocate_blob, release_blob,
+)
+
+SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+
+
+def migrate_blob(db, blob: Dict[str, Any], target: str, keep_source: bool = False) -> int:
+    """
+    Copy one content-addressed blob, as stored, to the target backend and switch its record
+
+    Returns:
+        Bytes moved (0 if the blob changed meanwhile and was left alone)
+    """
+    source_store, source_key = blob_location(blob)
+    return relocate_blob(db, blob, get_blob_store(target), source_store.open(source_key),
+                         expected_size=blob.get("stored_size"), keep_source=keep_source)
+
+
+def migrate_legacy_file(db, file_doc: Dict[str, Any], target: str, keep_source: bool = False) -> int:
+    """
+    Convert one pre-content-addressing GridFS file into a reference to a deduplicated blob
+
+    Returns:
+        Bytes of content migrated (0 if the file was already converted)
+    """
+    refs = db[FILE_REFS_COLLECTION]
+    if refs.find_one({"_id": file_doc["_id"]}, {"_id": 1}):
+        return 0
+    metadata = file_doc.get("metadata") or {}
+    # Reads archived stubs from cold storage too, which retention.py uses to rehydrate them
+    chunks = open_file_chunks(db, str(file_doc["_id"]))
+    if chunks is None:
+        raise KeyError(f"Content of file {file_doc['_id']} is missing")
+
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY) as spool:
+        digest = hashlib.sha256()
+        size = 0
+        for data in chunks:
+            digest.update(data)
+            spool.write(data)
+            size += len(data)
+        if file_doc.get("length") is not None and size != file_doc["length"]:
+            # Chunks deleted mid-read, e.g. retention.py archived the file meanwhile
+            raise RuntimeError(f"Read {size} of {file_doc['length']} bytes of file {file_doc['_id']}")
+        spool.seek(0)
+        sha256 = digest.hexdigest()
+        content_type = metadata.get("content_type", "application/octet-stream")
+        acquire_blob_sync(db, sha256, size, spool, content_type, backend=target)
+
+    ref = {
+        "_id": file_doc["_id"],
+        "sha256": sha256,
+        "filename": file_doc.get("filename") or metadata.get("filename", "unknown"),
+        "content_type": content_type,
+        "size": size,
+        "claim_id": metadata.get("claim_id"),
+        "uploaded_at": metadata.get("uploaded_at") or file_doc.get("uploadDate"),
+        "migrated_from": GRIDFS,
+    }
+    if metadata.get("user_id"):
+        ref["user_id"] = metadata["user_id"]
+    try:
+        refs.insert_one(ref)
+    except Exception:
+        release_blob(db, sha256)
+        raise
+    if not keep_source:
+        delete_legacy_file(db, file_doc["_id"])
+    return size
+
+
+def run(target: str, workers: int = 8, limit: Optional[int] = None, dry_run: bool = False,
+        include_legacy: bool = True, keep_source: bool = False) -> Dict[str, Any]:
+    db = get_db()
+    # Archived (cold) content stays where retention.py put it; records without a backend are in GridFS
+    excluded = [target, *COLD_BACKENDS] + ([None] if target == GRIDFS else [])
+    blobs = list(db[FILE_BLOBS_COLLECTION].find(
+        {"state": BLOB_READY, "backend": {"$nin": excluded}},
+        limit=limit or 0,
+    ))
+    legacy = []
+    if include_legacy:
+        legacy = list(db.fs.files.find(
+            {"metadata.content_addressed": {"$ne": True}, "metadata.archive": {"$exists": False},
+             "_id": {"$type": "objectId"}},
+            {"filename": 1, "length": 1, "metadata": 1, "uploadDate": 1},
+            limit=limit or 0,
+        ))
+
+    report: Dict[str, Any] = {
+        "target": target,
+        "blobs": len(blobs),
+        "blob_bytes": sum(blob.get("stored_size") or blob.get("size") or 0 for blob in blobs),
+        "legacy_files": len(legacy),
+        "legacy_bytes": sum(file_doc.get("length") or 0 for file_doc in legacy),
+        "dry_run": dry_run,
+    }
+    if dry_run:
+        return report
+
+    started = time.perf_counter()
+    moved = 0
+    failures = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(migrate_blob, db, blob, target, keep_source): blob["_id"] for blob in blobs}
+        futures.update({
+            executor.submit(migrate_legacy_file, db, file_doc, target, keep_source): str(file_doc["_id"])
+            for file_doc in legacy
+        })
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                moved += future.result()
+            except Exception as e:
+                failures.append({"id": futures[future], "error": str(e)})
+                print(f"Error migrating {futures[future]}: {e}")
+            if done % 100 == 0:
+                print(f"{done}/{len(futures)} migrated")
+
+    elapsed = time.perf_counter() - started
+    report.update({
+        "bytes_moved": moved,
+        "failures": failures,
+        "seconds": round(elapsed, 2),
+        "mb_per_s": round(moved / (1024 * 1024) / elapsed, 2) if elapsed else 0.0,
+    })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move stored claim file content to another blob backend")
+    parser.add_argument("--to", dest="target", default=FILE_BLOB_BACKEND, choices=["gridfs", "local", "s3"])
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--limit", type=int, help="At most this many blobs (and legacy files)")
+    parser.add_argument("--skip-legacy", action="store_true", help="Leave pre-content-addressing GridFS files alone")
+    parser.add_argument("--keep-source", action="store_true", help="Don't delete the old copies")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would move")
+    args = parser.parse_args()
+
+    report = run(args.target, args.workers, args.limit, args.dry_run, not args.skip_legacy, args.keep_source)
+    for key, value in report.items():
+        if key != "failures":
+            print(f"{key}: {value}")
+    if report.get("failures"):
+        print(f"failures: {len(report['failures'])}")
+
+
+if __name__ == "__main__":
+    main()
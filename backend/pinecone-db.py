@@ -6,6 +6,9 @@ import pinecone
 from dotenv import load_dotenv
 from pinecone import ServerlessSpec
 
+from embedding_client import get_embedding
+from rate_limiter import BATCH, RateLimitedIndex, use_priority
+
 # Load environment variables from .env file
 load_dotenv()
 JINA_API_KEY = os.getenv("JINA_API_KEY")
@@ -43,42 +46,10 @@ if True:
             )
         )
 
-    # Connect to the created index
-    index = pc.Index(index_name)
-
-    # Jina AI setup
-    JINA_URL = "https://api.jina.ai/v1/embeddings"
-
-    HEADERS = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {JINA_API_KEY}"
-    }
-
-    def get_embedding(text: str) -> list[float]:
-        payload = {
-            "model": "jina-clip-v2",
-            "input": [text],
-            "normalized": False
-        }
-        resp = requests.post(JINA_URL, headers=HEADERS, json=payload)
-        print(resp.content)
-        print(f"Response received from Jina AI, status: {resp.status_code}")
-        json_resp = resp.json()
-        print(f"Full response: {json_resp}")
-        
-        if "data" not in json_resp:
-            print(f"Error: Response missing 'data' key. Full response: {json_resp}")
-            if "error" in json_resp:
-                print(f"API Error: {json_resp['error']}")
-            raise KeyError(f"Response missing 'data' key. Full response: {json_resp}")
-        
-        if not json_resp["data"]:
-            raise ValueError("Response data is empty")
-        
-        if "embedding" not in json_resp["data"][0]:
-            raise KeyError(f"Response missing 'embedding' key. Data: {json_resp['data'][0]}")
-        
-        return json_resp["data"][0]["embedding"]
+    # Connect to the created index. This is a bulk ingest: run in the batch lane so
+    # the API's interactive requests keep priority on the shared Jina / Pinecone keys
+    use_priority(BATCH)
+    index = RateLimitedIndex(pc.Index(index_name), name=index_name)
 
     print("Testing Jina AI connection...")
     test_embedding = get_embedding("Test embedding")
@@ -117,6 +88,8 @@ if True:
         metadata = {
             "decision": rec.get("Decision", "") or "",
             "decision_date": dt,
+            # Numeric copy of the decision date: Pinecone range filters only work on numbers
+            "decision_ts": int(rec["Decision Date"] / 1000),
             "condition": rec.get("Condition", "") or "",
             "treatment": rec.get("Treatment", "") or "",
             "coverage_type": rec.get("Coverage Type", "") or "",
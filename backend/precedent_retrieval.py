@@ -0,0 +1,207 @@
+"""
+Metadata-filtered precedent retrieval.
+
+Precedent vectors written by pinecone-db.py carry ``condition``,
+``coverage_type``, ``decision``, ``decision_date`` and ``decision_ts``
+metadata. This module derives a Pinecone filter from a claim (condition,
+insurer -> coverage type, recency window) and pushes it down into the vector
+query, relaxing the filter step by step when too few precedents match.
+
+Vectors indexed before ``decision_ts`` existed only have ``decision_date``;
+backfill_decision_ts.py adds the numeric field, after which the recency
+window can be enabled with PRECEDENT_RECENCY_YEARS.
+"""
+
+import json
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from pydantic import BaseModel
+
+# How far back precedents are considered relevant before widening. Off by default:
+# vectors indexed before decision_ts was added don't have it and would never match
+# the recency clause, so set this only once backfill_decision_ts.py has run
+PRECEDENT_RECENCY_YEARS = float(os.getenv("PRECEDENT_RECENCY_YEARS", "0"))
+
+# Claim condition (as extracted by process_with_deepseek) -> metadata values
+CONDITION_ALIASES: Dict[str, List[str]] = {
+    "mental health": ["Mental Health"],
+    "substance abuse/ addiction": ["Substance Abuse/ Addiction", "Substance Abuse", "Addiction"],
+    "substance abuse": ["Substance Abuse/ Addiction", "Substance Abuse"],
+    "addiction": ["Substance Abuse/ Addiction", "Addiction"],
+}
+
+# Insurer name keyword -> coverage_type metadata value. Insurers that match no
+# keyword get no coverage filter rather than a guessed one.
+# Override with a JSON object in COVERAGE_TYPE_MAP.
+COVERAGE_TYPE_KEYWORDS: Dict[str, str] = json.loads(os.getenv("COVERAGE_TYPE_MAP", "null") or "null") or {
+    "medicaid": "Medicaid",
+    "medi-cal": "Medicaid",
+    "medicare": "Medicare",
+    "essential plan": "Essential Plan",
+    "child health plus": "Child Health Plus",
+}
+
+SECONDS_PER_YEAR = 365.25 * 24 * 3600
+
+
+class PrecedentFilters(BaseModel):
+    """Metadata constraints for a precedent query; unset fields are not filtered on"""
+    conditions: Optional[List[str]] = None
+    coverage_type: Optional[str] = None
+    min_decision_ts: Optional[int] = None
+
+    def to_pinecone(self) -> Optional[Dict[str, Any]]:
+        """Render as a Pinecone metadata filter (None when nothing is constrained)"""
+        clauses = []
+        if self.conditions:
+            clauses.append({"condition": {"$in": self.conditions}})
+        if self.coverage_type:
+            clauses.append({"coverage_type": {"$eq": self.coverage_type}})
+        if self.min_decision_ts is not None:
+            clauses.append({"decision_ts": {"$gte": self.min_decision_ts}})
+        if not clauses:
+            return None
+        return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+    def widening_steps(self) -> List["PrecedentFilters"]:
+        """
+        This filter followed by progressively looser ones: drop the recency
+        window, then the coverage type, then the condition (unfiltered).
+        """
+        steps = [self]
+        current = self
+        for field in ("min_decision_ts", "coverage_type", "conditions"):
+            if getattr(current, field) is not None:
+                current = current.model_copy(update={field: None})
+                steps.append(current)
+        return steps
+
+
+def _condition_values(condition: str) -> Optional[List[str]]:
+    normalized = condition.strip().strip("[]").strip()
+    if not normalized:
+        return None
+    aliases = CONDITION_ALIASES.get(normalized.lower())
+    if aliases:
+        return aliases
+    return [normalized]
+
+
+def coverage_type_for_insurer(insurer: Optional[str]) -> Optional[str]:
+    """Map an insurer name to a precedent coverage_type, or None if unknown"""
+    if not insurer:
+        return None
+    lowered = insurer.lower()
+    for keyword, coverage_type in COVERAGE_TYPE_KEYWORDS.items():
+        if keyword in lowered:
+            return coverage_type
+    return None
+
+
+def filters_for_claim(claim, recency_years: Optional[float] = PRECEDENT_RECENCY_YEARS) -> PrecedentFilters:
+    """
+    Derive precedent filters from a claim
+
+    Args:
+        claim: Anything with ``condition`` and ``health_insurance_provider``
+            attributes (e.g. ``HealthClaim``)
+        recency_years: Only consider precedents decided this recently; None disables
+
+    Returns:
+        The strictest filter for this claim
+    """
+    min_ts = None
+    if recency_years:
+        min_ts = int(time.time() - recency_years * SECONDS_PER_YEAR)
+    return PrecedentFilters(
+        conditions=_condition_values(getattr(claim, "condition", "") or ""),
+        coverage_type=coverage_type_for_insurer(getattr(claim, "health_insurance_provider", None)),
+        min_decision_ts=min_ts,
+    )
+
+
+def search_with_widening(
+    search: Callable[[Optional[Dict[str, Any]], int], List[Any]],
+    filters: PrecedentFilters,
+    top_k: int,
+    min_matches: Optional[int] = None,
+    key: Callable[[Any], Any] = lambda match: match["id"],
+) -> List[Any]:
+    """
+    Run ``search`` with each widening step until enough results are collected
+
+    Results from stricter filters are kept first; looser steps only fill the
+    remaining slots.
+
+    Args:
+        search: Called as ``search(pinecone_filter, k)``; returns a ranked list
+        filters: The strictest filter to start from
+        top_k: Number of results wanted
+        min_matches: Stop widening once this many are found (defaults to top_k)
+        key: Identity of a result, used to drop duplicates across steps
+
+    Returns:
+        Up to ``top_k`` results
+    """
+    min_matches = top_k if min_matches is None else min(min_matches, top_k)
+    results: List[Any] = []
+    seen = set()
+    for step in filters.widening_steps():
+        for match in search(step.to_pinecone(), top_k):
+            match_key = key(match)
+            if match_key not in seen:
+                seen.add(match_key)
+                results.append(match)
+        if len(results) >= min_matches:
+            break
+    return results[:top_k]
+
+
+def query_precedents(index, vector: List[float], claim, top_k: int = 3,
+                     min_matches: Optional[int] = None, namespace: str = "") -> List[Dict[str, Any]]:
+    """
+    Filtered top-k query against a Pinecone-style index for a claim
+
+    Args:
+        index: ``pinecone.Index`` (or anything with the same ``query`` method)
+        vector: The claim's query embedding
+        claim: The claim the filters are derived from
+        top_k: Number of precedents to return
+        min_matches: Widen the filter until at least this many match
+        namespace: Pinecone namespace
+
+    Returns:
+        Matches, each with ``id``, ``score`` and ``metadata``
+    """
+    def _search(pinecone_filter, k):
+        result = index.query(
+            vector=vector,
+            top_k=k,
+            include_metadata=True,
+            filter=pinecone_filter,
+            namespace=namespace,
+        )
+        return list(result["matches"])
+
+    return search_with_widening(_search, filters_for_claim(claim), top_k, min_matches)
+
+
+def query_precedents_hybrid(retriever, query: str, vector: List[float], claim, top_k: int = 3,
+                            budgets=None, min_matches: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Like ``query_precedents``, but through a ``hybrid_retrieval.HybridRetriever``
+
+    The widening steps only gather fused candidates; the cross-encoder then
+    re-ranks all of them in one pass rather than once per step.
+    """
+    groups: List[List[Dict[str, Any]]] = []
+
+    def _search(pinecone_filter, k):
+        candidates = retriever.candidates(query, vector, budgets=budgets, filter=pinecone_filter)
+        groups.append(candidates)
+        return candidates[:k]
+
+    search_with_widening(_search, filters_for_claim(claim), top_k, min_matches)
+    return retriever.rank(query, groups, top_k=top_k, budgets=budgets)
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+"""
+Exact (brute-force) cosine search over the precedent corpus.
+
+Loads every vector of a Pinecone index into one contiguous float32 matrix and
+answers top-k queries with a single matrix multiply plus ``argpartition``.
+This is the ground-truth oracle for measuring Pinecone's recall, and a fast
+path for corpora small enough to keep in memory.
+
+Run the recall / latency benchmark:
+    python precedent_search.py --index health-claims --k 3 10
+    python precedent_search.py --snapshot corpus.npz --corpus-queries 200
+"""
+
+import argparse
+import json
+import os
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+from rate_limiter import BATCH, use_priority
+
+# Load environment variables
+load_dotenv()
+PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
+MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
+DB_NAME = os.getenv("DB_NAME", "claims-management")
+
+# Queries are scored against the corpus in blocks of this many rows so the
+# (queries x corpus) score matrix stays bounded in memory
+QUERY_BLOCK_SIZE = 256
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """L2-normalize each row in place, leaving all-zero rows untouched"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+def _compare(value: Any, op: str, operand: Any) -> bool:
+    if op == "$eq":
+        return value == operand
+    if op == "$ne":
+        return value != operand
+    if op == "$in":
+        return value in operand
+    if op == "$nin":
+        return value not in operand
+    if op == "$exists":
+        return (value is not None) == bool(operand)
+    if value is None:
+        return False
+    try:
+        if op == "$gt":
+            return value > operand
+        if op == "$gte":
+            return value >= operand
+        if op == "$lt":
+            return value < operand
+        if op == "$lte":
+            return value <= operand
+    except TypeError:
+        return False
+    raise ValueError(f"Unsupported filter operator: {op}")
+
+
+def matches_filter(metadata: Dict[str, Any], metadata_filter: Dict[str, Any]) -> bool:
+    """Evaluate a Pinecone metadata filter against one record's metadata"""
+    for field, condition in metadata_filter.items():
+        if field == "$and":
+            if not all(matches_filter(metadata, clause) for clause in condition):
+                return False
+        elif field == "$or":
+            if not any(matches_filter(metadata, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(field)
+            if not all(_compare(value, op, operand) for op, operand in condition.items()):
+                return False
+        elif metadata.get(field) != condition:
+            return False
+    return True
+
+
+class PrecedentCorpus:
+    """All precedent vectors held in memory, row-aligned with their ids and metadata"""
+
+    def __init__(self, ids: List[str], vectors: np.ndarray, metadata: Optional[List[dict]] = None):
+        if len(ids) != len(vectors):
+            raise ValueError(f"Got {len(ids)} ids for {len(vectors)} vectors")
+        self.ids = list(ids)
+        # One contiguous float32 block, normalized once so that a dot product is a cosine
+        self.vectors = _normalize_rows(np.ascontiguousarray(vectors, dtype=np.float32).copy())
+        self.metadata = metadata if metadata is not None else [{} for _ in ids]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def dimension(self) -> int:
+        return self.vectors.shape[1] if len(self.vectors) else 0
+
+    @classmethod
+    def from_pinecone(cls, index, namespace: str = "", batch_size: int = 100) -> "PrecedentCorpus":
+        """
+        Pull every vector (and its metadata) out of a Pinecone index
+
+        Args:
+            index: A ``pinecone.Index``
+            namespace: The namespace to read
+            batch_size: Number of ids per fetch request
+
+        Returns:
+            The loaded corpus
+        """
+        ids: List[str] = []
+        rows: List[List[float]] = []
+        metadata: List[dict] = []
+
+        def _fetch(batch: List[str]) -> None:
+            fetched = index.fetch(ids=batch, namespace=namespace).vectors
+            for vector_id in batch:
+                vector = fetched.get(vector_id)
+                if vector is None:
+                    continue
+                ids.append(vector_id)
+                rows.append(vector.values)
+                metadata.append(dict(vector.metadata or {}))
+
+        pending: List[str] = []
+        for page in index.list(namespace=namespace):
+            pending.extend(page)
+            while len(pending) >= batch_size:
+                _fetch(pending[:batch_size])
+                pending = pending[batch_size:]
+        if pending:
+            _fetch(pending)
+
+        print(f"Loaded {len(ids)} precedent vectors from Pinecone")
+        vectors = np.asarray(rows, dtype=np.float32) if rows else np.zeros((0, 0), dtype=np.float32)
+        return cls(ids, vectors, metadata)
+
+    def save(self, path: str) -> None:
+        """Snapshot the corpus to a ``.npz`` file so it can be reloaded without Pinecone"""
+        np.savez(
+            path,
+            ids=np.asarray(self.ids),
+            vectors=self.vectors,
+            metadata=np.asarray(json.dumps(self.metadata)),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "PrecedentCorpus":
+        """Load a corpus snapshot written by ``save``"""
+        with np.load(path, allow_pickle=False) as data:
+            return cls(
+                [str(i) for i in data["ids"]],
+                data["vectors"],
+                json.loads(str(data["metadata"])),
+            )
+
+
+class ExactSearchIndex:
+    """Batched exact cosine top-k over a ``PrecedentCorpus``"""
+
+    def __init__(self, corpus: PrecedentCorpus):
+        self.corpus = corpus
+
+    def search(self, queries: np.ndarray, k: int,
+               candidates: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Exact top-k cosine search for a batch of query vectors
+
+        Args:
+            queries: Array of shape (num_queries, dimension), or a single vector
+            k: Number of neighbours per query
+            candidates: Restrict the search to these corpus rows (optional)
+
+        Returns:
+            (indices, scores), both of shape (num_queries, k'), best match first,
+            where k' = min(k, number of candidates). Indices are rows of the corpus.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32)).copy()
+        _normalize_rows(queries)
+
+        matrix = self.corpus.vectors if candidates is None else self.corpus.vectors[candidates]
+        num_rows = len(matrix)
+        k = min(k, num_rows)
+        all_indices = np.empty((len(queries), k), dtype=np.int64)
+        all_scores = np.empty((len(queries), k), dtype=np.float32)
+        if k == 0:
+            return all_indices, all_scores
+
+        for start in range(0, len(queries), QUERY_BLOCK_SIZE):
+            block = queries[start:start + QUERY_BLOCK_SIZE]
+            scores = block @ matrix.T
+
+            if k < num_rows:
+                # O(n) selection of the k best, then sort only those k
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            else:
+                top = np.broadcast_to(np.arange(num_rows), (len(block), num_rows))
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1)
+
+            all_indices[start:start + len(block)] = np.take_along_axis(top, order, axis=1)
+            all_scores[start:start + len(block)] = np.take_along_axis(top_scores, order, axis=1)
+
+        if candidates is not None:
+            all_indices = np.asarray(candidates)[all_indices]
+        return all_indices, all_scores
+
+    def filter_rows(self, metadata_filter: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """Corpus rows whose metadata satisfies a Pinecone filter (None means all rows)"""
+        if not metadata_filter:
+            return None
+        return np.flatnonzero([matches_filter(meta, metadata_filter) for meta in self.corpus.metadata])
+
+    def query(self, vector: Sequence[float], top_k: int = 3, include_metadata: bool = True,
+              filter: Optional[Dict[str, Any]] = None, namespace: str = "", **kwargs) -> Dict[str, Any]:
+        """Pinecone-compatible ``query`` so this index can stand in for ``pc.Index``"""
+        indices, scores = self.search(np.asarray(vector, dtype=np.float32), top_k,
+                                      candidates=self.filter_rows(filter))
+        matches = []
+        for row, score in zip(indices[0], scores[0]):
+            match = {"id": self.corpus.ids[row], "score": float(score)}
+            if include_metadata:
+                match["metadata"] = self.corpus.metadata[row]
+            matches.append(match)
+        return {"matches": matches, "namespace": namespace}
+
+
+def recall_at_k(truth: Sequence[Sequence[str]], approx: Sequence[Sequence[str]], k: int) -> float:
+    """Mean fraction of the exact top-k ids that the approximate search also returned"""
+    if not truth:
+        return 0.0
+    total = 0.0
+    for exact_ids, ann_ids in zip(truth, approx):
+        expected = set(exact_ids[:k])
+        if expected:
+            total += len(expected & set(ann_ids[:k])) / len(expected)
+    return total / len(truth)
+
+
+def _latency_summary(samples_ms: List[float]) -> Dict[str, float]:
+    if not samples_ms:
+        return {}
+    values = np.asarray(samples_ms)
+    return {
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+    }
+
+
+def run_benchmark(exact: ExactSearchIndex, queries: np.ndarray, ks: Iterable[int],
+                  ann_index=None, namespace: str = "") -> Dict[str, Any]:
+    """
+    Compare exact search against an ANN backend on the same query set
+
+    Args:
+        exact: The exact search oracle
+        queries: Query vectors, shape (num_queries, dimension)
+        ks: The k values to report recall for
+        ann_index: Any object with a Pinecone-style ``query`` method (optional)
+        namespace: Namespace passed to the ANN backend
+
+    Returns:
+        A JSON-serializable report
+    """
+    ks = sorted(set(ks))
+    max_k = ks[-1]
+    report: Dict[str, Any] = {
+        "corpus_size": len(exact.corpus),
+        "dimension": exact.corpus.dimension,
+        "num_queries": len(queries),
+    }
+
+    start = time.perf_counter()
+    indices, _ = exact.search(queries, max_k)
+    batched_ms = (time.perf_counter() - start) * 1000
+    truth = [[exact.corpus.ids[i] for i in row] for row in indices]
+
+    single_ms = []
+    for vector in queries:
+        start = time.perf_counter()
+        exact.search(vector, max_k)
+        single_ms.append((time.perf_counter() - start) * 1000)
+
+    report["exact"] = {
+        "batched_total_ms": batched_ms,
+        "batched_per_query_ms": batched_ms / max(len(queries), 1),
+        **_latency_summary(single_ms),
+    }
+
+    if ann_index is not None:
+        approx = []
+        ann_ms = []
+        for vector in queries:
+            start = time.perf_counter()
+            result = ann_index.query(vector=vector.tolist(), top_k=max_k,
+                                     include_metadata=False, namespace=namespace)
+            ann_ms.append((time.perf_counter() - start) * 1000)
+            approx.append([match["id"] for match in result["matches"]])
+
+        report["ann"] = _latency_summary(ann_ms)
+        report["recall"] = {f"recall@{k}": recall_at_k(truth, approx, k) for k in ks}
+
+    return report
+
+
+def claim_query_texts(limit: int = 100) -> List[str]:
+    """Build retrieval queries from the claims stored in MongoDB, in the same shape main.py uses"""
+    from pymongo import MongoClient
+
+    client = MongoClient(MONGODB_URI)
+    texts = []
+    try:
+        for claim in client[DB_NAME].claims.find({}).limit(limit):
+            service = claim.get("service", {}) or {}
+            patient = claim.get("patient", {}) or {}
+            texts.append(
+                f"Condition: {service.get('diagnosisCode') or ''}\n"
+                f"Treatment: {service.get('serviceDescription') or service.get('serviceType') or ''}\n"
+                f"Provider: {patient.get('patientInsuranceProvider') or ''}\n"
+                f"Explanation: {service.get('serviceDescription') or ''}\n"
+            )
+    finally:
+        client.close()
+    return texts
+
+
+def embed_queries(texts: List[str], batch_size: int = 32) -> np.ndarray:
+    """Embed query texts with Jina in batches"""
+    from embedding_client import get_embeddings
+
+    rows: List[List[float]] = []
+    for start in range(0, len(texts), batch_size):
+        rows.extend(get_embeddings(texts[start:start + batch_size]))
+    return np.asarray(rows, dtype=np.float32)
+
+
+def corpus_queries(corpus: PrecedentCorpus, count: int, noise: float = 0.05, seed: int = 0) -> np.ndarray:
+    """Perturbed copies of random corpus vectors, for benchmarking without Jina or MongoDB"""
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(corpus), size=min(count, len(corpus)), replace=False)
+    queries = corpus.vectors[rows] + rng.normal(0, noise, (len(rows), corpus.dimension)).astype(np.float32)
+    return queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exact top-k oracle and recall benchmark for the precedent index")
+    parser.add_argument("--index", default="health-claims", help="Pinecone index to load and compare against")
+    parser.add_argument("--namespace", default="", help="Pinecone namespace")
+    parser.add_argument("--snapshot", help="Load the corpus from this .npz instead of Pinecone (written if missing)")
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 3, 10], help="k values to report recall for")
+    parser.add_argument("--claims", type=int, default=100, help="Max stored claims to derive queries from")
+    parser.add_argument("--corpus-queries", type=int, default=0,
+                        help="Use N perturbed corpus vectors as queries instead of stored claims")
+    parser.add_argument("--no-ann", action="store_true", help="Only time exact search")
+    parser.add_argument("--output", help="Write the JSON report to this path")
+    args = parser.parse_args()
+    # Don't compete with the API for the shared Jina key
+    use_priority(BATCH)
+
+    index = None
+    if not args.no_ann or not (args.snapshot and os.path.exists(args.snapshot)):
+        import pinecone
+        index = pinecone.Pinecone(api_key=PINECONE_API_KEY).Index(args.index)
+
+    if args.snapshot and os.path.exists(args.snapshot):
+        corpus = PrecedentCorpus.load(args.snapshot)
+    else:
+        corpus = PrecedentCorpus.from_pinecone(index, namespace=args.namespace)
+        if args.snapshot:
+            corpus.save(args.snapshot)
+
+    if args.corpus_queries:
+        queries = corpus_queries(corpus, args.corpus_queries)
+    else:
+        texts = claim_query_texts(args.claims)
+        if not texts:
+            print("No stored claims found; use --corpus-queries instead")
+            return
+        queries = embed_queries(texts)
+
+    report = run_benchmark(
+        ExactSearchIndex(corpus),
+        queries,
+        args.k,
+        ann_index=None if args.no_ann else index,
+        namespace=args.namespace,
+    )
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,14 @@
 import os
 import sys
 import PyPDF2
-import requests
 import pinecone
 from dotenv import load_dotenv
 from pinecone import ServerlessSpec
 from datetime import datetime
 
+from embedding_client import get_embedding
+from rate_limiter import BATCH, RateLimitedIndex, use_priority
+
 # Load environment variables
 load_dotenv()
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
@@ -23,26 +25,6 @@ pc = pinecone.Pinecone(api_key=PINECONE_API_KEY)
 # Index names
 INDEX_NAMES = ["health-claims-plus-legal", "health-claims-legal-sourcing"]
 
-def get_embedding(text: str) -> list[float]:
-    """Get embedding from Jina AI API"""
-    JINA_URL = "https://api.jina.ai/v1/embeddings"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {JINA_API_KEY}"
-    }
-    
-    payload = {
-        "model": "jina-clip-v2",
-        "input": [text],
-        "normalized": False
-    }
-    
-    response = requests.post(JINA_URL, headers=headers, json=payload)
-    if response.status_code != 200:
-        raise Exception(f"Jina API error: {response.text}")
-    
-    return response.json()["data"][0]["embedding"]
-
 def process_pdf(pdf_path: str):
     """Process a PDF file and save embeddings to Pinecone"""
     print(f"Processing PDF: {pdf_path}")
@@ -62,7 +44,7 @@ def process_pdf(pdf_path: str):
             )
     
     # Connect to indexes
-    indexes = {name: pc.Index(name) for name in INDEX_NAMES}
+    indexes = {name: RateLimitedIndex(pc.Index(name), name=name) for name in INDEX_NAMES}
     
     # Open PDF
     with open(pdf_path, 'rb') as file:
@@ -117,6 +99,8 @@ def main():
         print(f"Error: File not found: {pdf_path}")
         sys.exit(1)
     
+    # Jina and Pinecone calls share the API's budget; leave its interactive share alone
+    use_priority(BATCH)
     process_pdf(pdf_path)
 
 if __name__ == "__main__":
@@ -10,6 +10,8 @@ from dotenv import load_dotenv
 import argparse
 from collections import defaultdict
 
+from file_storage import FILE_REFS_COLLECTION, read_file_bytes
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -45,42 +47,21 @@ def get_files_by_ids(file_ids):
     # Dictionary to store files grouped by claim ID
     files_by_claim = defaultdict(list)
     
-    # Retrieve each file from GridFS
-    fs_files = db.fs.files
-    fs_chunks = db.fs.chunks
-    
+    # Retrieve each file (content-addressed or legacy GridFS)
     for file_id in file_ids:
         print(f"Retrieving file with ID: {file_id}")
-        # Convert string ID to ObjectId if needed
-        try:
-            obj_id = ObjectId(file_id)
-        except:
-            obj_id = file_id
-            
-        # Get file metadata
-        file_metadata = fs_files.find_one({"_id": obj_id})
-        if not file_metadata:
-            print(f"Warning: File with ID {file_id} not found in GridFS")
+        found = read_file_bytes(db, file_id)
+        if not found:
+            print(f"Warning: File with ID {file_id} not found")
             continue
-            
-        filename = file_metadata.get("filename", f"file_{file_id}.pdf")
         
-        # Extract metadata
-        metadata = file_metadata.get("metadata", {})
-        claim_id = metadata.get("claim_id", "unknown_claim")
+        metadata, file_data = found
+        filename = metadata.get("filename") or f"file_{file_id}.pdf"
+        claim_id = metadata.get("claim_id") or "unknown_claim"
         
         # Log metadata for debugging
         print(f"File metadata: {metadata}")
         
-        # Get all chunks for this file
-        chunks = list(fs_chunks.find({"files_id": obj_id}).sort("n", 1))
-        if not chunks:
-            print(f"Warning: No chunks found for file {file_id}")
-            continue
-            
-        # Combine chunks to get complete file data
-        file_data = b''.join(chunk["data"] for chunk in chunks)
-        
         # Add to results, grouped by claim ID
         files_by_claim[claim_id].append((file_id, filename, file_data, metadata))
         print(f"Retrieved file: {filename} ({file_id}) - {len(file_data)} bytes, Claim ID: {claim_id}")
@@ -102,11 +83,9 @@ def search_files_by_claim(claim_id):
     client = MongoClient(MONGODB_URI)
     db = client[DB_NAME]
     
-    # Search GridFS files collection for files with this claim ID in metadata
-    fs_files = db.fs.files
-    files = list(fs_files.find({"metadata.claim_id": claim_id}))
-    
-    file_ids = [str(file["_id"]) for file in files]
+    # Search file references and legacy GridFS files for this claim ID
+    file_ids = [str(ref["_id"]) for ref in db[FILE_REFS_COLLECTION].find({"claim_id": claim_id}, {"_id": 1})]
+    file_ids.extend(str(file["_id"]) for file in db.fs.files.find({"metadata.claim_id": claim_id}, {"_id": 1}))
     print(f"Found {len(file_ids)} files with claim ID {claim_id}")
     
     client.close()
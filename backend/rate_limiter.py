@@ -0,0 +1,677 @@
+"""
+Rate-limit-aware scheduling for outbound AI API calls.
+
+Jina, DeepSeek, OpenAI and Pinecone share one API key per provider across
+every endpoint and the ingestion scripts. Each provider gets a
+``ProviderScheduler`` that
+
+* enforces requests-per-minute and tokens-per-minute with token buckets,
+* adapts its concurrency limit with AIMD: +1/limit per fast success, a
+  multiplicative cut when latency exceeds the target or the provider
+  answers 429 (which also pauses the provider for its Retry-After),
+* serves two priority lanes: ``interactive`` requests always go ahead of
+  ``batch`` ones, batch work may only use part of the concurrency limit and
+  must leave part of each bucket unused, so a background re-index can't
+  starve user-facing requests,
+* keeps queue-depth, wait-time and throttling metrics.
+
+The lane comes from a context variable (interactive by default); batch jobs
+wrap their work in ``with priority("batch"):``.
+
+Queues, lanes and the concurrency limit are per process, and by default so
+are the buckets. The quota is not: the API and the batch scripts
+(pinecone-db.py, precedent_search.py, process_*.py) run as separate
+processes on the same keys. Either split the limits between them with
+RATE_LIMITS, or set ``RATE_LIMIT_BACKEND=mongodb`` to also count requests in
+a ``SharedBudget`` - per-window request and token counters in MongoDB,
+leased a slice at a time - that keeps their combined rate within the limits
+and holds the batch reserve back for interactive requests in any process.
+``acquire`` blocks its thread; async code calls providers through
+``run_in_threadpool``.
+
+Usage:
+    from rate_limiter import get_scheduler
+
+    result = get_scheduler("pinecone").call(lambda: index.query(vector=v, top_k=3))
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional
+
+from pydantic import BaseModel
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+from tracing import annotate, span
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+LANES = (INTERACTIVE, BATCH)
+
+# Share of the concurrency limit batch requests may occupy, and share of each
+# token bucket they must leave for interactive requests
+BATCH_CONCURRENCY_SHARE = float(os.getenv("BATCH_CONCURRENCY_SHARE", "0.75"))
+BATCH_BUCKET_RESERVE = float(os.getenv("BATCH_BUCKET_RESERVE", "0.2"))
+
+# Retries of a call answered with 429, after waiting out the provider pause
+RATE_LIMIT_RETRIES = int(os.getenv("RATE_LIMIT_RETRIES", "3"))
+
+# AIMD factors: multiplicative decrease on 429 / on slow responses
+THROTTLE_DECREASE = 0.5
+LATENCY_DECREASE = 0.9
+
+# Pause after a 429 without a Retry-After header
+DEFAULT_RETRY_AFTER = 2.0
+
+# "local" keeps each process's budget to itself (split the limits between processes with
+# RATE_LIMITS); "mongodb" also counts requests and tokens across processes
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "local")
+RATE_LIMIT_WINDOW = float(os.getenv("RATE_LIMIT_WINDOW", "10"))
+RATE_LIMIT_COLLECTION = "rate_limit_windows"
+# Share of a window's budget a process claims per MongoDB round trip
+RATE_LIMIT_LEASE_SHARE = float(os.getenv("RATE_LIMIT_LEASE_SHARE", "0.05"))
+# The shared budget must never hold up a call for long: fail fast and fall back
+RATE_LIMIT_MONGO_TIMEOUT_MS = int(os.getenv("RATE_LIMIT_MONGO_TIMEOUT_MS", "200"))
+
+# After a MongoDB error, fall back to the per-process buckets for this long
+SHARED_BUDGET_RETRY = 60.0
+
+
+class ProviderLimits(BaseModel):
+    """Rate limits and concurrency bounds of one provider; None disables a bucket"""
+    rpm: Optional[float] = None
+    tpm: Optional[float] = None
+    min_concurrency: int = 1
+    max_concurrency: int = 16
+    initial_concurrency: Optional[int] = None
+    latency_target_ms: float = 10000
+
+
+DEFAULT_LIMITS: Dict[str, Dict[str, Any]] = {
+    "jina": {"rpm": 500, "tpm": 1_000_000, "max_concurrency": 8, "latency_target_ms": 3000},
+    "deepseek": {"rpm": 120, "max_concurrency": 16, "latency_target_ms": 60000},
+    "openai": {"rpm": 500, "tpm": 200_000, "max_concurrency": 16, "latency_target_ms": 30000},
+    "pinecone": {"rpm": 6000, "max_concurrency": 32, "latency_target_ms": 1000},
+}
+
+# Per-provider overrides, e.g. RATE_LIMITS='{"openai": {"rpm": 60, "tpm": 30000}}'
+RATE_LIMITS: Dict[str, Dict[str, Any]] = json.loads(os.getenv("RATE_LIMITS", "null") or "null") or {}
+
+_priority: ContextVar[str] = ContextVar("api_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def priority(lane: str) -> Iterator[None]:
+    """Run the enclosed API calls in the given lane ("interactive" or "batch")"""
+    if lane not in LANES:
+        raise ValueError(f"Unknown priority lane: {lane}")
+    token = _priority.set(lane)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def use_priority(lane: str) -> None:
+    """Set the lane for the rest of the current context (for scripts)"""
+    if lane not in LANES:
+        raise ValueError(f"Unknown priority lane: {lane}")
+    _priority.set(lane)
+
+
+def current_priority() -> str:
+    return _priority.get()
+
+
+def rate_limit_info(error: BaseException) -> Optional[float]:
+    """
+    Whether an exception is a provider 429, and how long to back off
+
+    Understands openai (``status_code``), pinecone (``status``) and requests
+    (``response.status_code``) errors.
+
+    Returns:
+        Seconds to wait (0 if unspecified) for a rate-limit error, else None
+    """
+    response = getattr(error, "response", None)
+    status = getattr(error, "status_code", None) or getattr(error, "status", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+    if status != 429:
+        return None
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after") or headers.get("Retry-After") or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class TokenBucket:
+    """Refills continuously at ``per_minute / 60`` per second up to ``capacity``"""
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float, reserve: float = 0.0, now: Optional[float] = None) -> float:
+        """Seconds until ``amount`` can be taken while leaving ``reserve`` in the bucket"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        # A request larger than the bucket would never fit; let it through on a full bucket
+        needed = min(amount + reserve, self.capacity)
+        if self.level >= needed:
+            return 0.0
+        return (needed - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.level -= amount
+
+    def adjust(self, amount: float) -> None:
+        """Correct an estimate: positive takes more, negative gives back (level may go negative)"""
+        self.level = min(self.capacity, self.level - amount)
+
+
+class _Lease:
+    """Share of one window's shared budget claimed by this process for one lane"""
+    __slots__ = ("window", "requests", "tokens")
+
+    def __init__(self, window: str, requests: float, tokens: float):
+        self.window = window
+        self.requests = requests
+        self.tokens = tokens
+
+
+_budget_client = None
+_budget_indexed = False
+_budget_client_lock = threading.Lock()
+
+
+def _budget_collection():
+    """The shared budget's collection, on its own client with short timeouts"""
+    global _budget_client, _budget_indexed
+    with _budget_client_lock:
+        if _budget_client is None:
+            # Not database.py's client: importing it runs a connection test with the default
+            # 30s timeout, and its commands have no timeout a rate limiter could live with
+            from pymongo import MongoClient
+            _budget_client = MongoClient(
+                os.getenv("MONGODB_URI", "mongodb://localhost:27017"),
+                serverSelectionTimeoutMS=RATE_LIMIT_MONGO_TIMEOUT_MS,
+                connectTimeoutMS=RATE_LIMIT_MONGO_TIMEOUT_MS,
+                socketTimeoutMS=RATE_LIMIT_MONGO_TIMEOUT_MS,
+            )
+        collection = _budget_client[os.getenv("DB_NAME", "claims-management")][RATE_LIMIT_COLLECTION]
+        if not _budget_indexed:
+            collection.create_index("expires_at", expireAfterSeconds=0)
+            _budget_indexed = True
+        return collection
+
+
+class SharedBudget:
+    """
+    Requests and tokens one provider may spend per window, counted across processes
+
+    Windows are ``RATE_LIMIT_WINDOW`` seconds of wall-clock time, each allowed
+    its share of the per-minute limits. Counters are MongoDB documents that
+    expire after their window. A process leases ``RATE_LIMIT_LEASE_SHARE`` of
+    a window per round trip and spends it locally, so most calls don't touch
+    MongoDB; a lease left unused when its window ends is lost. If MongoDB
+    can't be reached the budget admits everything for a while and only the
+    per-process buckets apply.
+    """
+
+    def __init__(self, provider: str, limits: ProviderLimits, window: float = RATE_LIMIT_WINDOW,
+                 lease_share: float = RATE_LIMIT_LEASE_SHARE):
+        self.provider = provider
+        self.window = window
+        self.requests = limits.rpm * window / 60 if limits.rpm else None
+        self.tokens = limits.tpm * window / 60 if limits.tpm else None
+        self.lease_share = lease_share
+        self._leases: Dict[float, _Lease] = {}
+        # Token corrections not yet written, sent with the next lease
+        self._pending_tokens = 0.0
+        self._down_until = 0.0
+        self._lock = threading.Lock()
+
+    def _current(self) -> tuple:
+        now = time.time()
+        start = now - now % self.window
+        return f"{self.provider}:{int(start * 1000)}", start, now
+
+    def _unavailable(self, error: Exception) -> None:
+        self._down_until = time.monotonic() + SHARED_BUDGET_RETRY
+        self._leases.clear()
+        print(f"[{self.provider}] shared rate budget unavailable, using per-process limits "
+              f"for {SHARED_BUDGET_RETRY:.0f}s: {error}")
+
+    def _lease_size(self, cap: Optional[float], needed: float) -> float:
+        return max(needed, cap * self.lease_share) if cap is not None else 0.0
+
+    @staticmethod
+    def _grantable(cap: Optional[float], total: float, leased: float, reserve: float) -> float:
+        """How much of ``leased`` fits in a window that the lease brought to ``total``"""
+        return min(leased, cap * (1 - reserve) - (total - leased)) if cap is not None else 0.0
+
+    def _refill(self, key: str, start: float, tokens: float, reserve: float) -> Optional[_Lease]:
+        """Claim the next lease in one round trip; None if the window can't spare this request"""
+        lease_requests = self._lease_size(self.requests, 1)
+        lease_tokens = self._lease_size(self.tokens, tokens)
+        pending, self._pending_tokens = self._pending_tokens, 0.0
+        windows = _budget_collection()
+        counts = windows.find_one_and_update(
+            {"_id": key},
+            {
+                "$inc": {"requests": lease_requests, "tokens": lease_tokens + pending},
+                "$setOnInsert": {"expires_at": datetime.fromtimestamp(start + 2 * self.window, timezone.utc)},
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        requests = self._grantable(self.requests, counts["requests"], lease_requests, reserve)
+        granted_tokens = self._grantable(self.tokens, counts["tokens"], lease_tokens, reserve)
+        if (self.requests is not None and requests < 1) or (self.tokens is not None and granted_tokens < tokens):
+            if self.requests is not None:
+                first = counts["requests"] == lease_requests
+            else:
+                first = counts["tokens"] == lease_tokens + pending
+            if not first:
+                windows.update_one({"_id": key}, {"$inc": {"requests": -lease_requests, "tokens": -lease_tokens}})
+                return None
+            # A request larger than the window would never fit; let it through on an empty one
+            requests, granted_tokens = max(requests, 1), max(granted_tokens, tokens)
+        unused_requests = max(0.0, lease_requests - requests) if self.requests is not None else 0.0
+        unused_tokens = max(0.0, lease_tokens - granted_tokens) if self.tokens is not None else 0.0
+        if unused_requests or unused_tokens:
+            windows.update_one({"_id": key}, {"$inc": {"requests": -unused_requests, "tokens": -unused_tokens}})
+        return _Lease(key, requests, granted_tokens)
+
+    def take(self, tokens: float, reserve: float = 0.0) -> float:
+        """
+        Count one request against the current window
+
+        Args:
+            tokens: Estimated tokens the request will consume
+            reserve: Share of the window to leave for other lanes
+
+        Returns:
+            0 if the request was counted, else seconds until the next window
+        """
+        with self._lock:
+            if time.monotonic() < self._down_until:
+                return 0.0
+            key, start, now = self._current()
+            lease = self._leases.get(reserve)
+            fits = lease is not None and lease.window == key and \
+                (self.requests is None or lease.requests >= 1) and (self.tokens is None or lease.tokens >= tokens)
+            if not fits:
+                try:
+                    lease = self._refill(key, start, tokens, reserve)
+                except PyMongoError as e:
+                    self._unavailable(e)
+                    return 0.0
+                if lease is None:
+                    self._leases.pop(reserve, None)
+                    return max(0.0, start + self.window - now)
+                self._leases[reserve] = lease
+            lease.requests -= 1
+            lease.tokens -= tokens
+            return 0.0
+
+    def adjust(self, tokens: float) -> None:
+        """Correct a token estimate; settled against this process's leases, written with the next refill"""
+        if self.tokens is None or not tokens:
+            return
+        with self._lock:
+            if time.monotonic() < self._down_until:
+                return
+            key, _, _ = self._current()
+            for lease in self._leases.values():
+                if lease.window == key:
+                    # Spend (or give back) the difference from a current lease where possible
+                    lease.tokens -= tokens
+                    return
+            self._pending_tokens += tokens
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self._down_until
+
+
+class _LaneStats:
+    __slots__ = ("queued", "max_queued", "started", "wait_ms_total", "wait_ms_max")
+
+    def __init__(self):
+        self.queued = 0
+        self.max_queued = 0
+        self.started = 0
+        self.wait_ms_total = 0.0
+        self.wait_ms_max = 0.0
+
+
+class Permit:
+    """A granted request slot; release it (or leave the ``with`` block) when the call ends"""
+
+    def __init__(self, scheduler: "ProviderScheduler", lane: str, tokens: float):
+        self.scheduler = scheduler
+        self.lane = lane
+        self.tokens = tokens
+        self.started = time.monotonic()
+        self._retry_after: Optional[float] = None
+        self._released = False
+
+    def record_tokens(self, used: Optional[float]) -> None:
+        """Replace the token estimate with the provider-reported usage"""
+        if used is not None:
+            self.scheduler._adjust_tokens(used - self.tokens)
+            self.tokens = used
+
+    def throttled(self, error: Optional[BaseException] = None) -> None:
+        """Mark this call as answered with 429"""
+        retry_after = rate_limit_info(error) if error is not None else None
+        self._retry_after = retry_after or DEFAULT_RETRY_AFTER
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            latency_ms = (time.monotonic() - self.started) * 1000
+            self.scheduler._release(self, latency_ms, self._retry_after)
+
+    def __enter__(self) -> "Permit":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc is not None and rate_limit_info(exc) is not None:
+            self.throttled(exc)
+        self.release()
+
+
+class ProviderScheduler:
+    """Admission control for one provider: token buckets, AIMD concurrency and priority lanes"""
+
+    def __init__(self, name: str, limits: ProviderLimits, shared: Optional[SharedBudget] = None):
+        self.name = name
+        self.limits = limits
+        self.shared = shared
+        self.limit = float(limits.initial_concurrency or max(limits.min_concurrency, limits.max_concurrency // 2))
+        self.requests = TokenBucket(limits.rpm) if limits.rpm else None
+        self.tokens = TokenBucket(limits.tpm) if limits.tpm else None
+        self.in_flight = 0
+        self._in_flight_by_lane = {lane: 0 for lane in LANES}
+        self._queues: Dict[str, Deque[object]] = {lane: deque() for lane in LANES}
+        self._lanes = {lane: _LaneStats() for lane in LANES}
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self.throttled = 0
+        self.completed = 0
+        self._cond = threading.Condition()
+
+    def _is_next(self, lane: str, ticket: object) -> bool:
+        if lane == BATCH and self._queues[INTERACTIVE]:
+            return False
+        return self._queues[lane][0] is ticket
+
+    def _delay(self, lane: str, tokens: float, now: float) -> Optional[float]:
+        """Seconds until the request can start; None to wait for a release"""
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self.in_flight >= int(self.limit):
+            return None
+        if lane == BATCH and self._in_flight_by_lane[BATCH] >= max(1, int(self.limit * BATCH_CONCURRENCY_SHARE)):
+            return None
+        reserve = BATCH_BUCKET_RESERVE if lane == BATCH else 0.0
+        delay = 0.0
+        if self.requests is not None:
+            delay = max(delay, self.requests.wait_time(1, reserve * self.requests.capacity, now))
+        if self.tokens is not None:
+            delay = max(delay, self.tokens.wait_time(tokens, reserve * self.tokens.capacity, now))
+        return delay
+
+    def acquire(self, tokens: float = 0, lane: Optional[str] = None, timeout: Optional[float] = None) -> Permit:
+        """
+        Block until a request may be sent
+
+        Args:
+            tokens: Estimated tokens the request will consume
+            lane: Priority lane; defaults to the current context's lane
+            timeout: Give up after this many seconds
+
+        Returns:
+            A ``Permit`` to release when the call completes
+
+        Raises:
+            TimeoutError: If the request could not start within ``timeout``
+        """
+        lane = lane or current_priority()
+        ticket = object()
+        queued_at = time.monotonic()
+        deadline = queued_at + timeout if timeout is not None else None
+        stats = self._lanes[lane]
+        reserve = BATCH_BUCKET_RESERVE if lane == BATCH else 0.0
+
+        with self._cond:
+            self._queues[lane].append(ticket)
+            stats.queued += 1
+            stats.max_queued = max(stats.max_queued, stats.queued)
+        try:
+            while True:
+                with self._cond:
+                    while True:
+                        now = time.monotonic()
+                        delay = self._delay(lane, tokens, now) if self._is_next(lane, ticket) else None
+                        if delay == 0:
+                            break
+                        if deadline is not None and now >= deadline:
+                            raise TimeoutError(f"{self.name}: no {lane} request slot within {timeout}s")
+                        wait = 1.0 if delay is None else delay
+                        if deadline is not None:
+                            wait = min(wait, deadline - now)
+                        self._cond.wait(wait)
+                    self._start(lane, tokens)
+
+                # Still first in the lane, so later requests wait behind this one, but without
+                # holding the lock over a MongoDB round trip
+                try:
+                    delay = self.shared.take(tokens, reserve) if self.shared is not None else 0.0
+                except BaseException:
+                    with self._cond:
+                        self._unstart(lane, tokens)
+                    raise
+                if delay == 0:
+                    break
+                with self._cond:
+                    self._unstart(lane, tokens)
+                now = time.monotonic()
+                if deadline is not None and now + delay > deadline:
+                    raise TimeoutError(f"{self.name}: no {lane} request slot within {timeout}s")
+                time.sleep(delay)
+        finally:
+            with self._cond:
+                self._queues[lane].remove(ticket)
+                stats.queued -= 1
+                self._cond.notify_all()
+
+        with self._cond:
+            waited_ms = (time.monotonic() - queued_at) * 1000
+            stats.started += 1
+            stats.wait_ms_total += waited_ms
+            stats.wait_ms_max = max(stats.wait_ms_max, waited_ms)
+        annotate(**{"ratelimit.lane": lane, "ratelimit.wait_ms": round(waited_ms, 3)})
+        return Permit(self, lane, tokens)
+
+    def _start(self, lane: str, tokens: float) -> None:
+        self.in_flight += 1
+        self._in_flight_by_lane[lane] += 1
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.tokens is not None:
+            self.tokens.take(tokens)
+
+    def _unstart(self, lane: str, tokens: float) -> None:
+        """Undo ``_start`` for a request the shared budget turned away"""
+        self.in_flight -= 1
+        self._in_flight_by_lane[lane] -= 1
+        if self.requests is not None:
+            self.requests.adjust(-1)
+        if self.tokens is not None:
+            self.tokens.adjust(-tokens)
+        self._cond.notify_all()
+
+    def _adjust_tokens(self, amount: float) -> None:
+        if self.tokens is not None:
+            with self._cond:
+                self.tokens.adjust(amount)
+        if self.shared is not None:
+            self.shared.adjust(amount)
+
+    def _release(self, permit: Permit, latency_ms: float, retry_after: Optional[float]) -> None:
+        limits = self.limits
+        with self._cond:
+            now = time.monotonic()
+            self.in_flight -= 1
+            self._in_flight_by_lane[permit.lane] -= 1
+            if retry_after is not None:
+                self.throttled += 1
+                self.limit = max(limits.min_concurrency, self.limit * THROTTLE_DECREASE)
+                self._paused_until = max(self._paused_until, now + retry_after)
+                self._last_decrease = now
+                print(f"[{self.name}] rate limited: concurrency limit -> {self.limit:.1f}, "
+                      f"pausing {retry_after:.1f}s")
+            else:
+                self.completed += 1
+                if latency_ms > limits.latency_target_ms:
+                    # At most one cut per latency window, or a burst of slow calls collapses the limit
+                    if now - self._last_decrease > limits.latency_target_ms / 1000:
+                        self.limit = max(limits.min_concurrency, self.limit * LATENCY_DECREASE)
+                        self._last_decrease = now
+                else:
+                    self.limit = min(limits.max_concurrency, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def call(self, fn: Callable[[], Any], tokens: float = 0, lane: Optional[str] = None,
+             usage: Optional[Callable[[Any], Optional[float]]] = None,
+             retries: int = RATE_LIMIT_RETRIES) -> Any:
+        """
+        Run ``fn`` under this scheduler, retrying when the provider answers 429
+
+        Args:
+            fn: The API call
+            tokens: Estimated tokens the call consumes
+            lane: Priority lane; defaults to the current context's lane
+            usage: Extracts the actual token usage from the result
+            retries: Retries after a 429
+
+        Returns:
+            ``fn()``'s result
+        """
+        attempt = 0
+        while True:
+            with self.acquire(tokens, lane) as permit:
+                try:
+                    result = fn()
+                except Exception as e:
+                    if rate_limit_info(e) is None or attempt >= retries:
+                        raise
+                    permit.throttled(e)
+                else:
+                    if usage is not None:
+                        permit.record_tokens(usage(result))
+                    return result
+            attempt += 1
+            print(f"[{self.name}] retrying after rate limit ({attempt}/{retries})")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            now = time.monotonic()
+            return {
+                "concurrency_limit": round(self.limit, 2),
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "throttled": self.throttled,
+                "paused_for_s": round(max(0.0, self._paused_until - now), 2),
+                "requests_available": round(self.requests.level, 1) if self.requests else None,
+                "tokens_available": round(self.tokens.level, 1) if self.tokens else None,
+                "shared_budget": self.shared.available if self.shared else None,
+                "lanes": {
+                    lane: {
+                        "queue_depth": stats.queued,
+                        "max_queue_depth": stats.max_queued,
+                        "in_flight": self._in_flight_by_lane[lane],
+                        "started": stats.started,
+                        "avg_wait_ms": stats.wait_ms_total / stats.started if stats.started else 0.0,
+                        "max_wait_ms": stats.wait_ms_max,
+                    }
+                    for lane, stats in self._lanes.items()
+                },
+            }
+
+
+class RateLimitedIndex:
+    """Pinecone ``Index`` whose query / upsert / fetch / update calls go through a scheduler (and are traced)"""
+
+    def __init__(self, index, scheduler: Optional[ProviderScheduler] = None, name: Optional[str] = None):
+        self.index = index
+        self.scheduler = scheduler or get_scheduler("pinecone")
+        self.name = name
+
+    def query(self, *args, **kwargs):
+        with span("pinecone.query", **{"pinecone.index": self.name, "pinecone.top_k": kwargs.get("top_k"),
+                                       "pinecone.filtered": bool(kwargs.get("filter"))}) as s:
+            result = self.scheduler.call(lambda: self.index.query(*args, **kwargs))
+            s.set("pinecone.matches", len(result["matches"]))
+            return result
+
+    def upsert(self, *args, **kwargs):
+        vectors = kwargs.get("vectors", args[0] if args else ())
+        with span("pinecone.upsert", **{"pinecone.index": self.name, "pinecone.vectors": len(vectors)}):
+            return self.scheduler.call(lambda: self.index.upsert(*args, **kwargs))
+
+    def fetch(self, *args, **kwargs):
+        with span("pinecone.fetch", **{"pinecone.index": self.name}):
+            return self.scheduler.call(lambda: self.index.fetch(*args, **kwargs))
+
+    def update(self, *args, **kwargs):
+        with span("pinecone.update", **{"pinecone.index": self.name}):
+            return self.scheduler.call(lambda: self.index.update(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+
+def estimate_tokens(texts: List[str]) -> int:
+    """Rough token count for rate limiting (about four characters per token)"""
+    return sum(len(text or "") for text in texts) // 4 + 1
+
+
+_schedulers: Dict[str, ProviderScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(provider: str) -> ProviderScheduler:
+    """Shared scheduler for a provider, configured from DEFAULT_LIMITS and RATE_LIMITS"""
+    with _schedulers_lock:
+        if provider not in _schedulers:
+            config = {**DEFAULT_LIMITS.get(provider, {}), **RATE_LIMITS.get(provider, {})}
+            limits = ProviderLimits(**config)
+            shared = SharedBudget(provider, limits) if RATE_LIMIT_BACKEND == "mongodb" and (limits.rpm or limits.tpm) else None
+            _schedulers[provider] = ProviderScheduler(provider, limits, shared)
+        return _schedulers[provider]
+
+
+def scheduler_stats() -> Dict[str, Dict[str, Any]]:
+    """Metrics for every scheduler created so far"""
+    with _schedulers_lock:
+        schedulers = dict(_schedulers)
+    return {name: scheduler.stats() for name, scheduler in schedulers.items()}
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Regression tests for provider scheduling (rate_limiter.py).
+
+Batch work must never starve interactive requests - neither through the
+queue order, the concurrency limit nor the token buckets - and the AIMD
+concurrency limit must grow on fast calls and back off on 429s and slow
+ones. Per-process buckets only, no database needed:
+
+    python rate_limiter_test.py
+"""
+
+import threading
+import time
+
+from rate_limiter import (BATCH, BATCH_BUCKET_RESERVE, BATCH_CONCURRENCY_SHARE, INTERACTIVE, LATENCY_DECREASE,
+                          THROTTLE_DECREASE, ProviderLimits, ProviderScheduler, SharedBudget)
+
+
+class RateLimited(Exception):
+    """A provider 429, as openai raises it"""
+
+    def __init__(self, retry_after: float):
+        super().__init__("429 Too Many Requests")
+        self.status_code = 429
+        self.headers = {"retry-after": str(retry_after)}
+
+
+def _wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out waiting for the scheduler"
+        time.sleep(0.005)
+
+
+def _timed_out(acquire):
+    try:
+        acquire().release()
+    except TimeoutError:
+        return True
+    return False
+
+
+def test_interactive_goes_ahead_of_queued_batch():
+    scheduler = ProviderScheduler("test", ProviderLimits(max_concurrency=1, initial_concurrency=1))
+    held = scheduler.acquire(lane=INTERACTIVE)
+    order = []
+
+    def _request(lane):
+        with scheduler.acquire(lane=lane):
+            order.append(lane)
+
+    # The batch request queues first, the interactive one behind it
+    threads = [threading.Thread(target=_request, args=(BATCH,))]
+    threads[0].start()
+    _wait_for(lambda: scheduler.stats()["lanes"][BATCH]["queue_depth"] == 1)
+    threads.append(threading.Thread(target=_request, args=(INTERACTIVE,)))
+    threads[1].start()
+    _wait_for(lambda: scheduler.stats()["lanes"][INTERACTIVE]["queue_depth"] == 1)
+
+    held.release()
+    for thread in threads:
+        thread.join(timeout=5)
+    assert order == [INTERACTIVE, BATCH]
+
+
+def test_batch_leaves_concurrency_for_interactive():
+    limits = ProviderLimits(max_concurrency=4, initial_concurrency=4)
+    scheduler = ProviderScheduler("test", limits)
+    batch_slots = int(limits.max_concurrency * BATCH_CONCURRENCY_SHARE)
+    permits = [scheduler.acquire(lane=BATCH) for _ in range(batch_slots)]
+
+    assert _timed_out(lambda: scheduler.acquire(lane=BATCH, timeout=0.1))
+    interactive = scheduler.acquire(lane=INTERACTIVE, timeout=0.1)
+    assert scheduler.stats()["lanes"][INTERACTIVE]["in_flight"] == 1
+    for permit in permits + [interactive]:
+        permit.release()
+
+
+def test_batch_flood_does_not_starve_interactive():
+    scheduler = ProviderScheduler("test", ProviderLimits(max_concurrency=4, initial_concurrency=4))
+    stop = threading.Event()
+
+    def _batch_worker():
+        while not stop.is_set():
+            with scheduler.acquire(lane=BATCH):
+                time.sleep(0.1)
+
+    workers = [threading.Thread(target=_batch_worker) for _ in range(8)]
+    for worker in workers:
+        worker.start()
+    try:
+        _wait_for(lambda: scheduler.stats()["lanes"][BATCH]["queue_depth"] > 0)
+        waits = []
+        for _ in range(20):
+            started = time.monotonic()
+            with scheduler.acquire(lane=INTERACTIVE, timeout=1.0):
+                waits.append(time.monotonic() - started)
+            time.sleep(0.005)
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join(timeout=5)
+    # Batch never holds every slot, so interactive requests start without queueing behind it
+    assert max(waits) < 0.05, f"interactive waited up to {max(waits) * 1000:.0f} ms"
+    assert scheduler.stats()["lanes"][BATCH]["started"] >= 3
+
+
+def test_batch_leaves_bucket_reserve():
+    # 60 requests per minute: a full bucket holds 60 and refills one per second
+    scheduler = ProviderScheduler("test", ProviderLimits(rpm=60, max_concurrency=4))
+    batch_started = 0
+    while not _timed_out(lambda: scheduler.acquire(lane=BATCH, timeout=0.05)):
+        batch_started += 1
+    reserve = int(60 * BATCH_BUCKET_RESERVE)
+    assert 60 - reserve <= batch_started <= 60 - reserve + 1, batch_started
+
+    interactive_started = 0
+    while not _timed_out(lambda: scheduler.acquire(lane=INTERACTIVE, timeout=0.05)):
+        interactive_started += 1
+    assert reserve - 1 <= interactive_started <= reserve + 1, interactive_started
+
+
+def test_aimd_concurrency_limit():
+    limits = ProviderLimits(min_concurrency=1, max_concurrency=8, initial_concurrency=4, latency_target_ms=1000)
+    scheduler = ProviderScheduler("test", limits)
+
+    # Additive increase: +1/limit per fast success, capped at max_concurrency
+    scheduler.acquire().release()
+    assert scheduler.limit == 4.25
+    for _ in range(200):
+        scheduler.acquire().release()
+    assert scheduler.limit == limits.max_concurrency
+
+    # Multiplicative decrease on 429, with a pause for the Retry-After
+    try:
+        with scheduler.acquire():
+            raise RateLimited(retry_after=0.3)
+    except RateLimited:
+        pass
+    assert scheduler.limit == limits.max_concurrency * THROTTLE_DECREASE
+    assert scheduler.throttled == 1 and scheduler.stats()["paused_for_s"] > 0
+    assert _timed_out(lambda: scheduler.acquire(timeout=0.1))
+    scheduler.acquire(timeout=1.0).release()
+
+    # Slow successes cut the limit, at most once per latency target
+    limit = scheduler.limit
+    scheduler._last_decrease = time.monotonic() - 2
+    for _ in range(3):
+        permit = scheduler.acquire()
+        permit.started -= 2
+        permit.release()
+    assert scheduler.limit == limit * LATENCY_DECREASE
+
+    # Never below min_concurrency
+    for _ in range(10):
+        permit = scheduler.acquire()
+        permit.throttled(RateLimited(retry_after=0.001))
+        permit.release()
+    assert scheduler.limit == limits.min_concurrency
+
+
+def test_call_retries_after_rate_limit():
+    scheduler = ProviderScheduler("test", ProviderLimits(max_concurrency=4))
+    attempts = []
+
+    def _flaky():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise RateLimited(retry_after=0.2)
+        return "ok"
+
+    assert scheduler.call(_flaky) == "ok"
+    assert scheduler.throttled == 1 and scheduler.completed == 1
+    assert attempts[1] - attempts[0] >= 0.2
+    assert scheduler.in_flight == 0
+
+
+def test_failed_shared_budget_frees_the_slot():
+    class BrokenBudget(SharedBudget):
+        def take(self, tokens, reserve=0.0):
+            raise RuntimeError("budget store unreachable")
+
+    limits = ProviderLimits(rpm=600, tpm=60000, max_concurrency=1, initial_concurrency=1)
+    scheduler = ProviderScheduler("test", limits, shared=BrokenBudget("test", limits))
+    for _ in range(3):
+        try:
+            scheduler.acquire(tokens=100, lane=BATCH, timeout=0.5)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("acquire ignored the shared budget's error")
+    stats = scheduler.stats()
+    assert scheduler.in_flight == 0 and stats["lanes"][BATCH]["in_flight"] == 0
+    assert stats["requests_available"] == 600 and stats["tokens_available"] == 60000
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"{name}: ok")
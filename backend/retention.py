@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+Tiered retention: move old claims' file content to compressed cold storage.
+
+Files of decided claims (``RETENTION_STATUSES``: approved and denied by
+default) submitted more than ``RETENTION_DAYS`` ago are moved out of the hot
+blob backend into a cold one (``RETENTION_BACKEND``: the ``cold-local``
+archive directory or the ``cold-s3`` bucket/prefix), and recompressed with
+high-level zstd along the way. In the hot backend they would otherwise keep
+growing MongoDB's working set and evict the claims indexes.
+
+* A content-addressed blob moves only when every file referencing it is
+  eligible, so content shared with an open claim stays hot. Its file_blobs
+  record then points at the cold copy.
+* A legacy GridFS file keeps its fs.files document as a stub: the chunks are
+  deleted and ``metadata.archive`` records where the content went.
+
+Downloads read archived files transparently. With
+``RETENTION_REHYDRATE_ON_READ``, a file that is read is also moved back to
+the hot tier in the background (e.g. a claim reopened on appeal).
+
+Usage:
+    python retention.py --dry-run
+    python retention.py --older-than-days 365 --statuses approved denied --workers 4
+    python retention.py --rehydrate <file_id>
+"""
+
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from itertools import chain
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from bson import ObjectId
+
+from blob_store import COLD_BACKENDS, COLD_LOCAL, COLD_S3, FILE_BLOB_BACKEND, GRIDFS, READ_CHUNK_SIZE, get_blob_store
+from database import get_db
+from file_codec import archive_codec, choose_codec, codec_for
+from file_storage import (
+    BLOB_READY, FILE_BLOBS_COLLECTION, FILE_REFS_COLLECTION, blob_location, rechunk, relocate_blob,
+)
+from migrate_blobs import migrate_legacy_file
+
+RETENTION_STATUSES = [status.strip() for status in os.getenv("RETENTION_STATUSES", "approved,denied").split(",")]
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "180"))
+RETENTION_BACKEND = os.getenv("RETENTION_BACKEND", COLD_LOCAL)
+RETENTION_REHYDRATE_ON_READ = os.getenv("RETENTION_REHYDRATE_ON_READ", "true").lower() == "true"
+
+# Larger zstd frames than hot storage's: better ratios, and cold reads are rare
+ARCHIVE_CHUNK_SIZE = 4 * 1024 * 1024
+QUERY_BATCH_SIZE = 500
+
+_rehydrate_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="rehydrate")
+_rehydrating: Set[str] = set()
+_rehydrating_lock = threading.Lock()
+
+
+def _batches(items: List[Any], size: int = QUERY_BATCH_SIZE) -> Iterator[List[Any]]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _encode(plain: Iterator[bytes], choose) -> Tuple[Any, Iterator[bytes]]:
+    """Pick a codec from the first chunk of ``plain``; returns it and the encoded stream"""
+    first = next(plain, b"")
+    codec = choose(first)
+    return codec, (codec.encode(data) for data in chain([first], plain) if data)
+
+
+def _counted(chunks: Iterable[bytes], counter: List[int]) -> Iterator[bytes]:
+    for data in chunks:
+        counter[0] += len(data)
+        yield data
+
+
+def plan(statuses: List[str] = RETENTION_STATUSES, older_than_days: int = RETENTION_DAYS,
+         limit: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Find the content the policy would move to cold storage
+
+    Args:
+        statuses: Claim statuses whose files may be archived
+        older_than_days: Only claims submitted at least this long ago
+        limit: At most this many blobs (and legacy files)
+
+    Returns:
+        ``blobs`` (file_blobs records), ``legacy_files`` (fs.files documents) and
+        ``shared_kept_hot`` (blobs also referenced by claims outside the policy)
+    """
+    db = get_db()
+    cutoff = datetime.now() - timedelta(days=older_than_days)
+    claim_keys: Set[str] = set()
+    claim_object_ids = []
+    for claim in db.claims.find({"status": {"$in": statuses}, "submittedAt": {"$lt": cutoff}}, {"_id": 1, "claimId": 1}):
+        # Files have been attached by claimId and by the claim's _id
+        claim_keys.add(str(claim["_id"]))
+        if claim.get("claimId"):
+            claim_keys.add(claim["claimId"])
+        if isinstance(claim["_id"], ObjectId):
+            claim_object_ids.append(claim["_id"])
+
+    candidates: Set[str] = set()
+    for keys in _batches(sorted(claim_keys)):
+        candidates.update(ref["sha256"] for ref in db[FILE_REFS_COLLECTION].find({"claim_id": {"$in": keys}}, {"sha256": 1}))
+    # Deduplicated content may also belong to files of claims outside the policy
+    shared = set()
+    for shas in _batches(sorted(candidates)):
+        for ref in db[FILE_REFS_COLLECTION].find({"sha256": {"$in": shas}}, {"sha256": 1, "claim_id": 1}):
+            if ref.get("claim_id") not in claim_keys:
+                shared.add(ref["sha256"])
+
+    blobs = []
+    for shas in _batches(sorted(candidates - shared)):
+        blobs.extend(db[FILE_BLOBS_COLLECTION].find(
+            {"_id": {"$in": shas}, "state": BLOB_READY, "backend": {"$nin": sorted(COLD_BACKENDS)}}
+        ))
+
+    legacy_files = []
+    legacy_query = {
+        "_id": {"$type": "objectId"},
+        "metadata.content_addressed": {"$ne": True},
+        "metadata.archive": {"$exists": False},
+    }
+    for keys in _batches(sorted(claim_keys)):
+        legacy_files.extend(db.fs.files.find({**legacy_query, "metadata.claim_id": {"$in": keys}},
+                                             {"filename": 1, "length": 1, "metadata": 1}))
+    for object_ids in _batches(claim_object_ids):
+        legacy_files.extend(db.fs.files.find(
+            {**legacy_query, "$or": [{"metadata.mongodb_id": {"$in": object_ids}},
+                                     {"metadata.claim_mongodb_id": {"$in": object_ids}}]},
+            {"filename": 1, "length": 1, "metadata": 1},
+        ))
+    legacy_files = list({file_doc["_id"]: file_doc for file_doc in legacy_files}.values())
+
+    if limit:
+        blobs, legacy_files = blobs[:limit], legacy_files[:limit]
+    return {"blobs": blobs, "legacy_files": legacy_files, "shared_kept_hot": len(shared)}
+
+
+def archive_blob(db, blob: Dict[str, Any], target: str = RETENTION_BACKEND) -> Tuple[int, int]:
+    """
+    Recompress one content-addressed blob into cold storage and point its record there
+
+    Returns:
+        (hot bytes freed, cold bytes written); (0, 0) if the blob changed meanwhile
+    """
+    source_store, source_key = blob_location(blob)
+    plain = rechunk(codec_for(blob.get("codec")).decode_stream(source_store.open(source_key)), ARCHIVE_CHUNK_SIZE)
+    codec, encoded = _encode(plain, archive_codec)
+    written = relocate_blob(db, blob, get_blob_store(target), encoded, codec.params(),
+                            {"archived_at": datetime.now(), "hot_backend": blob.get("backend") or GRIDFS})
+    if not written:
+        return 0, 0
+    return blob.get("stored_size", blob.get("size")) or 0, written
+
+
+def archive_legacy_file(db, file_doc: Dict[str, Any], target: str = RETENTION_BACKEND) -> Tuple[int, int]:
+    """
+    Move one legacy GridFS file's content to cold storage, leaving its fs.files document as a stub
+
+    Returns:
+        (hot bytes freed, cold bytes written); (0, 0) if the file changed meanwhile
+    """
+    obj_id = file_doc["_id"]
+    store = get_blob_store(target)
+    size = [0]
+    plain = rechunk(_counted(get_blob_store(GRIDFS).open(obj_id), size), ARCHIVE_CHUNK_SIZE)
+    codec, encoded = _encode(plain, archive_codec)
+    # Every attempt writes under its own key: of two overlapping runs, the one that loses the
+    # switch below deletes only its own copy
+    key = f"{obj_id}.{ObjectId()}"
+    written = store.put(key, encoded, {"legacy_file": True})
+    if file_doc.get("length") is not None and size[0] != file_doc["length"]:
+        # The chunks went away mid-read (archived or converted by another run)
+        store.delete(key)
+        return 0, 0
+
+    archive = {"backend": store.name, "location": key, "codec": codec.params(), "stored_size": written,
+               "archived_at": datetime.now()}
+    update = {"metadata.archive": archive} if file_doc.get("metadata") is not None else {"metadata": {"archive": archive}}
+    if file_doc.get("length") is None:
+        # Files from the old upload handlers have no length; the stub still reports the size
+        update["length"] = size[0]
+    # Readers switch to the cold copy before the chunks go; a file deleted meanwhile is left alone
+    switched = db.fs.files.update_one({"_id": obj_id, "metadata.archive": {"$exists": False}}, {"$set": update})
+    if not switched.modified_count:
+        store.delete(key)
+        return 0, 0
+    db.fs.chunks.delete_many({"files_id": obj_id})
+    return size[0], written
+
+
+def rehydrate_blob(db, sha256: str) -> int:
+    """
+    Move an archived blob back to the hot backend, compressed per the usual content-type policy
+
+    Returns:
+        Bytes written to the hot backend (0 if it wasn't archived or changed meanwhile)
+    """
+    blob = db[FILE_BLOBS_COLLECTION].find_one(
+        {"_id": sha256, "state": BLOB_READY, "backend": {"$in": sorted(COLD_BACKENDS)}}
+    )
+    if not blob:
+        return 0
+    ref = db[FILE_REFS_COLLECTION].find_one({"sha256": sha256}, {"content_type": 1}) or {}
+    source_store, source_key = blob_location(blob)
+    plain = rechunk(codec_for(blob.get("codec")).decode_stream(source_store.open(source_key)), READ_CHUNK_SIZE)
+    codec, encoded = _encode(plain, lambda sample: choose_codec(ref.get("content_type"), sample))
+    return relocate_blob(db, blob, get_blob_store(FILE_BLOB_BACKEND), encoded, codec.params(),
+                         {"rehydrated_at": datetime.now()})
+
+
+def rehydrate_file(file_id: str) -> int:
+    """
+    Bring one file's content back to the hot tier
+
+    Archived legacy stubs are converted to content-addressed files with the same ID.
+
+    Returns:
+        Bytes written to the hot backend
+    """
+    db = get_db()
+    try:
+        obj_id = ObjectId(file_id)
+    except Exception:
+        return 0
+    ref = db[FILE_REFS_COLLECTION].find_one({"_id": obj_id}, {"sha256": 1})
+    if ref:
+        return rehydrate_blob(db, ref["sha256"])
+    file_doc = db.fs.files.find_one({"_id": obj_id, "metadata.archive": {"$exists": True}})
+    if file_doc:
+        return migrate_legacy_file(db, file_doc, FILE_BLOB_BACKEND)
+    return 0
+
+
+def schedule_rehydrate(file_id: str) -> None:
+    """Rehydrate a file that was just read from cold storage, in the background"""
+    if not RETENTION_REHYDRATE_ON_READ:
+        return
+    # Files sharing deduplicated content are one rehydration; relocate_blob's claim on the
+    # blob record keeps other processes from running the same one at once
+    ref = None
+    if ObjectId.is_valid(file_id):
+        ref = get_db()[FILE_REFS_COLLECTION].find_one({"_id": ObjectId(file_id)}, {"sha256": 1})
+    key = ref["sha256"] if ref else file_id
+    with _rehydrating_lock:
+        if key in _rehydrating:
+            return
+        _rehydrating.add(key)
+
+    def _run():
+        try:
+            written = rehydrate_blob(get_db(), key) if ref else rehydrate_file(file_id)
+            if written:
+                print(f"Rehydrated file {file_id} ({written} bytes) to the {FILE_BLOB_BACKEND} blob store")
+        except Exception as e:
+            print(f"Error rehydrating file {file_id}: {str(e)}")
+        finally:
+            with _rehydrating_lock:
+                _rehydrating.discard(key)
+
+    _rehydrate_pool.submit(_run)
+
+
+def run(target: str = RETENTION_BACKEND, statuses: List[str] = RETENTION_STATUSES,
+        older_than_days: int = RETENTION_DAYS, workers: int = 4, limit: Optional[int] = None,
+        dry_run: bool = False) -> Dict[str, Any]:
+    """
+    Apply the retention policy
+
+    Returns:
+        A report of what was (or, with ``dry_run``, would be) moved
+    """
+    planned = plan(statuses, older_than_days, limit)
+    blobs, legacy_files = planned["blobs"], planned["legacy_files"]
+    report: Dict[str, Any] = {
+        "target": target,
+        "statuses": statuses,
+        "older_than_days": older_than_days,
+        "blobs": len(blobs),
+        "blob_bytes": sum(blob.get("stored_size", blob.get("size")) or 0 for blob in blobs),
+        "legacy_files": len(legacy_files),
+        "legacy_bytes": sum(file_doc.get("length") or 0 for file_doc in legacy_files),
+        "shared_kept_hot": planned["shared_kept_hot"],
+        "dry_run": dry_run,
+    }
+    if dry_run:
+        return report
+
+    db = get_db()
+    started = time.perf_counter()
+    freed = 0
+    written = 0
+    failures = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(archive_blob, db, blob, target): blob["_id"] for blob in blobs}
+        futures.update({
+            executor.submit(archive_legacy_file, db, file_doc, target): str(file_doc["_id"])
+            for file_doc in legacy_files
+        })
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                hot, cold = future.result()
+                freed += hot
+                written += cold
+            except Exception as e:
+                failures.append({"id": futures[future], "error": str(e)})
+                print(f"Error archiving {futures[future]}: {e}")
+            if done % 100 == 0:
+                print(f"{done}/{len(futures)} archived")
+
+    report.update({
+        "hot_bytes_freed": freed,
+        "cold_bytes_written": written,
+        "failures": failures,
+        "seconds": round(time.perf_counter() - started, 2),
+    })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move old claims' files to compressed cold storage")
+    parser.add_argument("--to", dest="target", default=RETENTION_BACKEND, choices=[COLD_LOCAL, COLD_S3])
+    parser.add_argument("--statuses", nargs="+", default=RETENTION_STATUSES, help="Claim statuses to archive")
+    parser.add_argument("--older-than-days", type=int, default=RETENTION_DAYS, help="Minimum claim age")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--limit", type=int, help="At most this many blobs (and legacy files)")
+    parser.add_argument("--dry-run", action="store_true", help="Only report the bytes that would move")
+    parser.add_argument("--rehydrate", metavar="FILE_ID", help="Bring one file back to the hot tier instead")
+    args = parser.parse_args()
+
+    if args.rehydrate:
+        print(f"Rehydrated {rehydrate_file(args.rehydrate)} bytes")
+        return
+    report = run(args.target, args.statuses, args.older_than_days, args.workers, args.limit, args.dry_run)
+    for key, value in report.items():
+        if key != "failures":
+            print(f"{key}: {value}")
+    if report.get("failures"):
+        print(f"failures: {len(report['failures'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Regression tests for concurrent moves of stored file content (retention.py, migrate_blobs.py).
+
+Overlapping moves of one blob or legacy file (two rehydrations of shared content, two
+retention runs, a relocation taken over as stale) must leave the content readable.
+Runs against mongomock and temporary directories, like load_test.py:
+
+    python retention_test.py
+"""
+
+import io
+import os
+import shutil
+import tempfile
+
+import mongomock
+import pymongo
+from bson import ObjectId
+
+_workdir = tempfile.mkdtemp(prefix="retention-test-")
+os.environ.update({
+    "MONGODB_URI": "mongodb://localhost:27017",
+    "DB_NAME": "claims-retention-test",
+    "FILE_BLOB_BACKEND": "gridfs",
+    "FILE_BLOB_DIR": os.path.join(_workdir, "blobs"),
+    "FILE_COLD_DIR": os.path.join(_workdir, "cold-blobs"),
+})
+pymongo.MongoClient = mongomock.MongoClient
+
+import file_storage  # noqa: E402
+import retention  # noqa: E402
+from blob_store import COLD_LOCAL, FILE_COLD_DIR, GRIDFS, get_blob_store  # noqa: E402
+from database import get_db  # noqa: E402
+
+CONTENT = b"Claim correspondence, archived and brought back. " * 20000
+
+
+def _reset():
+    db = get_db()
+    for name in db.list_collection_names():
+        db.drop_collection(name)
+    shutil.rmtree(FILE_COLD_DIR, ignore_errors=True)
+    return db
+
+
+def _store_shared(db, copies=2):
+    """Files of one claim sharing deduplicated content; returns their IDs and the hash"""
+    infos = [
+        file_storage._save_source(io.BytesIO(CONTENT), None, None, f"letter-{n}.txt", "text/plain", "CLM-1", None)
+        for n in range(copies)
+    ]
+    return [info["file_id"] for info in infos], infos[0]["sha256"]
+
+
+def _cold_files():
+    return sorted(name for _, _, names in os.walk(FILE_COLD_DIR) for name in names if not name.startswith("."))
+
+
+def _overlapping(store, during):
+    """Make the next put to ``store`` run ``during()`` first, as an overlapping attempt would"""
+    put = store.put
+    results = []
+
+    def put_with_overlap(key, chunks, metadata=None):
+        del store.put
+        results.append(during())
+        return put(key, chunks, metadata)
+
+    store.put = put_with_overlap
+    return results
+
+
+def _assert_readable(db, file_ids, content=CONTENT):
+    for file_id in file_ids:
+        located = file_storage.read_file_bytes(db, file_id)
+        assert located is not None, f"file {file_id} is gone"
+        assert located[1] == content, f"file {file_id}: read {len(located[1])} of {len(content)} bytes"
+
+
+def test_concurrent_rehydrations_keep_content():
+    db = _reset()
+    file_ids, sha256 = _store_shared(db)
+    blob = db[file_storage.FILE_BLOBS_COLLECTION].find_one({"_id": sha256})
+    assert retention.archive_blob(db, blob, COLD_LOCAL)[1] > 0
+
+    # A second rehydration (another file sharing the content, or another process) starts while
+    # the first is writing: it must back off rather than write the same object
+    overlapping = _overlapping(get_blob_store(GRIDFS), lambda: retention.rehydrate_blob(db, sha256))
+    assert retention.rehydrate_blob(db, sha256) > 0
+    assert overlapping == [0]
+
+    blob = db[file_storage.FILE_BLOBS_COLLECTION].find_one({"_id": sha256})
+    assert blob["backend"] == GRIDFS and "relocating" not in blob
+    assert _cold_files() == []
+    _assert_readable(db, file_ids)
+
+
+def test_stale_relocation_taken_over_keeps_content():
+    db = _reset()
+    file_ids, sha256 = _store_shared(db)
+    blob = db[file_storage.FILE_BLOBS_COLLECTION].find_one({"_id": sha256})
+    retention.archive_blob(db, blob, COLD_LOCAL)
+
+    # The first rehydration is slow enough to be presumed dead: the second takes over and wins,
+    # and the first must only delete what it wrote itself
+    timeout = file_storage.BLOB_RELOCATE_TIMEOUT
+    file_storage.BLOB_RELOCATE_TIMEOUT = -1
+    try:
+        overlapping = _overlapping(get_blob_store(GRIDFS), lambda: retention.rehydrate_blob(db, sha256))
+        first = retention.rehydrate_blob(db, sha256)
+    finally:
+        file_storage.BLOB_RELOCATE_TIMEOUT = timeout
+    assert first == 0 and overlapping[0] > 0
+
+    blob = db[file_storage.FILE_BLOBS_COLLECTION].find_one({"_id": sha256})
+    assert blob["backend"] == GRIDFS and "relocating" not in blob
+    assert db.fs.files.count_documents({"metadata.content_addressed": True}) == 1
+    _assert_readable(db, file_ids)
+
+
+def test_overlapping_legacy_archives_keep_content():
+    db = _reset()
+    legacy_id = ObjectId()
+    get_blob_store(GRIDFS).put(legacy_id, [CONTENT[:261120], CONTENT[261120:]], {"claim_id": "CLM-1"})
+
+    # Two retention runs archive the same legacy file at once; the later one loses the switch
+    file_doc = db.fs.files.find_one({"_id": legacy_id})
+    overlapping = _overlapping(get_blob_store(COLD_LOCAL), lambda: retention.archive_legacy_file(db, file_doc))
+    assert retention.archive_legacy_file(db, file_doc) == (0, 0)
+    assert overlapping[0][1] > 0
+
+    stub = db.fs.files.find_one({"_id": legacy_id})
+    assert _cold_files() == [stub["metadata"]["archive"]["location"]]
+    assert db.fs.chunks.count_documents({"files_id": legacy_id}) == 0
+    _assert_readable(db, [str(legacy_id)])
+
+
+if __name__ == "__main__":
+    try:
+        for name, test in list(globals().items()):
+            if name.startswith("test_") and callable(test):
+                test()
+                print(f"{name}: ok")
+    finally:
+        shutil.rmtree(_workdir, ignore_errors=True)
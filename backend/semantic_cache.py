@@ -0,0 +1,167 @@
+"""
+Semantic response cache for the RAG guidance endpoints.
+
+A cache hit requires cosine similarity to a previous query embedding at or
+above the threshold, exactly the same set of retrieved precedent ids, and the
+same scope. Only output that doesn't depend on one claimant's details
+belongs here: the guidance endpoints cache guidance written from the claim's
+profile (condition, treatment, insurer - also the scope) and the precedents,
+and write the patient-specific appeal letter for every request. Entries
+expire after a TTL and the least recently used ones are evicted beyond the
+size limit. Hit rates are tracked per endpoint.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from itertools import count
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.97"))
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", str(24 * 3600)))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "1000"))
+
+
+class _CacheEntry:
+    __slots__ = ("vector", "precedent_ids", "scope", "value", "expires_at")
+
+    def __init__(self, vector: np.ndarray, precedent_ids: Tuple[str, ...], scope: Optional[str], value: Any,
+                 expires_at: float):
+        self.vector = vector
+        self.precedent_ids = precedent_ids
+        self.scope = scope
+        self.value = value
+        self.expires_at = expires_at
+
+
+class _EndpointCache:
+    """Entries for one endpoint, with a lazily rebuilt matrix of their vectors"""
+
+    def __init__(self):
+        self.entries: "OrderedDict[int, _CacheEntry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._matrix: Optional[np.ndarray] = None
+        self._keys: Tuple[int, ...] = ()
+
+    def invalidate(self) -> None:
+        self._matrix = None
+
+    def matrix(self) -> Tuple[Tuple[int, ...], np.ndarray]:
+        if self._matrix is None:
+            self._keys = tuple(self.entries)
+            self._matrix = np.vstack([self.entries[key].vector for key in self._keys])
+        return self._keys, self._matrix
+
+
+def _unit(embedding: Iterable[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SemanticCache:
+    """Thread-safe embedding-keyed cache shared by all endpoints"""
+
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, ttl_seconds: float = SEMANTIC_CACHE_TTL,
+                 max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._endpoints: Dict[str, _EndpointCache] = {}
+        self._ids = count()
+        self._lock = threading.Lock()
+
+    def _endpoint(self, endpoint: str) -> _EndpointCache:
+        if endpoint not in self._endpoints:
+            self._endpoints[endpoint] = _EndpointCache()
+        return self._endpoints[endpoint]
+
+    def _expire(self, cache: _EndpointCache, now: float) -> None:
+        expired = [key for key, entry in cache.entries.items() if entry.expires_at <= now]
+        for key in expired:
+            del cache.entries[key]
+        if expired:
+            cache.invalidate()
+
+    def lookup(self, endpoint: str, embedding: Iterable[float], precedent_ids: Iterable[str],
+               scope: Optional[str] = None) -> Optional[Any]:
+        """
+        Find a cached response for a query
+
+        Args:
+            endpoint: Cache namespace (one per endpoint)
+            embedding: The query embedding
+            precedent_ids: Ids of the precedents retrieved for this query
+            scope: Only entries stored with the same scope match
+
+        Returns:
+            The value of the most similar live entry, or None on a miss
+        """
+        vector = _unit(embedding)
+        ids = tuple(sorted(precedent_ids))
+        with self._lock:
+            cache = self._endpoint(endpoint)
+            self._expire(cache, time.time())
+
+            best_key = None
+            if cache.entries:
+                keys, matrix = cache.matrix()
+                similarities = matrix @ vector
+                for position in np.argsort(-similarities):
+                    if similarities[position] < self.threshold:
+                        break
+                    entry = cache.entries[keys[position]]
+                    if entry.precedent_ids == ids and entry.scope == scope:
+                        best_key = keys[position]
+                        break
+
+            if best_key is None:
+                cache.misses += 1
+                return None
+
+            cache.hits += 1
+            cache.entries.move_to_end(best_key)
+            return cache.entries[best_key].value
+
+    def store(self, endpoint: str, embedding: Iterable[float], precedent_ids: Iterable[str], value: Any,
+              scope: Optional[str] = None) -> None:
+        """
+        Cache a response
+
+        Args:
+            endpoint: Cache namespace (one per endpoint)
+            embedding: The query embedding
+            precedent_ids: Ids of the precedents the response was generated from
+            value: The response to cache
+            scope: What else a query must share to reuse the response (e.g. a hash of the claim profile)
+        """
+        entry = _CacheEntry(_unit(embedding), tuple(sorted(precedent_ids)), scope, value,
+                            time.time() + self.ttl_seconds)
+        with self._lock:
+            cache = self._endpoint(endpoint)
+            cache.entries[next(self._ids)] = entry
+            while len(cache.entries) > self.max_entries:
+                cache.entries.popitem(last=False)
+            cache.invalidate()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._endpoints.clear()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Hit/miss counts, hit rate and size for each endpoint"""
+        with self._lock:
+            report = {}
+            for endpoint, cache in self._endpoints.items():
+                lookups = cache.hits + cache.misses
+                report[endpoint] = {
+                    "hits": cache.hits,
+                    "misses": cache.misses,
+                    "hit_rate": cache.hits / lookups if lookups else 0.0,
+                    "entries": len(cache.entries),
+                }
+            return report
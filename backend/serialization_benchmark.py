@@ -0,0 +1,181 @@
+"""
+Microbenchmarks for the claim serialization hot paths.
+
+Times, at list sizes from 1 to 1000 claims:
+
+* ``validated``: the original GET /claims path: ``_convert_objectid_to_str``,
+  ``ClaimInDB(**doc)`` per claim, FastAPI's response-model round trip
+  (``model_dump`` then ``ClaimsResponse`` validation and JSON-mode dump) and
+  ``json.dumps``,
+* ``validated_once``: the path now used by GET /claims: stored documents
+  (projected to the model's fields) validated and dumped once through
+  ``ClaimsResponse``,
+* ``raw_orjson``: stored documents straight into ``orjson``, without
+  validation (the lower bound),
+* ``summary``: ``view=summary`` list rows validated and dumped through
+  ``ClaimSummariesResponse`` (Mongo projects the fields; here the extra keys
+  are just ignored),
+* ``convert_objectid``: ``_convert_objectid_to_str`` alone,
+* ``update_roundtrip``: ``Claim(**claim.model_dump())``, as the file
+  attachment paths used to do per upload.
+
+Each case reports pytest-benchmark style statistics (min / mean / median /
+stddev per round, rounds, ops/s) plus microseconds per claim.
+
+Usage:
+    python serialization_benchmark.py --sizes 1 10 100 1000 --output serialization.json
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List
+
+import orjson
+from bson import ObjectId
+
+# No queries are made; don't wait 30s for database.py's import-time connection check
+os.environ.setdefault("MONGODB_URI", "mongodb://localhost:27017/?serverSelectionTimeoutMS=1000")
+
+from claim_models import Claim, ClaimInDB, ClaimStatus  # noqa: E402
+from claim_service import _convert_objectid_to_str  # noqa: E402
+from claims_api import ClaimsResponse, ClaimSummariesResponse  # noqa: E402
+
+DEFAULT_SIZES = [1, 10, 100, 1000]
+
+
+def stored_claims(count: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """Claim documents as pymongo returns them (ObjectId _id, datetime submittedAt)"""
+    rng = random.Random(seed)
+    now = datetime(2024, 3, 1, 12, 0, 0)
+    docs = []
+    for i in range(count):
+        claim = Claim(
+            provider={"providerType": rng.choice(["psychologist", "psychiatrist", "therapist"]),
+                      "providerName": f"Dr. Bench {i}", "providerNPI": "1234567890",
+                      "practiceName": "Wellness Center", "providerAddress": "123 Main St"},
+            patient={"patientName": f"Patient {i}", "patientDob": "1985-06-15",
+                     "patientInsuranceId": f"INS{i:09d}", "patientInsuranceProvider": "Blue Cross Blue Shield"},
+            service={"serviceType": "individual-therapy", "serviceDate": "2023-10-15", "totalCharge": "150.00",
+                     "cptCode": "90834", "diagnosisCode": "F41.1",
+                     "serviceDescription": "Individual psychotherapy, 45 minutes",
+                     "uploadedFiles": [str(ObjectId()) for _ in range(rng.randint(0, 4))]},
+            submittedAt=now - timedelta(minutes=i),
+            status=rng.choice(list(ClaimStatus)),
+            claimId=f"MH-2024-{i:04d}",
+        )
+        doc = claim.model_dump()
+        doc["status"] = doc["status"].value
+        doc["provider"]["providerType"] = doc["provider"]["providerType"].value
+        doc["service"]["serviceType"] = doc["service"]["serviceType"].value
+        doc["_id"] = ObjectId()
+        docs.append(doc)
+    return docs
+
+
+def _copy(docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # A cursor hands out fresh dicts; _convert_objectid_to_str mutates them
+    return [dict(doc) for doc in docs]
+
+
+def validated(docs: List[Dict[str, Any]]) -> bytes:
+    claims = [ClaimInDB(**_convert_objectid_to_str(doc)) for doc in docs]
+    # FastAPI dumps returned models, re-validates them against response_model, then serializes
+    content = {"claims": [claim.model_dump() for claim in claims], "total": len(claims)}
+    response = ClaimsResponse.model_validate(content)
+    return json.dumps(response.model_dump(mode="json")).encode("utf-8")
+
+
+def validated_once(docs: List[Dict[str, Any]]) -> bytes:
+    for doc in docs:
+        doc.pop("_id", None)  # done by the CLAIM_PROJECTION in the query itself
+    return ClaimsResponse.model_validate({"claims": docs, "total": len(docs)}).model_dump_json().encode("utf-8")
+
+
+def raw_orjson(docs: List[Dict[str, Any]]) -> bytes:
+    for doc in docs:
+        doc.pop("_id", None)
+    return orjson.dumps({"claims": docs, "total": len(docs)})
+
+
+def summary(docs: List[Dict[str, Any]]) -> bytes:
+    return ClaimSummariesResponse.model_validate({"claims": docs, "total": len(docs)}).model_dump_json().encode("utf-8")
+
+
+def convert_objectid(docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [_convert_objectid_to_str(doc) for doc in docs]
+
+
+def update_roundtrip(docs: List[Dict[str, Any]]) -> List[Claim]:
+    claims = [ClaimInDB(**_convert_objectid_to_str(doc)) for doc in docs]
+    return [Claim(**claim.model_dump()) for claim in claims]
+
+
+CASES: Dict[str, Callable[[List[Dict[str, Any]]], Any]] = {
+    "validated": validated,
+    "validated_once": validated_once,
+    "raw_orjson": raw_orjson,
+    "summary": summary,
+    "convert_objectid": convert_objectid,
+    "update_roundtrip": update_roundtrip,
+}
+
+
+def bench(fn: Callable[[List[Dict[str, Any]]], Any], docs: List[Dict[str, Any]],
+          min_time: float = 0.5, min_rounds: int = 5, max_rounds: int = 1000) -> Dict[str, float]:
+    """Run ``fn`` on fresh copies of ``docs`` until ``min_time`` has elapsed; per-round stats in ms"""
+    fn(_copy(docs))  # warm up
+    rounds: List[float] = []
+    spent = 0.0
+    while len(rounds) < max_rounds and (len(rounds) < min_rounds or spent < min_time):
+        batch = _copy(docs)
+        started = time.perf_counter()
+        fn(batch)
+        elapsed = time.perf_counter() - started
+        rounds.append(elapsed * 1000)
+        spent += elapsed
+    mean = statistics.fmean(rounds)
+    return {
+        "rounds": len(rounds),
+        "min_ms": min(rounds),
+        "mean_ms": mean,
+        "median_ms": statistics.median(rounds),
+        "stddev_ms": statistics.stdev(rounds) if len(rounds) > 1 else 0.0,
+        "ops_per_s": 1000 / mean if mean else 0.0,
+        "us_per_claim": mean * 1000 / len(docs),
+    }
+
+
+def run(sizes: List[int], cases: List[str], min_time: float) -> Dict[str, Dict[str, Dict[str, float]]]:
+    results: Dict[str, Dict[str, Dict[str, float]]] = {}
+    for size in sizes:
+        docs = stored_claims(size)
+        results[str(size)] = {name: bench(CASES[name], docs, min_time=min_time) for name in cases}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark claim serialization paths")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Claims per list")
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES))
+    parser.add_argument("--min-time", type=float, default=0.5, help="Seconds to spend per case and size")
+    parser.add_argument("--output", help="Write the JSON results to this path")
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.cases, args.min_time)
+    print(f"{'size':>6} {'case':18} {'median ms':>10} {'mean ms':>10} {'stddev':>8} {'us/claim':>9} {'rounds':>7}")
+    for size, cases in results.items():
+        for name, stats in cases.items():
+            print(f"{size:>6} {name:18} {stats['median_ms']:10.3f} {stats['mean_ms']:10.3f} "
+                  f"{stats['stddev_ms']:8.3f} {stats['us_per_claim']:9.2f} {stats['rounds']:7}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
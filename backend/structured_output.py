@@ -0,0 +1,354 @@
+"""
+Robust JSON extraction for LLM responses.
+
+Replaces the ad-hoc ``json.loads`` / greedy ``re.search(r'\\{.*\\}')`` /
+code-fence stripping scattered across the backend with one parser that
+
+* locates the JSON value in the response, ignoring prose and ```json fences
+  around it (brackets in the prose are skipped: each later opening bracket
+  is tried in turn, and only objects when an object is expected),
+* repairs common defects: trailing commas, Python literals
+  (True / False / None), raw newlines inside strings, output truncated
+  mid-object,
+* validates into a pydantic model, and re-prompts the model only when the
+  output is irreparable,
+* can parse a streamed completion incrementally, reporting each top-level
+  field as soon as its value is complete.
+
+Usage:
+    from structured_output import complete_structured
+
+    claim = complete_structured(llm_client, messages, schema=HealthClaim, temperature=0.1)
+"""
+
+import json
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Type
+
+from pydantic import BaseModel, ValidationError
+
+_CLOSERS = {"{": "}", "[": "]"}
+_PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+# Opening brackets tried as the start of the JSON value before giving up
+MAX_JSON_STARTS = 20
+
+
+class StructuredOutputError(ValueError):
+    """The LLM response could not be turned into the requested structure"""
+
+    def __init__(self, message: str, raw: str = ""):
+        super().__init__(message)
+        self.raw = raw
+
+
+def _json_starts(text: str, openers: str = "{[") -> List[int]:
+    """Positions of the first ``MAX_JSON_STARTS`` opening brackets in ``text``"""
+    starts: List[int] = []
+    for i, char in enumerate(text):
+        if char in openers:
+            starts.append(i)
+            if len(starts) == MAX_JSON_STARTS:
+                break
+    return starts
+
+
+def _repair_candidates(text: str, start: int) -> List[str]:
+    """
+    Candidate JSON strings for the object/array opening at ``text[start]``, best first
+
+    The first candidate is the value with trailing commas and Python literals
+    fixed and, if the text was truncated, its open string and containers
+    closed. Truncated text also yields fallbacks cut back to each earlier
+    comma or opening bracket, for output that stopped mid-key or mid-literal.
+    """
+    out: List[str] = []
+    stack: List[str] = []
+    # Positions a truncated value can be cut back to: each comma and just after each opener
+    cuts: List[Tuple[int, Tuple[str, ...]]] = []
+    in_string = escape = False
+    i = start
+    while i < len(text):
+        char = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+            elif char == "\n":
+                char = "\\n"
+            out.append(char)
+            i += 1
+            continue
+
+        if char == '"':
+            in_string = True
+        elif char in _CLOSERS:
+            stack.append(char)
+            cuts.append((len(out) + 1, tuple(stack)))
+        elif char in "}]":
+            # Drop a trailing comma before the closer
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            if stack:
+                stack.pop()
+            out.append(char)
+            if not stack:
+                return ["".join(out)]
+            i += 1
+            continue
+        elif char == ",":
+            cuts.append((len(out), tuple(stack)))
+        elif char.isalpha():
+            end = i
+            while end < len(text) and text[end].isalpha():
+                end += 1
+            word = text[i:end]
+            out.append(_PYTHON_LITERALS.get(word, word))
+            i = end
+            continue
+        out.append(char)
+        i += 1
+
+    # Truncated output: close the open string and containers
+    closed = list(out)
+    if in_string:
+        if escape:
+            closed.pop()
+        closed.append('"')
+    candidate = "".join(closed).rstrip().rstrip(",:").rstrip()
+    candidates = [candidate + "".join(_CLOSERS[opener] for opener in reversed(stack))]
+    for position, open_stack in reversed(cuts):
+        candidates.append("".join(out[:position]) + "".join(_CLOSERS[opener] for opener in reversed(open_stack)))
+    return candidates
+
+
+def repair_json(text: str) -> str:
+    """
+    Cut the first JSON object/array out of ``text`` and fix common defects
+
+    Returns:
+        A candidate JSON string (not guaranteed to parse)
+
+    Raises:
+        StructuredOutputError: If the text contains no JSON object or array
+    """
+    starts = _json_starts(text)
+    if not starts:
+        raise StructuredOutputError("No JSON object found in response", text)
+    return _repair_candidates(text, starts[0])[0]
+
+
+def extract_json(text: str, expect: Optional[type] = None) -> Any:
+    """
+    Parse the JSON value in an LLM response, repairing it if necessary
+
+    Each opening bracket is tried as the start of the value in turn, so
+    brackets in prose before the JSON (``Sure [note]: {...}``) are skipped.
+
+    Args:
+        text: The response
+        expect: ``dict`` or ``list`` to only accept a value of that type
+
+    Raises:
+        StructuredOutputError: If no parseable JSON (of the expected type) can be recovered
+    """
+    if text is None:
+        raise StructuredOutputError("Empty response")
+    stripped = text.strip()
+    try:
+        data = json.loads(stripped)
+        if expect is None or isinstance(data, expect):
+            return data
+    except ValueError:
+        pass
+
+    openers = {dict: "{", list: "["}.get(expect, "{[")
+    starts = _json_starts(stripped, openers)
+    if not starts:
+        raise StructuredOutputError("No JSON object found in response", text)
+    error: Optional[ValueError] = None
+    for start in starts:
+        for candidate in _repair_candidates(stripped, start):
+            try:
+                data = json.loads(candidate, strict=False)
+            except ValueError as e:
+                error = error or e
+                continue
+            if expect is None or isinstance(data, expect):
+                return data
+    if error is None:
+        raise StructuredOutputError(f"Expected a JSON {'object' if expect is dict else 'array'}", text)
+    raise StructuredOutputError(f"Could not parse JSON from response: {error}", text) from error
+
+
+def parse_structured(text: str, schema: Optional[Type[BaseModel]] = None):
+    """
+    Parse an LLM response into ``schema`` (or a plain dict when schema is None)
+
+    Raises:
+        StructuredOutputError: On unparseable JSON or schema mismatch
+    """
+    # Both a schema and the plain-dict result are JSON objects
+    data = extract_json(text, expect=dict)
+    if schema is None:
+        if not isinstance(data, dict):
+            raise StructuredOutputError("Expected a JSON object", text)
+        return data
+    try:
+        return schema.model_validate(data)
+    except ValidationError as e:
+        raise StructuredOutputError(f"Response does not match {schema.__name__}: {e}", text) from e
+
+
+class IncrementalJSONParser:
+    """
+    Feed a streamed JSON object chunk by chunk
+
+    ``feed`` returns the top-level fields whose values completed in that
+    chunk, so callers can use them before the completion finishes. Scanning
+    is incremental; each field is parsed once, when it completes.
+    """
+
+    def __init__(self):
+        self._chars: List[str] = []
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._started = False
+        self._expect_key = False
+        self._key_chars: Optional[List[str]] = None
+        self._current_key: Optional[str] = None
+        self.fields: Dict[str, Any] = {}
+        self.done = False
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chars)
+
+    def _complete_field(self, closing: bool) -> Optional[Tuple[str, Any]]:
+        key = self._current_key
+        self._current_key = None
+        if key is None:
+            return None
+        snapshot = self.text if closing else self.text[:-1] + "}"
+        try:
+            value = extract_json(snapshot, expect=dict).get(key)
+        except (StructuredOutputError, AttributeError):
+            return None
+        self.fields[key] = value
+        return key, value
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        """Consume a chunk; return (key, value) for each top-level field completed by it"""
+        completed = []
+        for char in chunk:
+            if self.done:
+                break
+            if not self._started:
+                if char != "{":
+                    continue
+                self._started = True
+
+            self._chars.append(char)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._key_chars is not None:
+                        self._current_key = json.loads('"' + "".join(self._key_chars) + '"')
+                        self._key_chars = None
+                        self._expect_key = False
+                    continue
+                if self._key_chars is not None:
+                    self._key_chars.append(char)
+                continue
+
+            if char == '"':
+                self._in_string = True
+                if len(self._stack) == 1 and self._expect_key:
+                    self._key_chars = []
+            elif char in _CLOSERS:
+                self._stack.append(char)
+                if len(self._stack) == 1:
+                    self._expect_key = True
+            elif char in "}]":
+                if self._stack:
+                    self._stack.pop()
+                if not self._stack:
+                    field = self._complete_field(closing=True)
+                    if field:
+                        completed.append(field)
+                    self.done = True
+            elif char == "," and len(self._stack) == 1:
+                field = self._complete_field(closing=False)
+                if field:
+                    completed.append(field)
+                self._expect_key = True
+        return completed
+
+    def result(self, schema: Optional[Type[BaseModel]] = None):
+        """Parse everything fed so far (repairing truncation) into ``schema`` or a dict"""
+        return parse_structured(self.text, schema)
+
+
+def _reprompt_messages(messages: List[Dict[str, str]], raw: str, error: Exception) -> List[Dict[str, str]]:
+    return messages + [
+        {"role": "assistant", "content": raw or ""},
+        {"role": "user", "content": (
+            f"Your previous response could not be used: {error}. "
+            "Reply with only the corrected JSON object, no other text."
+        )},
+    ]
+
+
+def complete_structured(llm, messages: List[Dict[str, str]], schema: Optional[Type[BaseModel]] = None,
+                        max_reprompts: int = 1, stream: bool = False,
+                        on_field: Optional[Callable[[str, Any], None]] = None, **completion_params):
+    """
+    Run a completion and parse it into ``schema``, re-prompting only on irreparable output
+
+    Args:
+        llm: An ``llm_client.CachedLLMClient``
+        messages: Chat messages
+        schema: Pydantic model to validate into; None returns a plain dict
+        max_reprompts: Extra attempts after an irreparable response
+        stream: Stream the completion and call ``on_field`` as fields complete
+        on_field: Called as ``on_field(key, value)`` for each completed top-level field
+        **completion_params: Passed to ``llm.complete`` / ``llm.stream`` (model, temperature, ...)
+
+    Returns:
+        The validated model instance (or dict)
+
+    Raises:
+        StructuredOutputError: If every attempt fails
+    """
+    attempt_messages = messages
+    last_error: Optional[StructuredOutputError] = None
+    for _attempt in range(max_reprompts + 1):
+        if stream:
+            parser = IncrementalJSONParser()
+            for chunk in llm.stream(attempt_messages, **completion_params):
+                for key, value in parser.feed(chunk):
+                    if on_field is not None:
+                        on_field(key, value)
+            raw = parser.text
+        else:
+            raw = llm.complete(attempt_messages, **completion_params)
+
+        try:
+            return parse_structured(raw, schema)
+        except StructuredOutputError as e:
+            print(f"Structured output attempt failed: {e}")
+            last_error = e
+            # The same prompt would be served from the completion cache; the
+            # corrective turn changes the fingerprint
+            attempt_messages = _reprompt_messages(messages, raw, e)
+
+    raise last_error
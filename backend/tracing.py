@@ -0,0 +1,433 @@
+"""
+Request-scoped latency tracing for external calls.
+
+Every request handled by the API gets a root span (see ``TraceMiddleware``);
+calls to Jina, Pinecone, the LLM providers and MongoDB open child spans with
+their duration, payload sizes, token counts and cache hits as attributes.
+Spans follow the OpenTelemetry data model (32-hex trace id, 16-hex span id,
+parent id, start/end in unix nanoseconds, attributes, status) and are
+
+* kept per trace in an in-memory ring buffer (served by ``/debug/traces``),
+* appended as JSON lines to ``TRACE_EXPORT_PATH`` when set (local exporter,
+  written from a background thread),
+* mirrored to an OpenTelemetry tracer when ``opentelemetry-api`` is installed,
+* aggregated into Prometheus metrics (``render_prometheus``).
+
+MongoDB commands (claims collection and GridFS) are traced by registering
+``MongoCommandTracer`` on the ``MongoClient``.
+
+Usage:
+    from tracing import span
+
+    with span("jina.embeddings", texts=len(texts)) as s:
+        resp = ...
+        s.set("payload.response_bytes", len(resp.content))
+"""
+
+import atexit
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+from pymongo import monitoring
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "200"))
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH")
+
+# Spans kept per trace; a streamed download records one MongoDB span per getMore, so
+# long requests would otherwise hold thousands. Further spans still count in the metrics.
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "500"))
+# Finished traces waiting for the exporter thread; beyond this they are dropped, not waited for
+TRACE_EXPORT_QUEUE_SIZE = 1000
+
+# Prometheus histogram buckets for span durations, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+try:
+    from opentelemetry import trace as _otel_trace
+    _otel_tracer = _otel_trace.get_tracer("hofhack.backend")
+except ImportError:
+    _otel_tracer = None
+
+
+class Span:
+    """One timed operation within a trace"""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "status", "error")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = {key: value for key, value in attributes.items() if value is not None}
+        self.status = "UNSET"
+        self.error: Optional[str] = None
+
+    def set(self, key: str, value: Any) -> None:
+        if value is not None:
+            self.attributes[key] = value
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end - self.start_ns) / 1e6
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "start_time_unix_nano": self.start_ns,
+            "end_time_unix_nano": self.end_ns,
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "status": {"code": self.status, "message": self.error},
+        }
+
+
+class _Trace:
+    __slots__ = ("trace_id", "spans", "open_spans", "dropped_spans")
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: List[Span] = []
+        self.open_spans = 0
+        self.dropped_spans = 0
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+_current_trace: ContextVar[Optional[_Trace]] = ContextVar("current_trace", default=None)
+
+
+class _Metrics:
+    """Prometheus-style aggregates over finished spans"""
+
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = {}
+        self.duration_sums: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.bytes: Dict[Tuple[str, str], int] = {}
+        self.tokens: Dict[Tuple[str, str], int] = {}
+        self.cache: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, span: Span) -> None:
+        seconds = span.duration_ms / 1000
+        attributes = span.attributes
+        with self._lock:
+            buckets = self.durations.setdefault(span.name, [0] * len(DURATION_BUCKETS))
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    buckets[i] += 1
+            self.duration_sums[span.name] = self.duration_sums.get(span.name, 0.0) + seconds
+            self.counts[span.name] = self.counts.get(span.name, 0) + 1
+            if span.status == "ERROR":
+                self.errors[span.name] = self.errors.get(span.name, 0) + 1
+            for direction in ("request", "response"):
+                size = attributes.get(f"payload.{direction}_bytes")
+                if size:
+                    key = (span.name, direction)
+                    self.bytes[key] = self.bytes.get(key, 0) + int(size)
+            for kind in ("prompt", "completion", "total"):
+                count = attributes.get(f"tokens.{kind}")
+                if count:
+                    key = (span.name, kind)
+                    self.tokens[key] = self.tokens.get(key, 0) + int(count)
+            if "cache.hit" in attributes:
+                key = (span.name, "hit" if attributes["cache.hit"] else "miss")
+                self.cache[key] = self.cache.get(key, 0) + 1
+
+    def render(self) -> str:
+        lines = [
+            "# HELP span_duration_seconds Duration of traced operations",
+            "# TYPE span_duration_seconds histogram",
+        ]
+        with self._lock:
+            for name, buckets in sorted(self.durations.items()):
+                for bound, count in zip(DURATION_BUCKETS, buckets):
+                    lines.append(f'span_duration_seconds_bucket{{span="{name}",le="{bound}"}} {count}')
+                lines.append(f'span_duration_seconds_bucket{{span="{name}",le="+Inf"}} {self.counts[name]}')
+                lines.append(f'span_duration_seconds_sum{{span="{name}"}} {self.duration_sums[name]:.6f}')
+                lines.append(f'span_duration_seconds_count{{span="{name}"}} {self.counts[name]}')
+            lines += ["# HELP span_errors_total Traced operations that raised", "# TYPE span_errors_total counter"]
+            for name, count in sorted(self.errors.items()):
+                lines.append(f'span_errors_total{{span="{name}"}} {count}')
+            lines += ["# HELP span_payload_bytes_total Payload bytes sent and received",
+                      "# TYPE span_payload_bytes_total counter"]
+            for (name, direction), size in sorted(self.bytes.items()):
+                lines.append(f'span_payload_bytes_total{{span="{name}",direction="{direction}"}} {size}')
+            lines += ["# HELP span_tokens_total Tokens consumed by model calls", "# TYPE span_tokens_total counter"]
+            for (name, kind), count in sorted(self.tokens.items()):
+                lines.append(f'span_tokens_total{{span="{name}",kind="{kind}"}} {count}')
+            lines += ["# HELP span_cache_lookups_total Cache lookups by result", "# TYPE span_cache_lookups_total counter"]
+            for (name, result), count in sorted(self.cache.items()):
+                lines.append(f'span_cache_lookups_total{{span="{name}",result="{result}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+class _Exporter:
+    """Appends finished spans to a JSON-lines file from a background thread, off the event loop"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.dropped = 0
+        self._queue: "queue.Queue[Optional[List[Dict[str, Any]]]]" = queue.Queue(maxsize=TRACE_EXPORT_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run, daemon=True, name="trace-exporter")
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, spans: List[Dict[str, Any]]) -> None:
+        try:
+            self._queue.put_nowait(spans)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self) -> None:
+        while True:
+            spans = self._queue.get()
+            if spans is None:
+                return
+            try:
+                with open(self.path, "a") as f:
+                    for span in spans:
+                        f.write(json.dumps(span, default=str) + "\n")
+            except OSError as e:
+                print(f"Could not export trace spans to {self.path}: {str(e)}")
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Write what is queued, then stop"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+
+class TraceBuffer:
+    """Ring buffer of the most recent finished traces, plus the optional JSON-lines exporter"""
+
+    def __init__(self, max_traces: int = TRACE_BUFFER_SIZE, export_path: Optional[str] = TRACE_EXPORT_PATH):
+        self.traces: Deque[Dict[str, Any]] = deque(maxlen=max_traces)
+        self.exporter = _Exporter(export_path) if export_path else None
+        self._lock = threading.Lock()
+
+    def add(self, trace: _Trace) -> None:
+        spans = [span.as_dict() for span in trace.spans]
+        root = next((span for span in spans if span["parent_span_id"] is None), spans[0])
+        record = {
+            "trace_id": trace.trace_id,
+            "name": root["name"],
+            "duration_ms": root["duration_ms"],
+            "start_time_unix_nano": root["start_time_unix_nano"],
+            "dropped_spans": trace.dropped_spans,
+            "spans": spans,
+        }
+        with self._lock:
+            self.traces.append(record)
+        if self.exporter is not None:
+            self.exporter.submit(spans)
+
+    def recent(self, limit: int = 50, name: Optional[str] = None,
+               min_duration_ms: float = 0.0) -> List[Dict[str, Any]]:
+        with self._lock:
+            traces = list(self.traces)
+        traces = [
+            trace for trace in reversed(traces)
+            if trace["duration_ms"] >= min_duration_ms and (name is None or name in trace["name"])
+        ]
+        return traces[:limit]
+
+    def get(self, trace_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return next((trace for trace in self.traces if trace["trace_id"] == trace_id), None)
+
+
+metrics = _Metrics()
+trace_buffer = TraceBuffer()
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def annotate(**attributes: Any) -> None:
+    """Set attributes on the current span, if any"""
+    active = _current_span.get()
+    if active is not None:
+        for key, value in attributes.items():
+            active.set(key, value)
+
+
+def _start(name: str, attributes: Dict[str, Any]) -> Tuple[Span, _Trace, bool]:
+    parent = _current_span.get()
+    trace = _current_trace.get()
+    is_root = parent is None or trace is None
+    if is_root:
+        trace = _Trace(secrets.token_hex(16))
+    new_span = Span(name, trace.trace_id, None if is_root else parent.span_id, attributes)
+    if len(trace.spans) < TRACE_MAX_SPANS:
+        trace.spans.append(new_span)
+    else:
+        trace.dropped_spans += 1
+    trace.open_spans += 1
+    return new_span, trace, is_root
+
+
+def _finish(finished: Span, trace: _Trace) -> None:
+    if finished.end_ns is None:
+        finished.end_ns = time.time_ns()
+    trace.open_spans -= 1
+    metrics.observe(finished)
+    if finished.parent_id is None:
+        if trace.dropped_spans:
+            finished.set("trace.dropped_spans", trace.dropped_spans)
+        trace_buffer.add(trace)
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span]:
+    """
+    Time the enclosed block as a span
+
+    The span is a child of the current span; outside any span it starts a new
+    trace. Exceptions mark the span as failed and propagate.
+
+    Args:
+        name: Operation name, e.g. "pinecone.query"
+        **attributes: Initial span attributes
+    """
+    if not TRACING_ENABLED:
+        yield Span(name, "", None, attributes)
+        return
+
+    new_span, trace, is_root = _start(name, attributes)
+    span_token = _current_span.set(new_span)
+    trace_token = _current_trace.set(trace)
+    otel_context = _otel_tracer.start_as_current_span(name) if _otel_tracer is not None else None
+    otel_span = otel_context.__enter__() if otel_context is not None else None
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.status = "ERROR"
+        new_span.error = f"{type(e).__name__}: {e}"
+        raise
+    else:
+        if new_span.status == "UNSET":
+            new_span.status = "OK"
+    finally:
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+        _finish(new_span, trace)
+        if otel_context is not None:
+            for key, value in new_span.attributes.items():
+                if isinstance(value, (str, bool, int, float)):
+                    otel_span.set_attribute(key, value)
+            otel_context.__exit__(None, None, None)
+
+
+def record_span(name: str, duration_ms: float, error: Optional[str] = None, **attributes: Any) -> None:
+    """Add an already-finished operation (timed elsewhere) as a child of the current span"""
+    if not TRACING_ENABLED:
+        return
+    finished, trace, _is_root = _start(name, attributes)
+    finished.end_ns = time.time_ns()
+    finished.start_ns = finished.end_ns - int(duration_ms * 1e6)
+    finished.status = "ERROR" if error else "OK"
+    finished.error = error
+    _finish(finished, trace)
+
+
+class MongoCommandTracer(monitoring.CommandListener):
+    """
+    Records each MongoDB command (finds, inserts, GridFS chunk reads...) as a span
+
+    Sync pymongo runs listeners on the calling thread, so commands are
+    attached to the request's current span.
+    """
+
+    # Handshake / monitoring commands that would only add noise
+    IGNORED_COMMANDS = {"ismaster", "isMaster", "hello", "ping", "saslStart", "saslContinue", "endSessions"}
+
+    def __init__(self):
+        self._pending: Dict[Tuple[Any, int], Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def started(self, event) -> None:
+        if event.command_name in self.IGNORED_COMMANDS:
+            return
+        collection = event.command.get(event.command_name)
+        attributes = {
+            "db.system": "mongodb",
+            "db.name": event.database_name,
+            "db.operation": event.command_name,
+            "db.collection": collection if isinstance(collection, str) else None,
+        }
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = attributes
+
+    def _complete(self, event, error: Optional[str] = None) -> None:
+        with self._lock:
+            attributes = self._pending.pop((event.connection_id, event.request_id), None)
+        if attributes is None:
+            return
+        collection = attributes.get("db.collection")
+        name = f"mongo.{event.command_name}" + (f" {collection}" if collection else "")
+        record_span(name, event.duration_micros / 1000, error=error,
+                    **{key: value for key, value in attributes.items() if value is not None})
+
+    def succeeded(self, event) -> None:
+        self._complete(event)
+
+    def failed(self, event) -> None:
+        self._complete(event, error=str(event.failure))
+
+
+mongo_tracer = MongoCommandTracer()
+
+
+class TraceMiddleware:
+    """ASGI middleware: one root span per HTTP request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with span(f"{scope['method']} {scope['path']}", **{"http.method": scope["method"],
+                                                           "http.target": scope["path"]}) as root:
+            async def _send(message):
+                if message["type"] == "http.response.start":
+                    root.set("http.status_code", message["status"])
+                    if message["status"] >= 500:
+                        root.status = "ERROR"
+                await send(message)
+
+            try:
+                await self.app(scope, receive, _send)
+            finally:
+                # Name by route template (/claims/{claim_id}) rather than the raw path, to bound
+                # metric labels, whether the app returned or raised; the raw path stays in http.target
+                route = scope.get("route")
+                if route is not None and getattr(route, "path", None):
+                    root.name = f"{scope['method']} {route.path}"
+                else:
+                    root.name = f"{scope['method']} (unmatched)"
+
+
+def render_prometheus() -> str:
+    """All span metrics in the Prometheus text exposition format"""
+    return metrics.render()
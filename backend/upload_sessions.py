@@ -0,0 +1,489 @@
+#!/usr/bin/env python3
+"""
+Resumable uploads for large claim files (tus-style).
+
+The client creates an upload session with the file's total length, sends the
+bytes in any number of PATCH requests (each starting at the offset the server
+reports on HEAD), then finalizes with the file's SHA-256. Each request body is
+staged on disk as it arrives, in a segment file of its own under
+``UPLOAD_STAGING_DIR`` (a volume shared by all API instances), so a dropped
+connection loses only what was in flight and neither the server's memory nor
+MongoDB ever holds the file. The session document only records how much of
+each segment was accepted: every 1 MiB is flushed and then acknowledged with a
+compare-and-set on the session's offset, so of two requests writing the same
+range only one is accepted, and bytes a losing request wrote are never read.
+
+The SHA-256 is computed as ranges are accepted, so finalizing doesn't reread
+the file; if the ranges arrived at different processes (or one restarted),
+the staged segments are hashed on finalize instead. The staged bytes are then
+stored like any other upload (deduplicated, compressed, in the configured blob
+backend). Disk and database work runs on the thread pool, never on the event
+loop.
+
+Sessions idle for longer than ``UPLOAD_SESSION_TTL`` are removed together with
+their staged segments. This happens periodically when sessions are created, or
+from cron:
+
+    python upload_sessions.py --cleanup
+"""
+
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.collection import Collection
+from pymongo.database import Database
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
+
+from database import get_db
+from file_storage import FileStorage
+
+UPLOAD_SESSIONS_COLLECTION = "upload_sessions"
+UPLOAD_STAGING_DIR = os.getenv(
+    "UPLOAD_STAGING_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "upload-staging")
+)
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Bytes flushed and acknowledged at a time
+UPLOAD_MAX_SIZE = int(os.getenv("UPLOAD_MAX_SIZE", str(2 * 1024 * 1024 * 1024)))
+UPLOAD_SESSION_TTL = float(os.getenv("UPLOAD_SESSION_TTL", "24"))  # hours since the last PATCH
+UPLOAD_CLEANUP_INTERVAL = float(os.getenv("UPLOAD_CLEANUP_INTERVAL", "300"))  # seconds
+
+# Session states: "open" while receiving bytes, "finalizing" while one complete() stores them
+UPLOAD_OPEN = "open"
+UPLOAD_FINALIZING = "finalizing"
+
+# tus uses 460 for a checksum mismatch
+CHECKSUM_MISMATCH = 460
+
+_SHA256 = re.compile(r"^[0-9a-f]{64}$")
+
+_indexed = False
+_last_cleanup = 0.0
+
+# Running SHA-256 of each upload whose accepted ranges all arrived at this process: upload ID ->
+# (bytes hashed, hash). Dropped as soon as a range is accepted elsewhere.
+_digests: Dict[ObjectId, Tuple[int, Any]] = {}
+_digests_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    """A request the upload session can't accept; ``status_code`` is the HTTP status to answer with"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _sessions(db: Database) -> Collection:
+    global _indexed
+    sessions = db[UPLOAD_SESSIONS_COLLECTION]
+    if not _indexed:
+        sessions.create_index("expires_at")
+        _indexed = True
+    return sessions
+
+
+def _as_object_id(upload_id: str) -> Optional[ObjectId]:
+    try:
+        return ObjectId(upload_id)
+    except Exception:
+        return None
+
+
+def _expiry() -> datetime:
+    return datetime.now() + timedelta(hours=UPLOAD_SESSION_TTL)
+
+
+def _staging_dir(upload_id: ObjectId) -> str:
+    return os.path.join(UPLOAD_STAGING_DIR, str(upload_id))
+
+
+def _session_info(session: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "upload_id": str(session["_id"]),
+        "claim_id": session.get("claim_id"),
+        "filename": session.get("filename"),
+        "content_type": session.get("content_type"),
+        "length": session["length"],
+        "offset": session["offset"],
+        "state": session["state"],
+        "expires_at": session.get("expires_at"),
+    }
+
+
+def _normalize_sha256(sha256: Optional[str]) -> Optional[str]:
+    if sha256 is None:
+        return None
+    sha256 = sha256.strip().lower()
+    if not _SHA256.match(sha256):
+        raise UploadError(400, "sha256 must be 64 hex digits")
+    return sha256
+
+
+def _segments(session: Dict[str, Any]) -> List[Tuple[str, int, int]]:
+    """The accepted (segment file, offset, length) ranges, in order, checking they are contiguous"""
+    segments = sorted(
+        ((name, segment["offset"], segment["length"]) for name, segment in (session.get("segments") or {}).items()),
+        key=lambda segment: segment[1],
+    )
+    position = 0
+    for _, offset, length in segments:
+        if offset != position:
+            raise UploadError(409, f"Staged upload has a gap at offset {position}")
+        position += length
+    return segments
+
+
+def _start_segment(db: Database, upload_id: str, offset: int) -> Tuple[ObjectId, Dict[str, Any], str, Any]:
+    """Check the session accepts a range at ``offset`` and open a new segment file for it"""
+    obj_id = _as_object_id(upload_id)
+    session = _sessions(db).find_one({"_id": obj_id}, {"segments": 0}) if obj_id else None
+    if not session:
+        raise UploadError(404, f"Upload {upload_id} not found")
+    if session["state"] != UPLOAD_OPEN:
+        raise UploadError(409, f"Upload {upload_id} is already being finalized")
+    if session["offset"] != offset:
+        raise UploadError(409, f"Upload-Offset {offset} does not match the current offset {session['offset']}")
+    os.makedirs(_staging_dir(obj_id), exist_ok=True)
+    # Every request writes its own file: a competing or stale request never touches accepted bytes
+    name = f"{offset:016d}-{ObjectId()}"
+    return obj_id, session, name, open(os.path.join(_staging_dir(obj_id), name), "xb")
+
+
+def _write_chunk(db: Database, upload_id: ObjectId, segment: Tuple[str, int, Any], position: int, data: bytes) -> int:
+    """Stage one chunk at ``position`` in the request's segment and advance the session past it; returns the new offset"""
+    name, segment_offset, f = segment
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+    end = position + len(data)
+    advanced = _sessions(db).update_one(
+        {"_id": upload_id, "offset": position, "state": UPLOAD_OPEN},
+        {"$set": {
+            "offset": end,
+            f"segments.{name}": {"offset": segment_offset, "length": end - segment_offset},
+            "updated_at": datetime.now(),
+            "expires_at": _expiry(),
+        }},
+    ).modified_count
+    if not advanced:
+        raise UploadError(409, "Upload session changed while writing; check the offset and retry")
+
+    with _digests_lock:
+        hashed, digest = _digests.get(upload_id, (0, hashlib.sha256()) if position == 0 else (None, None))
+        if hashed == position:
+            digest.update(data)
+            _digests[upload_id] = (end, digest)
+        else:
+            # Part of the upload was accepted elsewhere: finalize hashes the staged segments
+            _digests.pop(upload_id, None)
+    return end
+
+
+def _close_segment(db: Database, upload_id: ObjectId, segment: Tuple[str, int, Any], accepted: bool) -> None:
+    name, _, f = segment
+    f.close()
+    if not accepted:
+        try:
+            os.remove(os.path.join(_staging_dir(upload_id), name))
+        except FileNotFoundError:
+            pass
+
+
+class _StagedReader:
+    """Read-only file view of a session's accepted segments; supports ``seek(0)`` only"""
+
+    def __init__(self, upload_id: ObjectId, segments: List[Tuple[str, int, int]]):
+        self._directory = _staging_dir(upload_id)
+        self._segments = segments
+        self._file = None
+        self.seek(0)
+
+    def seek(self, position: int) -> None:
+        if position != 0:
+            raise ValueError("Staged uploads can only be rewound")
+        self.close()
+        self._pending = iter(self._segments)
+        self._remaining = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = bytearray()
+        while size < 0 or len(data) < size:
+            if not self._remaining:
+                self.close()
+                segment = next(self._pending, None)
+                if segment is None:
+                    break
+                name, _, self._remaining = segment
+                self._file = open(os.path.join(self._directory, name), "rb")
+            wanted = self._remaining if size < 0 else min(self._remaining, size - len(data))
+            piece = self._file.read(wanted)
+            if not piece:
+                raise UploadError(409, f"Staged segment {name} is shorter than accepted")
+            data += piece
+            self._remaining -= len(piece)
+        return bytes(data)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _hash_staged(upload_id: ObjectId, segments: List[Tuple[str, int, int]]) -> Tuple[str, int]:
+    """SHA-256 and size of the accepted segments"""
+    digest = hashlib.sha256()
+    size = 0
+    reader = _StagedReader(upload_id, segments)
+    try:
+        while True:
+            data = reader.read(UPLOAD_CHUNK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+            size += len(data)
+    finally:
+        reader.close()
+    return digest.hexdigest(), size
+
+
+def _discard(db: Database, upload_id: ObjectId) -> bool:
+    deleted = _sessions(db).delete_one({"_id": upload_id}).deleted_count
+    shutil.rmtree(_staging_dir(upload_id), ignore_errors=True)
+    with _digests_lock:
+        _digests.pop(upload_id, None)
+    return deleted == 1
+
+
+def _begin_finalize(db: Database, upload_id: str, sha256: Optional[str]) -> Tuple[ObjectId, Dict[str, Any], List[Tuple[str, int, int]], str]:
+    """Lock the session for finalizing and verify the staged bytes against the checksum"""
+    obj_id = _as_object_id(upload_id)
+    if obj_id is None:
+        raise UploadError(404, f"Upload {upload_id} not found")
+    # Only one request may finalize; PATCHes are refused from here on
+    session = _sessions(db).find_one_and_update(
+        {"_id": obj_id, "state": UPLOAD_OPEN},
+        {"$set": {"state": UPLOAD_FINALIZING, "updated_at": datetime.now(), "expires_at": _expiry()}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not session:
+        if _sessions(db).find_one({"_id": obj_id}, {"_id": 1}):
+            raise UploadError(409, f"Upload {upload_id} is already being finalized")
+        raise UploadError(404, f"Upload {upload_id} not found")
+
+    try:
+        if session["offset"] != session["length"]:
+            raise UploadError(409, f"Upload incomplete: {session['offset']} of {session['length']} bytes received")
+        expected = _normalize_sha256(sha256) or session.get("sha256")
+        if not expected:
+            raise UploadError(400, "sha256 is required to finalize an upload")
+        segments = _segments(session)
+    except UploadError:
+        _reopen(db, obj_id)
+        raise
+
+    with _digests_lock:
+        hashed, digest = _digests.pop(obj_id, (None, None))
+    if hashed == session["length"]:
+        actual, size = digest.hexdigest(), hashed
+    else:
+        actual, size = _hash_staged(obj_id, segments)
+    if actual != expected or size != session["length"]:
+        # The staged bytes are corrupt; the client has to send the file again
+        _discard(db, obj_id)
+        raise UploadError(CHECKSUM_MISMATCH, f"Checksum mismatch: received content has sha256 {actual}")
+    return obj_id, session, segments, actual
+
+
+def _reopen(db: Database, upload_id: ObjectId) -> None:
+    _sessions(db).update_one({"_id": upload_id}, {"$set": {"state": UPLOAD_OPEN}})
+
+
+def cleanup_expired_uploads(db: Optional[Database] = None) -> int:
+    """
+    Remove sessions idle past ``UPLOAD_SESSION_TTL``, with their staged segments
+
+    Staging directories without a session (e.g. left by a crash) are removed once as old.
+
+    Returns:
+        The number of sessions removed
+    """
+    global _last_cleanup
+    db = db if db is not None else get_db()
+    _last_cleanup = time.monotonic()
+    expired = [session["_id"] for session in _sessions(db).find({"expires_at": {"$lt": datetime.now()}}, {"_id": 1})]
+    removed = 0
+    if expired:
+        removed = _sessions(db).delete_many({"_id": {"$in": expired}}).deleted_count
+        print(f"Removed {removed} abandoned upload sessions")
+
+    with _digests_lock:
+        tracked = list(_digests)
+    live = {session["_id"] for session in _sessions(db).find({"_id": {"$in": tracked}}, {"_id": 1})} if tracked else set()
+    with _digests_lock:
+        for upload_id in tracked:
+            if upload_id not in live:
+                _digests.pop(upload_id, None)
+
+    if os.path.isdir(UPLOAD_STAGING_DIR):
+        cutoff = time.time() - UPLOAD_SESSION_TTL * 3600
+        for name in os.listdir(UPLOAD_STAGING_DIR):
+            path = os.path.join(UPLOAD_STAGING_DIR, name)
+            upload_id = _as_object_id(name)
+            if upload_id is None:
+                continue
+            if upload_id in expired or (
+                os.path.getmtime(path) < cutoff and not _sessions(db).find_one({"_id": upload_id}, {"_id": 1})
+            ):
+                shutil.rmtree(path, ignore_errors=True)
+    return removed
+
+
+class UploadSessions:
+    """Resumable upload sessions for claim files"""
+
+    @staticmethod
+    def create(claim_id: str, length: int, filename: Optional[str] = None, content_type: Optional[str] = None,
+               user_id: Optional[str] = None, sha256: Optional[str] = None) -> dict:
+        """
+        Start a resumable upload
+
+        Args:
+            claim_id: The claim the file will be attached to
+            length: The file's total size in bytes
+            filename: The file's name
+            content_type: The file's content type
+            user_id: The ID of the uploading user (optional)
+            sha256: The file's SHA-256, if already known (otherwise required on finalize)
+
+        Returns:
+            The session's details
+        """
+        if length <= 0:
+            raise UploadError(400, "Upload-Length must be positive")
+        if length > UPLOAD_MAX_SIZE:
+            raise UploadError(413, f"Upload-Length exceeds the {UPLOAD_MAX_SIZE} byte limit")
+        db = get_db()
+        if time.monotonic() - _last_cleanup > UPLOAD_CLEANUP_INTERVAL:
+            cleanup_expired_uploads(db)
+
+        now = datetime.now()
+        session = {
+            "claim_id": claim_id,
+            "user_id": user_id,
+            "filename": filename or "upload",
+            "content_type": content_type or "application/octet-stream",
+            "length": length,
+            "offset": 0,
+            "sha256": _normalize_sha256(sha256),
+            "state": UPLOAD_OPEN,
+            "created_at": now,
+            "updated_at": now,
+            "expires_at": _expiry(),
+        }
+        session["_id"] = _sessions(db).insert_one(session).inserted_id
+        return _session_info(session)
+
+    @staticmethod
+    def get(upload_id: str) -> Optional[dict]:
+        """
+        The session's details (``offset`` is where the next PATCH must start), or None if unknown or expired
+        """
+        obj_id = _as_object_id(upload_id)
+        if obj_id is None:
+            return None
+        session = _sessions(get_db()).find_one({"_id": obj_id, "expires_at": {"$gte": datetime.now()}}, {"segments": 0})
+        return _session_info(session) if session else None
+
+    @staticmethod
+    async def append(upload_id: str, offset: int, body: AsyncIterator[bytes]) -> int:
+        """
+        Write a byte range to the session, staging it chunk by chunk as it arrives
+
+        Args:
+            upload_id: The session's ID
+            offset: Where the range starts; must equal the session's current offset
+            body: The request body stream
+
+        Returns:
+            The new offset; if the client disconnected midway, it covers what arrived
+        """
+        db = get_db()
+        obj_id, session, name, f = await run_in_threadpool(_start_segment, db, upload_id, offset)
+        segment = (name, offset, f)
+        position = offset
+        buffer = bytearray()
+        try:
+            try:
+                async for data in body:
+                    if position + len(buffer) + len(data) > session["length"]:
+                        raise UploadError(413, "Request body goes past Upload-Length")
+                    buffer += data
+                    while len(buffer) >= UPLOAD_CHUNK_SIZE:
+                        position = await run_in_threadpool(
+                            _write_chunk, db, obj_id, segment, position, bytes(buffer[:UPLOAD_CHUNK_SIZE])
+                        )
+                        del buffer[:UPLOAD_CHUNK_SIZE]
+            except ClientDisconnect:
+                # Keep what arrived; the client resumes from the offset HEAD reports
+                print(f"Client disconnected from upload {upload_id} at offset {position + len(buffer)}")
+            if buffer:
+                position = await run_in_threadpool(_write_chunk, db, obj_id, segment, position, bytes(buffer))
+        finally:
+            await run_in_threadpool(_close_segment, db, obj_id, segment, position > offset)
+        return position
+
+    @staticmethod
+    async def complete(upload_id: str, sha256: Optional[str] = None) -> dict:
+        """
+        Verify a fully received upload against its checksum and store it as a claim file
+
+        Args:
+            upload_id: The session's ID
+            sha256: The file's SHA-256 (hex); falls back to the one given at creation
+
+        Returns:
+            File details as returned by ``FileStorage.save_stream``
+        """
+        db = get_db()
+        obj_id, session, segments, actual = await run_in_threadpool(_begin_finalize, db, upload_id, sha256)
+        reader = _StagedReader(obj_id, segments)
+        try:
+            info = await FileStorage.save_stream(reader, actual, session["length"], session["filename"],
+                                                 session["content_type"], session["claim_id"], session.get("user_id"))
+        except Exception:
+            await run_in_threadpool(_reopen, db, obj_id)
+            raise
+        finally:
+            reader.close()
+        await run_in_threadpool(_discard, db, obj_id)
+        return info
+
+    @staticmethod
+    def abort(upload_id: str) -> bool:
+        """Drop a session and its staged bytes; False if it didn't exist"""
+        obj_id = _as_object_id(upload_id)
+        return obj_id is not None and _discard(get_db(), obj_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resumable upload session maintenance")
+    parser.add_argument("--cleanup", action="store_true", help="Remove abandoned upload sessions")
+    args = parser.parse_args()
+    if args.cleanup:
+        cleanup_expired_uploads()
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
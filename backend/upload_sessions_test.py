@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Regression tests for resumable uploads (upload_sessions.py).
+
+Two PATCHes racing for the same offset must not both be accepted, a dropped
+connection must keep what arrived, and finalizing must check the checksum
+whether the running hash or the staged segments are used. Runs against
+mongomock and temporary directories, like retention_test.py:
+
+    python upload_sessions_test.py
+"""
+
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import mongomock
+import pymongo
+from starlette.requests import ClientDisconnect
+
+_workdir = tempfile.mkdtemp(prefix="upload-sessions-test-")
+os.environ.update({
+    "MONGODB_URI": "mongodb://localhost:27017",
+    "DB_NAME": "claims-upload-sessions-test",
+    "FILE_BLOB_BACKEND": "gridfs",
+    "FILE_BLOB_DIR": os.path.join(_workdir, "blobs"),
+    "UPLOAD_STAGING_DIR": os.path.join(_workdir, "upload-staging"),
+})
+pymongo.MongoClient = mongomock.MongoClient
+
+import file_storage  # noqa: E402
+import upload_sessions  # noqa: E402
+from database import get_db  # noqa: E402
+from upload_sessions import CHECKSUM_MISMATCH, UPLOAD_STAGING_DIR, UploadError, UploadSessions  # noqa: E402
+
+# Small chunks so a few KiB exercise several acknowledged writes per request
+upload_sessions.UPLOAD_CHUNK_SIZE = 1024
+
+CONTENT = bytes(range(256)) * 40
+SHA256 = hashlib.sha256(CONTENT).hexdigest()
+
+
+def _reset():
+    db = get_db()
+    for name in db.list_collection_names():
+        db.drop_collection(name)
+    shutil.rmtree(UPLOAD_STAGING_DIR, ignore_errors=True)
+    with upload_sessions._digests_lock:
+        upload_sessions._digests.clear()
+    return db
+
+
+async def _body(*pieces):
+    for piece in pieces:
+        yield piece
+
+
+def _staged(upload_id):
+    directory = os.path.join(UPLOAD_STAGING_DIR, upload_id)
+    return sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+
+
+def _assert_stored(db, info, content=CONTENT):
+    located = file_storage.read_file_bytes(db, info["file_id"])
+    assert located is not None, f"file {info['file_id']} is gone"
+    assert located[1] == content, f"stored {len(located[1])} bytes that differ from the {len(content)} uploaded"
+
+
+def _status(error_from):
+    try:
+        error_from()
+    except UploadError as e:
+        return e.status_code
+    return None
+
+
+def test_competing_patches_accept_one():
+    db = _reset()
+    upload_id = UploadSessions.create("CLM-1", len(CONTENT))["upload_id"]
+    split = 3000
+
+    async def race():
+        b_started = asyncio.Event()
+        a_done = asyncio.Event()
+
+        async def body_a():
+            await b_started.wait()
+            yield CONTENT[:split]
+
+        async def body_b():
+            # Both requests have checked the offset; B only writes once A's range was accepted
+            b_started.set()
+            await a_done.wait()
+            yield b"x" * split
+
+        task_b = asyncio.ensure_future(UploadSessions.append(upload_id, 0, body_b()))
+        offset = await UploadSessions.append(upload_id, 0, body_a())
+        a_done.set()
+        try:
+            await task_b
+        except UploadError as e:
+            return offset, e.status_code
+        return offset, None
+
+    offset, b_status = asyncio.run(race())
+    assert (offset, b_status) == (split, 409)
+    assert UploadSessions.get(upload_id)["offset"] == split
+    # The losing request's segment file is gone; only the accepted range is staged
+    assert len(_staged(upload_id)) == 1
+
+    assert asyncio.run(UploadSessions.append(upload_id, split, _body(CONTENT[split:]))) == len(CONTENT)
+    info = asyncio.run(UploadSessions.complete(upload_id, SHA256))
+    _assert_stored(db, info)
+    assert UploadSessions.get(upload_id) is None and _staged(upload_id) == []
+
+
+def test_resume_after_disconnect():
+    db = _reset()
+    upload_id = UploadSessions.create("CLM-1", len(CONTENT), sha256=SHA256)["upload_id"]
+
+    async def dropped():
+        yield CONTENT[:2500]
+        raise ClientDisconnect()
+
+    # What arrived before the disconnect is kept, including the part short of a full chunk
+    assert asyncio.run(UploadSessions.append(upload_id, 0, dropped())) == 2500
+    assert UploadSessions.get(upload_id)["offset"] == 2500
+
+    # A retry from the old offset is refused; resuming from the reported one succeeds
+    assert _status(lambda: asyncio.run(UploadSessions.append(upload_id, 0, _body(CONTENT)))) == 409
+    assert asyncio.run(UploadSessions.append(upload_id, 2500, _body(CONTENT[2500:6000], CONTENT[6000:]))) == len(CONTENT)
+    _assert_stored(db, asyncio.run(UploadSessions.complete(upload_id)))
+
+
+def test_running_hash_matches_staged_segments():
+    db = _reset()
+    upload_id = UploadSessions.create("CLM-1", len(CONTENT))["upload_id"]
+    for start in range(0, len(CONTENT), 4000):
+        asyncio.run(UploadSessions.append(upload_id, start, _body(CONTENT[start:start + 4000])))
+
+    obj_id = upload_sessions._as_object_id(upload_id)
+    session = db[upload_sessions.UPLOAD_SESSIONS_COLLECTION].find_one({"_id": obj_id})
+    hashed, digest = upload_sessions._digests[obj_id]
+    staged = upload_sessions._hash_staged(obj_id, upload_sessions._segments(session))
+    assert (digest.hexdigest(), hashed) == staged == (SHA256, len(CONTENT))
+
+    # As if the ranges had arrived at another process: finalize hashes the staged segments
+    with upload_sessions._digests_lock:
+        upload_sessions._digests.clear()
+    _assert_stored(db, asyncio.run(UploadSessions.complete(upload_id, SHA256)))
+
+
+def test_checksum_mismatch_discards_upload():
+    db = _reset()
+    for running_hash in (True, False):
+        upload_id = UploadSessions.create("CLM-1", len(CONTENT))["upload_id"]
+        asyncio.run(UploadSessions.append(upload_id, 0, _body(CONTENT)))
+        if not running_hash:
+            with upload_sessions._digests_lock:
+                upload_sessions._digests.clear()
+
+        wrong = hashlib.sha256(CONTENT + b"!").hexdigest()
+        assert _status(lambda: asyncio.run(UploadSessions.complete(upload_id, wrong))) == CHECKSUM_MISMATCH
+        assert UploadSessions.get(upload_id) is None and _staged(upload_id) == []
+    assert db[file_storage.FILE_REFS_COLLECTION].count_documents({}) == 0
+
+
+def test_cleanup_removes_expired_sessions():
+    db = _reset()
+    expired_id = UploadSessions.create("CLM-1", len(CONTENT))["upload_id"]
+    live_id = UploadSessions.create("CLM-1", len(CONTENT))["upload_id"]
+    for upload_id in (expired_id, live_id):
+        asyncio.run(UploadSessions.append(upload_id, 0, _body(CONTENT[:2000])))
+    sessions = db[upload_sessions.UPLOAD_SESSIONS_COLLECTION]
+    sessions.update_one({"_id": upload_sessions._as_object_id(expired_id)},
+                        {"$set": {"expires_at": datetime.now() - timedelta(minutes=1)}})
+
+    # Staging left by a crash: no session, older than the TTL
+    orphan = os.path.join(UPLOAD_STAGING_DIR, str(upload_sessions.ObjectId()))
+    os.makedirs(orphan)
+    old = time.time() - upload_sessions.UPLOAD_SESSION_TTL * 3600 - 60
+    os.utime(orphan, (old, old))
+
+    assert upload_sessions.cleanup_expired_uploads(db) == 1
+    assert UploadSessions.get(expired_id) is None and _staged(expired_id) == []
+    assert upload_sessions._as_object_id(expired_id) not in upload_sessions._digests
+    assert not os.path.exists(orphan)
+    assert UploadSessions.get(live_id)["offset"] == 2000 and len(_staged(live_id)) == 1
+
+
+if __name__ == "__main__":
+    try:
+        for name, test in list(globals().items()):
+            if name.startswith("test_") and callable(test):
+                test()
+                print(f"{name}: ok")
+    finally:
+        shutil.rmtree(_workdir, ignore_errors=True)
@@ -0,0 +1,148 @@
+"""
+ZIP archives written on the fly, for streaming a claim's files in one download.
+
+Entries are read, (optionally) deflated and written one chunk at a time, so
+memory stays constant however large the archive. CRCs aren't known until an
+entry's data has been sent, so each entry is followed by a data descriptor
+(general purpose flag bit 3), which every unzip tool supports. With every
+entry stored uncompressed the archive's exact size is known up front
+(``archive_size``), so the response can carry a Content-Length.
+
+Classic (non-ZIP64) format only: archives are limited to 4 GiB and 65535
+entries, checked before streaming starts.
+"""
+
+import struct
+import zlib
+from datetime import datetime
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP_DEFLATE_LEVEL = 6
+
+ZIP_MAX_SIZE = 0xFFFFFFFF
+ZIP_MAX_ENTRIES = 0xFFFF
+
+_VERSION = 20  # 2.0: deflate and data descriptors
+_FLAGS = 0x0008 | 0x0800  # sizes/CRC in the data descriptor, UTF-8 names
+_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+_DATA_DESCRIPTOR = struct.Struct("<IIII")
+_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+_END_OF_CENTRAL_DIRECTORY = struct.Struct("<IHHHHIIH")
+
+
+class ZipEntry:
+    """One file in a streamed archive"""
+
+    def __init__(self, name: str, open_chunks: Callable[[], Iterable[bytes]], size: Optional[int] = None,
+                 modified: Optional[datetime] = None, compress: bool = False):
+        """
+        Args:
+            name: Path inside the archive
+            open_chunks: Called when the entry is reached, returns its content chunks
+            size: The content's size, if known (required for ``archive_size``)
+            modified: Modification time shown by unzip tools
+            compress: Deflate the entry instead of storing it
+        """
+        self.name = name
+        self.encoded_name = name.encode("utf-8")
+        self.open_chunks = open_chunks
+        self.size = size
+        self.modified = modified or datetime.now()
+        self.method = ZIP_DEFLATED if compress else ZIP_STORED
+
+
+def _dos_time(moment: datetime) -> Tuple[int, int]:
+    if moment.year < 1980:
+        moment = datetime(1980, 1, 1)
+    moment = max(moment, datetime(1980, 1, 1))
+    return (
+        (moment.hour << 11) | (moment.minute << 5) | (moment.second // 2),
+        ((moment.year - 1980) << 9) | (moment.month << 5) | moment.day,
+    )
+
+
+def archive_size(entries: List[ZipEntry]) -> Optional[int]:
+    """
+    The exact size of the archive, or None if it depends on compression or unknown entry sizes
+    """
+    total = _END_OF_CENTRAL_DIRECTORY.size
+    for entry in entries:
+        if entry.method != ZIP_STORED or entry.size is None:
+            return None
+        name_length = len(entry.encoded_name)
+        total += _LOCAL_HEADER.size + name_length + entry.size + _DATA_DESCRIPTOR.size
+        total += _CENTRAL_HEADER.size + name_length
+    return total
+
+
+def check_limits(entries: List[ZipEntry]) -> None:
+    """
+    Raise ValueError if the archive can't be written without ZIP64
+
+    Entries of unknown size are checked while streaming instead.
+    """
+    if len(entries) > ZIP_MAX_ENTRIES:
+        raise ValueError(f"Too many files for one archive ({len(entries)} > {ZIP_MAX_ENTRIES})")
+    # Deflated entries are at most slightly larger than their content
+    known = sum(entry.size for entry in entries if entry.size is not None)
+    if known + sum(200 + 2 * len(entry.encoded_name) for entry in entries) > ZIP_MAX_SIZE:
+        raise ValueError("Files are too large for one archive (4 GiB)")
+
+
+def stream_zip(entries: List[ZipEntry]) -> Iterator[bytes]:
+    """
+    Write a ZIP archive, yielding it piece by piece
+
+    Args:
+        entries: The files, in archive order
+
+    Raises:
+        ValueError: If an entry's content doesn't match its declared size, or the archive
+            outgrows the classic ZIP limits (the response is then cut short)
+    """
+    offset = 0
+    central_directory = []
+    for entry in entries:
+        dos_time, dos_date = _dos_time(entry.modified)
+        header = _LOCAL_HEADER.pack(
+            0x04034B50, _VERSION, _FLAGS, entry.method, dos_time, dos_date, 0, 0, 0, len(entry.encoded_name), 0
+        ) + entry.encoded_name
+        yield header
+
+        crc = 0
+        size = 0
+        compressed_size = 0
+        compressor = zlib.compressobj(ZIP_DEFLATE_LEVEL, zlib.DEFLATED, -15) if entry.method == ZIP_DEFLATED else None
+        for data in entry.open_chunks():
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            if compressor is not None:
+                data = compressor.compress(data)
+            if data:
+                compressed_size += len(data)
+                yield data
+        if compressor is not None:
+            data = compressor.flush()
+            compressed_size += len(data)
+            yield data
+        if entry.size is not None and size != entry.size:
+            raise ValueError(f"{entry.name}: expected {entry.size} bytes, read {size}")
+
+        if offset > ZIP_MAX_SIZE or size > ZIP_MAX_SIZE or compressed_size > ZIP_MAX_SIZE:
+            raise ValueError("Archive outgrew the 4 GiB ZIP limit")
+        yield _DATA_DESCRIPTOR.pack(0x08074B50, crc, compressed_size, size)
+        central_directory.append(_CENTRAL_HEADER.pack(
+            0x02014B50, _VERSION, _VERSION, _FLAGS, entry.method, dos_time, dos_date, crc, compressed_size, size,
+            len(entry.encoded_name), 0, 0, 0, 0, 0, offset,
+        ) + entry.encoded_name)
+        offset += len(header) + compressed_size + _DATA_DESCRIPTOR.size
+
+    directory = b"".join(central_directory)
+    if offset + len(directory) > ZIP_MAX_SIZE:
+        raise ValueError("Archive outgrew the 4 GiB ZIP limit")
+    yield directory
+    yield _END_OF_CENTRAL_DIRECTORY.pack(
+        0x06054B50, 0, 0, len(central_directory), len(central_directory), len(directory), offset, 0
+    )
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Regression tests for streamed ZIP archives (zip_stream.py).
+
+Archives must open with the standard library's zipfile and pass its CRC
+check, with stored and deflated entries alike, and ``archive_size`` must
+match what ``stream_zip`` writes. No database needed:
+
+    python zip_stream_test.py
+"""
+
+import io
+import os
+import zipfile
+from datetime import datetime
+
+from zip_stream import ZipEntry, archive_size, stream_zip
+
+TEXT = b"Claim MH-2024-0001: denial letter, page after page. " * 5000
+BINARY = os.urandom(300 * 1024)
+MODIFIED = datetime(2024, 5, 17, 14, 30, 12)
+
+
+def _chunked(content, size=64 * 1024):
+    return lambda: (content[start:start + size] for start in range(0, len(content), size))
+
+
+def _entries(compress):
+    return [
+        ZipEntry("letter.txt", _chunked(TEXT), size=len(TEXT), modified=MODIFIED, compress=compress),
+        ZipEntry("scan.pdf", _chunked(BINARY), size=len(BINARY), modified=MODIFIED),
+        ZipEntry("médical/empty.txt", _chunked(b""), size=0, modified=MODIFIED, compress=compress),
+    ]
+
+
+def _round_trip(entries):
+    archive = b"".join(stream_zip(entries))
+    with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+        assert zf.testzip() is None
+        contents = {info.filename: (info.compress_type, zf.read(info)) for info in zf.infolist()}
+        assert zf.getinfo("letter.txt").date_time == (2024, 5, 17, 14, 30, 12)
+    return archive, contents
+
+
+def test_stored_entries_round_trip():
+    entries = _entries(compress=False)
+    archive, contents = _round_trip(entries)
+    assert contents == {
+        "letter.txt": (zipfile.ZIP_STORED, TEXT),
+        "scan.pdf": (zipfile.ZIP_STORED, BINARY),
+        "médical/empty.txt": (zipfile.ZIP_STORED, b""),
+    }
+    assert archive_size(entries) == len(archive)
+
+
+def test_deflated_entries_round_trip():
+    entries = _entries(compress=True)
+    archive, contents = _round_trip(entries)
+    assert contents == {
+        "letter.txt": (zipfile.ZIP_DEFLATED, TEXT),
+        "scan.pdf": (zipfile.ZIP_STORED, BINARY),
+        "médical/empty.txt": (zipfile.ZIP_DEFLATED, b""),
+    }
+    assert len(archive) < len(TEXT) + len(BINARY)
+    # Compressed sizes aren't known up front
+    assert archive_size(entries) is None
+
+
+def test_entries_open_when_reached():
+    opened = []
+
+    def _open(name, content):
+        def _chunks():
+            opened.append(name)
+            return [content]
+        return _chunks
+
+    pieces = stream_zip([ZipEntry("a.txt", _open("a.txt", b"a")), ZipEntry("b.txt", _open("b.txt", b"b"))])
+    written = [next(pieces)]
+    assert opened == []
+    written.append(next(pieces))
+    assert opened == ["a.txt"]
+    written.extend(pieces)
+    assert opened == ["a.txt", "b.txt"]
+    with zipfile.ZipFile(io.BytesIO(b"".join(written))) as zf:
+        assert zf.testzip() is None and zf.read("b.txt") == b"b"
+
+
+def test_size_mismatch_raises():
+    entries = [ZipEntry("short.txt", _chunked(TEXT[:100]), size=200)]
+    try:
+        b"".join(stream_zip(entries))
+    except ValueError as e:
+        assert "expected 200 bytes, read 100" in str(e)
+    else:
+        raise AssertionError("a short entry was written without error")
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"{name}: ok")